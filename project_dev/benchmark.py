@@ -0,0 +1,439 @@
+##################################################################################
+# BENCHMARK สำหรับระบบจ่ายเงินห้องจัดเลี้ยง (room_payment.py)
+#
+# เรียก endpoint (async handler) ตรง ๆ ไม่ผ่าน HTTP เพื่อวัดเฉพาะงานของระบบเอง
+#
+# วิธีใช้:
+#   python benchmark.py                    # รันทุก benchmark
+#   python benchmark.py booking_lookup     # รันเฉพาะที่ระบุ
+#
+##################################################################################
+
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import room_payment as rp
+
+
+# ============================================================================
+# HELPERS
+# ============================================================================
+
+def print_header(title):
+    print()
+    print("=" * 70)
+    print(title)
+    print("=" * 70)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def quiet():
+    """ปิด print ของระบบระหว่างวัด"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def endpoint(tool):
+    """handler เดิมของ endpoint (@mcp.tool ห่อ function ไว้ใน .fn)"""
+    return getattr(tool, 'fn', tool)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def latency_row(name, latencies_ns, extra=''):
+    values = sorted(latencies_ns)
+    print(f"{name:>30} {len(values):>8,} {percentile(values, 50) / 1e3:>10.1f} "
+          f"{percentile(values, 99) / 1e3:>10.1f} {extra}")
+
+
+async def measure(handler, args_list):
+    latencies = []
+    clock = time.perf_counter_ns
+    for args in args_list:
+        start = clock()
+        await handler(*args)
+        latencies.append(clock() - start)
+    return latencies
+
+
+@contextlib.contextmanager
+def temp_transaction_log(**kwargs):
+    """ให้ Restaurant.add_log เขียนลง directory ชั่วคราวแทน transaction_log/ ของจริง"""
+    saved = rp.transaction_log
+    with tempfile.TemporaryDirectory() as directory:
+        rp.transaction_log = log = rp.TransactionLog(directory, **kwargs)
+        try:
+            yield log
+        finally:
+            log.close()
+            rp.transaction_log = saved
+
+
+def load_bookings(n_bookings, n_members=10_000, days=60, in_use=0.3, seed=21):
+    """ใส่ booking n_bookings รายการ (กระจาย member / ห้อง / วัน) แทน mock data"""
+    rng = random.Random(seed)
+    rp.BookingManager.clear()
+    members = [rp.Member(f"M{i:06d}", f"Member {i}", rp.MemberTier.BRONZE) for i in range(n_members)]
+    rooms = [rp.Room(f"R{i:02d}", room_type) for i, room_type in enumerate(rp.RoomType)]
+    today = rp.SimulationClock.get_time().replace(hour=10, minute=0, second=0, microsecond=0)
+    for i in range(n_bookings):
+        start = today + timedelta(days=rng.randrange(-days // 2, days // 2), hours=rng.randrange(10))
+        booking = rp.Booking(f"B{i:06d}", rng.choice(members), rng.choice(rooms), start, rng.randint(1, 4))
+        if rng.random() < 0.5:
+            booking.add_event_order(rp.EventOrder(f"ORD-{i:06d}", rng.randrange(1, 50) * 20.0))
+        rp.BookingManager.add_booking(booking)
+        if rng.random() < in_use:
+            booking.status = rp.BookingStatus.IN_USE
+    return members, today
+
+
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+def bench_booking_lookup(n_bookings=100_000, requests=20_000, scan_requests=200):
+    """get_base_price และ staff query ตอนมี booking n_bookings รายการ: index vs scan list แบบเดิม"""
+    print_header(f"Booking lookup with {n_bookings:,} bookings")
+    (members, today), build = timed(load_bookings, n_bookings)
+    print(f"loaded in {build:.2f}s")
+    rng = random.Random(1)
+    booking_ids = [f"B{rng.randrange(n_bookings):06d}" for _ in range(requests)]
+    bookings = rp.BookingManager._booking_list
+
+    def scan_by_id(booking_id):
+        for booking in bookings:
+            if booking.id == booking_id:
+                return booking
+        return None
+
+    async def scan_base_price(booking_id):
+        booking = scan_by_id(booking_id)
+        return booking.total_base_price
+
+    async def scan_pending_today(day):
+        return [b for b in bookings if b.status == rp.BookingStatus.PENDING and b.start_time.date() == day]
+
+    async def query_pending_today(day):
+        return rp.BookingManager.find_bookings(status=rp.BookingStatus.PENDING, start_date=day)
+
+    get_base_price = endpoint(rp.get_base_price)
+    find_bookings = endpoint(rp.find_bookings)
+    day = today.date()
+    pending_today = len(rp.BookingManager.find_bookings(status=rp.BookingStatus.PENDING, start_date=day))
+    member_id = members[0].get_id
+
+    print(f"{'request':>30} {'count':>8} {'p50 us':>10} {'p99 us':>10}")
+    latency_row("get_base_price (index)", asyncio.run(measure(get_base_price, [(b,) for b in booking_ids])))
+    latency_row("get_base_price (list scan)",
+                asyncio.run(measure(scan_base_price, [(b,) for b in booking_ids[:scan_requests]])))
+    latency_row("pending today (index)", asyncio.run(measure(query_pending_today, [(day,)] * 200)),
+                f"{pending_today:,} rows")
+    latency_row("pending today (endpoint)",
+                asyncio.run(measure(find_bookings, [("Pending", None, day)] * 200)), f"{pending_today:,} rows")
+    latency_row("pending today (list scan)",
+                asyncio.run(measure(scan_pending_today, [(day,)] * 20)), f"{pending_today:,} rows")
+    latency_row("bookings of one member (index)",
+                asyncio.run(measure(find_bookings, [(None, member_id, None)] * 2_000)),
+                f"{len(rp.BookingManager.get_bookings_by_member(member_id)):,} rows")
+
+
+def bench_coupons(n_coupons=100_000, coupons_per_member=20, redeems=100_000, campaign_members=1_000_000):
+    """หา coupon ด้วย code, ตรวจ+ใช้คูปองของ member และแจกคูปอง campaign ให้ member จำนวนมาก"""
+    print_header(f"Coupons: {n_coupons:,} codes, {coupons_per_member} per member, "
+                 f"campaign to {campaign_members:,} members")
+    rng = random.Random(22)
+    rp.CouponRegistry.clear()
+    coupons = [rp.PercentCoupon(f"C{i:06d}", f"CODE{i:06d}", 0, 10.0) for i in range(n_coupons)]
+    for coupon in coupons:
+        rp.CouponRegistry.add(coupon)
+    codes = [rng.choice(coupons).code for _ in range(redeems)]
+    clock = time.perf_counter_ns
+
+    def scan_coupon(code):
+        for coupon in coupons:
+            if code == coupon.code:
+                return coupon
+        return None
+
+    def scan_redeem(pairs, code):
+        """validate_coupon + mark_coupon_used แบบ list ของ [code, status] เดิม"""
+        if not any(item[0] == code and item[1] == rp.CouponStatus.AVALIBLE for item in pairs):
+            return False
+        for item in pairs:
+            if item[0] == code and item[1] == rp.CouponStatus.AVALIBLE:
+                item[1] = rp.CouponStatus.USED
+                return True
+        return False
+
+    def run(fn, args_list):
+        latencies = []
+        for args in args_list:
+            start = clock()
+            fn(*args)
+            latencies.append(clock() - start)
+        return latencies
+
+    print(f"{'operation':>30} {'count':>8} {'p50 us':>10} {'p99 us':>10}")
+    latency_row("get_coupon_by_code (registry)", run(rp.Restaurant.get_coupon_by_code, [(c,) for c in codes]))
+    latency_row("get_coupon_by_code (list scan)", run(scan_coupon, [(c,) for c in codes[:500]]))
+
+    members, pairs, redeem_args = [], [], []
+    for i in range(redeems // coupons_per_member):
+        member = rp.Member(f"M{i:07d}", f"Member {i}", rp.MemberTier.BRONZE)
+        own = [coupons[rng.randrange(n_coupons)].code for _ in range(coupons_per_member)]
+        for code in own:
+            member.add_coupon(code)
+        members.append(member)
+        pairs.append([[code, rp.CouponStatus.AVALIBLE] for code in own])
+        redeem_args.extend((i, code) for code in own)
+    rng.shuffle(redeem_args)
+    latency_row("validate + use (member sets)", run(lambda i, code: members[i].use_coupon(code), redeem_args))
+    latency_row("validate + use (pair list)", run(lambda i, code: scan_redeem(pairs[i], code), redeem_args))
+
+    tracemalloc.start()
+    campaign = [rp.Member(f"M{i:07d}", f"Member {i}", rp.MemberTier.BRONZE) for i in range(campaign_members)]
+    member_bytes = tracemalloc.get_traced_memory()[0]
+    issued, elapsed = timed(rp.CouponRegistry.issue, coupons[0].code, campaign)
+    issue_bytes = tracemalloc.get_traced_memory()[0] - member_bytes
+    tracemalloc.stop()
+    again, _ = timed(rp.CouponRegistry.issue, coupons[0].code, campaign)
+    print(f"campaign issue: {issued:,} members in {elapsed:.2f}s ({issued / elapsed:,.0f}/s), "
+          f"+{issue_bytes / max(issued, 1):.0f} B/member (Member itself {member_bytes / campaign_members:.0f} B "
+          f"incl. empty coupon sets), re-issue added {again:,}")
+
+def bench_slow_gateway(requests=2_000, latency=0.05, jitter=0.05, max_concurrency=200, blocking_requests=40):
+    """pay_event ต่อเนื่องเมื่อ gateway ช้า: pay_async (ไม่ block loop) vs เรียก gateway แบบ blocking"""
+    print_header(f"pay_event with a slow gateway: {latency * 1e3:.0f}-{(latency + jitter) * 1e3:.0f} ms, "
+                 f"{requests:,} concurrent requests")
+    load_bookings(requests, n_members=requests, in_use=0)
+    pay_event = endpoint(rp.pay_event)
+    strategies = (rp.QRCode, rp.CreditCard, rp.Cash)
+    saved = [(cls.gateway, cls.timeout, cls.max_concurrency, cls.retries, cls.backoff) for cls in strategies]
+    clock = time.perf_counter_ns
+
+    async def one(booking_id, strategy, latencies, outcomes):
+        start = clock()
+        try:
+            await pay_event(booking_id, strategy, None, None)
+            outcomes['paid'] += 1
+        except rp.HTTPException as e:
+            outcomes[e.status_code] = outcomes.get(e.status_code, 0) + 1
+        latencies.append(clock() - start)
+
+    async def drive(booking_ids):
+        latencies, outcomes = [], {'paid': 0}
+        await asyncio.gather(*(one(b, strategies[i % 3].get_name(), latencies, outcomes)
+                               for i, b in enumerate(booking_ids)))
+        return latencies, outcomes
+
+    def blocking_gateway(rate):
+        def pay(amount):
+            time.sleep(latency + random.random() * jitter)
+            return (True, f"REC-{random.getrandbits(32):08X}") if random.random() < rate else (False, "Payment Declined")
+        return pay
+
+    async def blocking_pay_async(cls, amount, reference=None):
+        return cls.pay(amount)
+
+    print(f"{'mode':>28} {'requests':>9} {'seconds':>8} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}  outcomes")
+    bookings = [b.id for b in rp.BookingManager._booking_list]
+    with temp_transaction_log():
+        try:
+            for cls in strategies:
+                cls.configure(gateway=rp.StubGateway(success_rate=0.95, latency=latency, jitter=jitter),
+                              timeout=1.0, max_concurrency=max_concurrency, retries=2, backoff=0.05)
+            with quiet():
+                (latencies, outcomes), elapsed = timed(asyncio.run, drive(bookings))
+            print_run("pay_async", latencies, elapsed, outcomes)
+
+            load_bookings(requests, n_members=requests, in_use=0)
+            for cls in strategies:
+                cls.configure(gateway=rp.StubGateway(success_rate=0.95, latency=latency, jitter=jitter, error_rate=0.1),
+                              timeout=(latency + jitter) * 0.9)
+            with quiet():
+                (latencies, outcomes), elapsed = timed(asyncio.run, drive(bookings))
+            print_run("pay_async, flaky + timeouts", latencies, elapsed, outcomes)
+
+            load_bookings(blocking_requests, n_members=blocking_requests, in_use=0)
+            originals = {cls: cls.__dict__['pay'] for cls in strategies}
+            for cls in strategies:
+                cls.pay = staticmethod(blocking_gateway(0.95))
+                cls.pay_async = classmethod(blocking_pay_async)
+            try:
+                with quiet():
+                    (latencies, outcomes), elapsed = timed(
+                        asyncio.run, drive([b.id for b in rp.BookingManager._booking_list]))
+            finally:
+                for cls in strategies:
+                    cls.pay = originals[cls]
+                    del cls.pay_async
+            print_run("blocking pay (old inline)", latencies, elapsed, outcomes)
+        finally:
+            for cls, (gateway, timeout, limit, retries, backoff) in zip(strategies, saved):
+                cls.configure(gateway=gateway, timeout=timeout, max_concurrency=limit, retries=retries, backoff=backoff)
+
+
+def print_run(name, latencies_ns, elapsed, outcomes):
+    values = sorted(latencies_ns)
+    print(f"{name:>28} {len(values):>9,} {elapsed:>8.2f} {len(values) / elapsed:>9,.0f} "
+          f"{percentile(values, 50) / 1e6:>8.1f} {percentile(values, 99) / 1e6:>8.1f}  "
+          + ", ".join(f"{key}={count}" for key, count in outcomes.items()))
+
+
+def bench_idempotency(bookings=1_000, retries=5, latency=0.02, jitter=0.03):
+    """client retry ซ้อนกันด้วย Idempotency-Key เดียวกัน: ต้องตัดเงินครั้งเดียวต่อ key และได้ response เดียวกัน"""
+    print_header(f"Idempotent pay_event: {bookings:,} keys x {retries} concurrent retries, "
+                 f"gateway {latency * 1e3:.0f}-{(latency + jitter) * 1e3:.0f} ms")
+    load_bookings(bookings, n_members=bookings, in_use=0)
+    pay_event = endpoint(rp.pay_event)
+    strategies = (rp.QRCode, rp.CreditCard, rp.Cash)
+    saved = [(cls.gateway, cls.timeout, cls.retries) for cls in strategies]
+    gateway = rp.StubGateway(success_rate=0.9, latency=latency, jitter=jitter, error_rate=0.05)
+    for cls in strategies:
+        cls.configure(gateway=gateway, timeout=1.0, retries=2)
+    rp.payment_idempotency = rp.IdempotencyStore()
+    clock = time.perf_counter_ns
+
+    async def attempt(booking_id, key, strategy, latencies, responses):
+        start = clock()
+        try:
+            response = await pay_event(booking_id, strategy, None, key)
+            responses[key].append(response["receipt_no"])
+        except rp.HTTPException as e:
+            responses[key].append(e.status_code)
+        latencies.append(clock() - start)
+
+    async def drive():
+        latencies, responses, other = [], {}, {}
+        tasks = []
+        for i, booking in enumerate(rp.BookingManager._booking_list):
+            key = f"KEY-{i:06d}"
+            responses[key] = []
+            strategy = strategies[i % 3].get_name()
+            tasks.extend(attempt(booking.id, key, strategy, latencies, responses) for _ in range(retries))
+            other_key = f"OTHER-{i:06d}"  # client อื่น/ปุ่มกดซ้ำ: key ต่างแต่ booking เดียวกัน
+            other[other_key] = []
+            tasks.append(attempt(booking.id, other_key, strategy, latencies, other))
+        random.shuffle(tasks)
+        await asyncio.gather(*tasks)
+        return latencies, responses, other
+
+    try:
+        with quiet(), temp_transaction_log(tail_size=None) as log:
+            (latencies, responses, other), elapsed = timed(asyncio.run, drive())
+            replay, replay_elapsed = timed(asyncio.run, drive())
+            transactions = log.recent()
+    finally:
+        for cls, (old_gateway, timeout, retry_count) in zip(strategies, saved):
+            cls.configure(gateway=old_gateway, timeout=timeout, retries=retry_count)
+
+    paid = {}
+    for record in transactions:
+        if record["status"] == rp.Status.SUCCESS.value:
+            paid[record["target"]] = paid.get(record["target"], 0) + 1
+    consistent = sum(1 for values in responses.values() if len(set(values)) == 1)
+    cached = [key for key, values in responses.items() if values[0] not in rp.IdempotencyStore.TRANSIENT_STATUS]
+    replay_same = sum(1 for key in cached if set(replay[1][key]) == set(responses[key]))
+    double_paid = sum(1 for count in paid.values() if count > 1)
+    assert consistent == len(responses) and double_paid == 0 and replay_same == len(cached)
+    print(f"requests {len(latencies):,} in {elapsed:.2f}s; gateway charges {gateway.charges:,} "
+          f"for {len(responses) + len(other):,} keys; bookings paid {len(paid):,}, paid twice {double_paid}")
+    print(f"retries with the same response: {consistent:,}/{len(responses):,} keys; "
+          f"replayed from the store unchanged: {replay_same:,}/{len(cached):,} (409 conflicts are not cached)")
+    print(f"other keys on a booking being paid: "
+          + ", ".join(f"{code}={sum(1 for v in other.values() if v[0] == code)}" for code in sorted(
+              {v[0] for v in other.values() if isinstance(v[0], int)}))
+          + f", paid={sum(1 for v in other.values() if isinstance(v[0], str))}")
+    print(f"{'request':>30} {'count':>8} {'p50 us':>10} {'p99 us':>10}")
+    latency_row("first run (with retries)", latencies)
+    latency_row("replay from store", replay[0], f"{len(replay[0]) / replay_elapsed:,.0f} req/s")
+
+
+def bench_transaction_log(records=20_000, per_record_fsync=2_000, segment_bytes=1024 * 1024):
+    """Restaurant.add_log ต่อเนื่องลง transaction log: fsync ทีละ record vs group commit, แล้วเปิด log ใหม่"""
+    print_header(f"Transaction log: sustained Restaurant.add_log, {segment_bytes // 1024:,} KiB segments")
+    transactions = []
+    for i in range(records):
+        transaction = rp.Transaction(f"B{i:06d}", 100.0 + i % 500, "qrcode", "PENDING", f"REC-{i:08X}",
+                                     order_type=rp.OrderType.EVENT)
+        transaction.mark_success()
+        transactions.append(transaction)
+    clock = time.perf_counter_ns
+
+    async def writer(queue, latencies):
+        while queue:
+            transaction = queue.pop()
+            start = clock()
+            await rp.Restaurant.add_log(transaction)
+            latencies.append(clock() - start)
+
+    async def drive(count, writers):
+        queue, latencies = transactions[:count], []
+        await asyncio.gather(*(writer(queue, latencies) for _ in range(writers)))
+        return latencies
+
+    print(f"{'mode':>28} {'writers':>8} {'records':>8} {'rec/s':>9} {'rec/fsync':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'B/rec':>6} {'segments':>9}")
+    runs = [("fsync per record", per_record_fsync, 64, dict(max_batch=1)),
+            ("group commit", per_record_fsync, 1, {}),
+            ("group commit", records, 64, {}),
+            ("group commit", records, 512, {}),
+            ("flush only (not durable)", records, 512, dict(fsync=False))]
+    for name, count, writers, options in runs:
+        with temp_transaction_log(segment_bytes=segment_bytes, **options) as log:
+            latencies, elapsed = timed(asyncio.run, drive(count, writers))
+            values = sorted(latencies)
+            print(f"{name:>28} {writers:>8} {log.records:>8,} {log.records / elapsed:>9,.0f} "
+                  f"{log.records / log.commits:>10.1f} {percentile(values, 50) / 1e6:>8.2f} "
+                  f"{percentile(values, 99) / 1e6:>8.2f} {log.bytes_written / log.records:>6.0f} "
+                  f"{len(log.segments):>9}")
+
+    with temp_transaction_log(segment_bytes=segment_bytes) as log:
+        asyncio.run(drive(records, 512))
+        log.close()
+        with open(log.segments[-1], "ab") as f:
+            f.write(b'{"id":"TXN-TORN","ts":')  # crash กลาง write
+        reopened = rp.TransactionLog(log.directory)
+        tail, elapsed = timed(reopened.recent)
+        intact = tail[-1]["id"] != "TXN-TORN" and len(tail) == min(records, 10_000)
+        reopened.close()
+        assert intact
+        print(f"reopen {len(log.segments)} segments with a torn last line: tail of {len(tail):,} records "
+              f"loaded in {elapsed * 1e3:.1f} ms, torn line dropped")
+
+
+BENCHMARKS = {
+    'booking_lookup': bench_booking_lookup,
+    'coupons': bench_coupons,
+    'slow_gateway': bench_slow_gateway,
+    'idempotency': bench_idempotency,
+    'transaction_log': bench_transaction_log,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+        BENCHMARKS[name]()
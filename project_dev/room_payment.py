@@ -1,10 +1,18 @@
 from __future__ import annotations
-from typing import Optional, List, Tuple
-from fastapi import FastAPI, HTTPException, Query
+from typing import Optional, List, Tuple, Dict, Set, Iterable, Any, Awaitable, Callable
+from fastapi import FastAPI, Header, HTTPException, Query
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
 from enum import Enum
 from fastmcp import FastMCP
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
 import uuid
 import random
 
@@ -100,6 +108,43 @@ class PercentCoupon(Coupon):
             return base_price * (self._percent / 100)
         return 0.0
 
+class CouponRegistry:
+    """คูปองทั้งหมดของร้าน keyed ด้วย code และการแจกคูปองให้ member
+
+    ต่อ member เก็บเป็น set ของ code ที่ใช้ได้ / ใช้แล้ว (Member.use_coupon)
+    ดังนั้นหา coupon, ตรวจ และใช้คูปองเป็น O(1) ทั้งหมด
+    """
+    _coupons: Dict[str, Coupon] = {}
+
+    @classmethod
+    def add(cls, coupon: Coupon):
+        if coupon.code in cls._coupons:
+            raise ValueError(f"Coupon {coupon.code} already exists")
+        cls._coupons[coupon.code] = coupon
+
+    @classmethod
+    def get(cls, code: str) -> Optional[Coupon]:
+        return cls._coupons.get(code)
+
+    @classmethod
+    def clear(cls):
+        cls._coupons.clear()
+
+    @classmethod
+    def issue(cls, code: str, members: Iterable[Member]) -> int:
+        """แจกคูปองให้ member จำนวนมาก (เช่น campaign) - ข้ามคนที่มีอยู่แล้วหรือเคยใช้แล้ว
+        members เป็น generator ได้; คืนจำนวนที่แจกจริง"""
+        if code not in cls._coupons:
+            raise ValueError(f"Unknown coupon {code}")
+        issued = 0
+        for member in members:
+            available = member._available_coupons
+            if code in available or code in member._used_coupons:
+                continue
+            available.add(code)
+            issued += 1
+        return issued
+
 class User:
     def __init__(self, id: str, name: str, phone: str = ""):
         self._id = id
@@ -126,7 +171,8 @@ class Customer(User):
 class Member(Customer):
     def __init__(self, id: str, name: str, tier: MemberTier):
         super().__init__(id, name)
-        self._coupon_list: List[List[str | CouponStatus]] = [] 
+        self._available_coupons: Set[str] = set()
+        self._used_coupons: Set[str] = set()
         self._receipt_list: List[Receipt] = []
         self._tier = tier
 
@@ -134,21 +180,36 @@ class Member(Customer):
         self._receipt_list.append(receipt)
 
     def add_coupon(self, code: str):
-        self._coupon_list.append([code, CouponStatus.AVALIBLE])
+        self._available_coupons.add(code)
 
     def validate_coupon(self, code: str) -> bool:
-        for item in self._coupon_list:
-            if item[0] == code and item[1] == CouponStatus.AVALIBLE:
-                return True
-        return False
-    
+        return code in self._available_coupons
+
+    def use_coupon(self, code: str) -> bool:
+        """ตรวจและใช้คูปองในขั้นเดียว (set.remove เป็น atomic) - False ถ้าไม่มีหรือใช้ไปแล้ว"""
+        try:
+            self._available_coupons.remove(code)
+        except KeyError:
+            return False
+        self._used_coupons.add(code)
+        return True
+
+    def return_coupon(self, code: str):
+        """คืนคูปองที่ use_coupon ไปแล้วแต่จ่ายเงินไม่สำเร็จ"""
+        if code in self._used_coupons:
+            self._used_coupons.discard(code)
+            self._available_coupons.add(code)
+
     def mark_coupon_used(self, code: str) -> bool:
-        for item in self._coupon_list:
-            if item[0] == code and item[1] == CouponStatus.AVALIBLE:
-                item[1] = CouponStatus.USED
-                return True
-        return False
-    
+        return self.use_coupon(code)
+
+    def get_coupon_status(self, code: str) -> Optional[CouponStatus]:
+        if code in self._available_coupons:
+            return CouponStatus.AVALIBLE
+        if code in self._used_coupons:
+            return CouponStatus.USED
+        return None
+
     @property
     def name(self): return self._name
 
@@ -253,11 +314,15 @@ class Booking:
     @property
     def id(self): return self._booking_id
     @property
+    def start_time(self) -> datetime: return self._start_time
+    @property
     def member(self): return self._member
     @property
     def status(self) -> BookingStatus: return self._status
     @status.setter
-    def status(self, val: BookingStatus): self._status = val
+    def status(self, val: BookingStatus):
+        old, self._status = self._status, val
+        BookingManager._status_changed(self, old)
     @property
     def event_order(self): return self._event_order
 
@@ -277,6 +342,11 @@ class Transaction:
     def mark_success(self): self._status = Status.SUCCESS
     def mark_failed(self): self._status = Status.FAILED
 
+    def to_record(self) -> dict:
+      return {"id": self._id, "ts": self._timestamp.isoformat(), "target": self._target_id, "amount": self._amount,
+              "strategy": self._strategy, "status": getattr(self._status, "value", self._status),
+              "payment_id": self._payment_id, "coupon": self._coupon_code, "type": self._order_type.value, "staff": self._staff_id}
+
     @property
     def id(self): return self._id
     @property
@@ -297,16 +367,18 @@ class Transaction:
     def staff_id(self): return self._staff_id
 
 class Restaurant:
-    transaction_list: List[Transaction] = []
-    coupon_list: List[Coupon] = []
     members: List[Member] = []
     rooms: List[Room] = []
     staff_list: List[PartyStaff] = []
     
     @classmethod
-    def add_log(cls, transaction: Transaction):
-      cls.transaction_list.append(transaction)
-      print(f"[SYSTEM LOG] {transaction.timestamp} | {transaction.id} | {transaction.status} | {transaction.amount} THB | Staff: {transaction.staff_id}")
+    async def add_log(cls, transaction: Transaction):
+      """เขียนลง transaction_log แล้วรอจน fsync เสร็จ (รวม batch กับ request อื่นที่เขียนพร้อมกัน)"""
+      await transaction_log.commit(transaction.to_record())
+
+    @classmethod
+    def get_recent_transactions(cls, limit: Optional[int] = 100, target_id: Optional[str] = None) -> List[dict]:
+      return transaction_log.recent(limit, target_id)
 
     @classmethod
     def add_member(cls, member: Member):
@@ -314,30 +386,194 @@ class Restaurant:
 
     @classmethod
     def add_coupon(cls, coupon: Coupon):
-        cls.coupon_list.append(coupon)
+        CouponRegistry.add(coupon)
 
     @classmethod
     def get_coupon_by_code(cls, code: str) -> Optional[Coupon]:
-        for coupon in cls.coupon_list:
-            if code == coupon.code:
-                return coupon
-        return None
+        return CouponRegistry.get(code)
 
 class BookingManager:
+    """Booking ทุกตัวถูก index ด้วย id, member id, status และวันที่เริ่ม (dict ของ dict เรียงตามลำดับที่เพิ่ม)
+    lookup ด้วย id เป็น O(1), query ตามเงื่อนไขใช้เวลาตามขนาดผลลัพธ์ ไม่ต้อง scan ทุก booking
+    status index อัปเดตเองผ่าน Booking.status setter
+    """
     _booking_list: List[Booking] = []
+    _booking_by_id: Dict[str, Booking] = {}
+    _bookings_by_member: Dict[str, Dict[str, Booking]] = {}
+    _bookings_by_status: Dict[BookingStatus, Dict[str, Booking]] = {}
+    _paying: Set[str] = set()
+    _bookings_by_date: Dict[date, Dict[str, Booking]] = {}
 
     @classmethod
     def add_booking(cls, booking: Booking):
+        if booking.id in cls._booking_by_id:
+            raise ValueError(f"Booking {booking.id} already exists")
         cls._booking_list.append(booking)
+        cls._booking_by_id[booking.id] = booking
+        cls._bookings_by_member.setdefault(booking.member.get_id, {})[booking.id] = booking
+        cls._bookings_by_status.setdefault(booking.status, {})[booking.id] = booking
+        cls._bookings_by_date.setdefault(booking.start_time.date(), {})[booking.id] = booking
+
+    @classmethod
+    def clear(cls):
+        cls._booking_list.clear()
+        cls._booking_by_id.clear()
+        cls._bookings_by_member.clear()
+        cls._bookings_by_status.clear()
+        cls._paying.clear()
+        cls._bookings_by_date.clear()
+
+    @classmethod
+    def start_payment(cls, booking_id: str) -> bool:
+        """จองสิทธิ์จ่ายเงินของ booking - False ถ้ามี request อื่นกำลังจ่ายอยู่"""
+        if booking_id in cls._paying:
+            return False
+        cls._paying.add(booking_id)
+        return True
+
+    @classmethod
+    def finish_payment(cls, booking_id: str):
+        cls._paying.discard(booking_id)
+
+    @classmethod
+    def _status_changed(cls, booking: Booking, old: BookingStatus):
+        if cls._booking_by_id.get(booking.id) is not booking or old == booking.status:
+            return
+        cls._bookings_by_status.get(old, {}).pop(booking.id, None)
+        cls._bookings_by_status.setdefault(booking.status, {})[booking.id] = booking
 
     @classmethod
     def get_booking_from_id(cls, booking_id: str) -> Optional[Booking]:
-      for booking in cls._booking_list:
-        if booking.id == booking_id:
-          return booking
-      return None
-    
+        return cls._booking_by_id.get(booking_id)
+
+    @classmethod
+    def get_bookings_by_member(cls, member_id: str) -> List[Booking]:
+        return list(cls._bookings_by_member.get(member_id, {}).values())
+
+    @classmethod
+    def get_bookings_by_status(cls, status: BookingStatus) -> List[Booking]:
+        return list(cls._bookings_by_status.get(status, {}).values())
+
+    @classmethod
+    def get_bookings_by_date(cls, start_date: date) -> List[Booking]:
+        return list(cls._bookings_by_date.get(start_date, {}).values())
+
+    @classmethod
+    def find_bookings(cls, member_id: Optional[str] = None, status: Optional[BookingStatus] = None, start_date: Optional[date] = None) -> List[Booking]:
+        """Booking ที่ตรงทุกเงื่อนไขที่ระบุ: member_id, status, start_date (วันที่เริ่มใช้ห้อง)
+        ไล่จาก index ที่เล็กที่สุดแล้วเช็คที่เหลือด้วย dict lookup"""
+        conditions = ((member_id, cls._bookings_by_member), (status, cls._bookings_by_status),
+                      (start_date, cls._bookings_by_date))
+        indexes = sorted((index.get(key, {}) for key, index in conditions if key is not None), key=len)
+        if not indexes:
+            return list(cls._booking_list)
+        found = indexes[0]
+        for index in indexes[1:]:
+            found = {booking_id: booking for booking_id, booking in found.items() if booking_id in index}
+        return list(found.values())
+
+class PaymentGatewayError(Exception):
+    """gateway ตอบไม่ได้ชั่วคราว (network / 5xx) - retry ได้ ต่างจากการถูกปฏิเสธ"""
+
+class StubGateway:
+    """gateway จำลองในเครื่อง: หน่วง latency (+ สุ่ม jitter) วินาทีต่อครั้ง แล้วอนุมัติตาม success_rate
+    error_rate = โอกาส PaymentGatewayError; reference เดิมที่เคยตอบแล้วได้ผลเดิม (retry ไม่ตัดเงินซ้ำ)
+    จำผลไว้ result_ttl วินาที และไม่เกิน max_results reference (เก่าสุดออกก่อน) เหมือน IdempotencyStore"""
+    def __init__(self, success_rate: float = 1.0, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 max_results: int = 100_000, result_ttl: float = 24 * 3600):
+        self.success_rate = success_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.charges = 0
+        self._max_results = max_results
+        self._result_ttl = result_ttl
+        self._results: OrderedDict[str, Tuple[float, Tuple[bool, str]]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def _evict(self, now: float):
+        results = self._results
+        while results and (len(results) > self._max_results or next(iter(results.values()))[0] <= now):
+            results.popitem(last=False)  # ttl เท่ากันทุกตัว -> ลำดับที่ใส่ = ลำดับหมดอายุ
+
+    async def charge(self, amount: float, reference: str) -> Tuple[bool, str]:
+        delay = self.latency + random.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = time.monotonic()
+        self._evict(now)
+        if reference in self._results:
+            return self._results[reference][1]
+        if random.random() < self.error_rate:
+            raise PaymentGatewayError("Gateway Unavailable")
+        self.charges += 1
+        if random.random() < self.success_rate:
+            result = True, f"REC-{uuid.uuid4().hex[:8].upper()}"
+        else:
+            result = False, "Payment Declined"
+        self._results[reference] = (now + self._result_ttl, result)
+        self._evict(now)
+        return result
+
 class PaymentStrategy(ABC):
+    """ช่องทางจ่ายเงิน: pay() แบบเดิม (sync) และ pay_async() ที่ไม่ block event loop
+
+    pay_async เรียก gateway ของ strategy นั้นโดย
+    - รอไม่เกิน timeout วินาทีต่อครั้ง
+    - เรียกพร้อมกันไม่เกิน max_concurrency ครั้ง (ที่เหลือรอคิว)
+    - timeout / PaymentGatewayError retry อีก retries ครั้ง หน่วง backoff * 2^ครั้ง (ถูกปฏิเสธไม่ retry)
+    ปรับค่าต่อ strategy ด้วย configure()
+    ถ้า timeout ทุกครั้งจะได้ (False, TIMEOUT_MESSAGE) - ไม่รู้ว่าตัดเงินไปหรือยัง ใช้ failure_status() แปลงเป็น 504
+    """
+    TIMEOUT_MESSAGE = "Payment Timeout"
+    gateway: StubGateway = StubGateway()
+    timeout: float = 5.0
+    max_concurrency: int = 100
+    retries: int = 2
+    backoff: float = 0.1
+
+    @classmethod
+    def configure(cls, gateway: Optional[StubGateway] = None, timeout: Optional[float] = None, max_concurrency: Optional[int] = None, retries: Optional[int] = None, backoff: Optional[float] = None):
+        if gateway is not None: cls.gateway = gateway
+        if timeout is not None: cls.timeout = timeout
+        if max_concurrency is not None: cls.max_concurrency = max_concurrency
+        if retries is not None: cls.retries = retries
+        if backoff is not None: cls.backoff = backoff
+        cls._limiter = None
+
+    @classmethod
+    def _get_limiter(cls) -> asyncio.Semaphore:
+        # Semaphore ผูกกับ event loop - สร้างใหม่ต่อ strategy ต่อ loop
+        loop = asyncio.get_running_loop()
+        limiter = cls.__dict__.get("_limiter")
+        if limiter is None or limiter[0] is not loop:
+            limiter = (loop, asyncio.Semaphore(cls.max_concurrency))
+            cls._limiter = limiter
+        return limiter[1]
+
+    @classmethod
+    async def pay_async(cls, amount: float, reference: Optional[str] = None) -> Tuple[bool, str]:
+        reference = reference or f"PAY-{uuid.uuid4().hex[:12].upper()}"
+        limiter = cls._get_limiter()
+        for attempt in range(cls.retries + 1):
+            if attempt:
+                await asyncio.sleep(cls.backoff * 2 ** (attempt - 1))
+            try:
+                async with limiter:
+                    return await asyncio.wait_for(cls.gateway.charge(amount, reference), cls.timeout)
+            except asyncio.TimeoutError:
+                message = cls.TIMEOUT_MESSAGE
+            except PaymentGatewayError as e:
+                message = str(e)
+        return False, message
+
+    @classmethod
+    def failure_status(cls, message: str) -> int:
+        """timeout = 504 (IdempotencyStore ไม่ cache, retry ด้วย key เดิมได้), ที่เหลือ = 402"""
+        return 504 if message == cls.TIMEOUT_MESSAGE else 402
+
     @classmethod
     def get_strategy(cls, name: str):
       for strategy_cls in PaymentStrategy.__subclasses__():
@@ -358,6 +594,7 @@ class PaymentStrategy(ABC):
       pass
 
 class QRCode(PaymentStrategy):
+    gateway = StubGateway(success_rate=0.90)
     @staticmethod
     def get_name() -> str: return "QRCode"
     @staticmethod
@@ -367,6 +604,7 @@ class QRCode(PaymentStrategy):
       return False, "Payment Declined"
 
 class CreditCard(PaymentStrategy):
+    gateway = StubGateway(success_rate=0.80)
     @staticmethod
     def get_name() -> str: return "CreditCard"
     @staticmethod
@@ -376,6 +614,7 @@ class CreditCard(PaymentStrategy):
       return False, "Payment Declined"
 
 class Cash(PaymentStrategy):
+    gateway = StubGateway(success_rate=0.99)
     @staticmethod
     def get_name() -> str: return "Cash"
     @staticmethod
@@ -384,6 +623,211 @@ class Cash(PaymentStrategy):
       if success : return True, f"REC-{uuid.uuid4().hex[:8].upper()}"
       return False, "Payment Declined"
 
+class TransactionLog:
+    """append-only log ของ Transaction เป็นไฟล์ JSONL (1 บรรทัด = 1 record) พร้อม group commit
+
+    - append ใส่ record เข้าคิว แล้ว thread writer เขียนทุก record ที่รออยู่ในครั้งเดียว + fsync ครั้งเดียว
+      ระหว่าง fsync รอบก่อน record ใหม่จะสะสมเป็น batch ถัดไปเอง (ไม่ต้องหน่วงเวลา)
+    - Future ที่ append คืนมาจะเสร็จหลัง fsync แล้วเท่านั้น -> await commit() ก่อนตอบ client = durable
+    - ไฟล์ละไม่เกิน segment_bytes แล้วขึ้น segment ใหม่ (transactions-00000001.jsonl, ...)
+      max_segments=None เก็บทุก segment, ถ้าระบุจะลบ segment เก่าสุดทิ้ง
+    - tail_size record ล่าสุดอยู่ใน memory สำหรับ recent() (None = ทั้งหมด); เปิดใหม่จะอ่าน tail กลับจากไฟล์
+    - บรรทัดท้ายที่เขียนไม่ครบ (crash กลาง write) ถูกตัดทิ้งตอนเปิด
+      ถ้า write/fsync error ระหว่างทำงานจะตัดไฟล์กลับไปที่ offset ก่อน batch นั้น; ตัดไม่ได้ -> append ต่อไป error จนเปิดใหม่
+    - caller ที่ถูก cancel ระหว่างรอ record ยังถูกเขียน แค่ไม่มีใครรอผล; writer ล้มด้วย error อื่น -> ทุก Future ที่ค้างได้ error นั้น
+    - เปิดไฟล์/สร้าง thread ตอนใช้ครั้งแรก และ 1 directory ใช้ได้ทีละ process
+    """
+    SEGMENT_PREFIX = "transactions-"
+    SEGMENT_SUFFIX = ".jsonl"
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, tail_size: Optional[int] = 10_000,
+                 max_batch: int = 4096, fsync: bool = True, max_segments: Optional[int] = None):
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_batch = max_batch
+        self._fsync = fsync
+        self._max_segments = max_segments
+        self._tail: deque = deque(maxlen=tail_size)
+        self._pending: List[Tuple[bytes, dict, Future]] = []
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+        self._file = None
+        self._segments: List[str] = []
+        self._closed = False
+        self._broken: Optional[BaseException] = None
+        self.records = 0
+        self.commits = 0
+        self.bytes_written = 0
+
+    @property
+    def directory(self): return self._directory
+    @property
+    def segments(self) -> List[str]: return list(self._segments)
+
+    def append(self, record: dict) -> Future:
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Transaction log is closed")
+            if self._broken is not None:
+                raise self._broken
+            if self._writer is None:
+                self._open()
+            self._pending.append((line, record, future))
+            self._cond.notify()
+        return future
+
+    async def commit(self, record: dict):
+        await asyncio.wrap_future(self.append(record))
+
+    def recent(self, limit: Optional[int] = None, target_id: Optional[str] = None) -> List[dict]:
+        with self._cond:
+            if self._writer is None and not self._closed:
+                self._open()
+            records = list(self._tail)
+        if target_id is not None:
+            records = [record for record in records if record["target"] == target_id]
+        return records[-limit:] if limit else records
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+            writer = self._writer
+        if writer is not None:
+            writer.join()  # writer เขียนคิวที่ค้างให้หมดก่อนออก
+            self._file.close()
+
+    def _open(self):
+        os.makedirs(self._directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self._directory)
+                       if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX))
+        self._segments = [os.path.join(self._directory, name) for name in names]
+        if self._segments:
+            self._truncate_partial(self._segments[-1])
+            self._load_tail()
+        if self._segments and os.path.getsize(self._segments[-1]) < self._segment_bytes:
+            self._file = open(self._segments[-1], "ab", buffering=0)
+        else:
+            self._new_segment()
+        self._writer = threading.Thread(target=self._run, name="transaction-log", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _truncate_partial(path: str):
+        with open(path, "rb+") as f:
+            end = pos = f.seek(0, os.SEEK_END)
+            while pos > 0:
+                step = min(64 * 1024, pos)
+                pos -= step
+                f.seek(pos)
+                newline = f.read(step).rfind(b"\n")
+                if newline >= 0:
+                    pos += newline + 1
+                    break
+            if pos != end:
+                f.truncate(pos)
+
+    def _load_tail(self):
+        need, chunks = self._tail.maxlen, []
+        for path in reversed(self._segments):
+            if need is not None and need <= 0:
+                break
+            with open(path, "rb") as f:
+                lines = f.read().splitlines()
+            if need is not None:
+                lines = lines[-need:]
+                need -= len(lines)
+            chunks.append(lines)
+        for lines in reversed(chunks):
+            self._tail.extend(json.loads(line) for line in lines)
+
+    def _new_segment(self):
+        last = os.path.basename(self._segments[-1]) if self._segments else None
+        index = int(last[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]) + 1 if last else 1
+        path = os.path.join(self._directory, f"{self.SEGMENT_PREFIX}{index:08d}{self.SEGMENT_SUFFIX}")
+        self._file = open(path, "ab", buffering=0)
+        self._segments.append(path)
+        if self._fsync:  # ให้ชื่อไฟล์ใหม่อยู่รอดหลัง crash ด้วย
+            fd = os.open(self._directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        while self._max_segments and len(self._segments) > self._max_segments:
+            os.remove(self._segments.pop(0))
+
+    def _write(self, data: bytes):
+        if self._file.tell() and self._file.tell() + len(data) > self._segment_bytes:
+            self._file.close()
+            self._new_segment()
+        start = self._file.tell()
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self._file.write(view):]
+            if self._fsync:
+                os.fsync(self._file.fileno())
+        except OSError:
+            try:  # ไม่ให้ batch ที่เขียนไปครึ่งเดียวค้างอยู่กลาง segment
+                self._file.truncate(start)
+            except OSError as e:
+                self._broken = e
+            raise
+        self.bytes_written += len(data)
+
+    @staticmethod
+    def _waiters(batch) -> List[Future]:
+        # RUNNING แล้ว cancel() ไม่ได้อีก -> set_result ข้างล่างไม่ชน InvalidStateError; ที่ cancel ไปแล้วไม่มีใครรอ
+        return [future for _, _, future in batch if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        waiters: List[Future] = []
+        try:
+            while True:
+                with self._cond:
+                    while not self._pending and not self._closed:
+                        self._cond.wait()
+                    if not self._pending:
+                        return
+                    if len(self._pending) <= self._max_batch:
+                        batch, self._pending = self._pending, []
+                    else:
+                        batch = self._pending[:self._max_batch]
+                        del self._pending[:self._max_batch]
+                waiters = self._waiters(batch)
+                try:
+                    self._write(b"".join(line for line, _, _ in batch))
+                except OSError as e:
+                    with self._cond:
+                        if self._broken is not None:
+                            waiters += self._waiters(self._pending)
+                            self._pending = []
+                    for future in waiters:
+                        future.set_exception(e)
+                    waiters = []
+                    continue
+                with self._cond:
+                    self._tail.extend(record for _, record, _ in batch)
+                    self.records += len(batch)
+                    self.commits += 1
+                for future in waiters:
+                    future.set_result(None)
+                waiters = []
+        except BaseException as e:
+            with self._cond:
+                self._broken = e
+                waiters += self._waiters(self._pending)
+                self._pending = []
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
 class Receipt:
   def __init__(self, transaction: Transaction, source_object):
     self._transaction = transaction
@@ -409,6 +853,81 @@ class Receipt:
       "status": "PAID"
     }
 
+class IdempotencyStore:
+    """idempotency key -> ผลของ request แรก สำหรับ endpoint จ่ายเงิน
+
+    - request ที่ key ซ้ำระหว่างที่ request แรกยังทำอยู่ จะรอผลเดียวกัน (ไม่เรียก handler ซ้ำ)
+    - เก็บทั้ง response และ HTTPException (เช่น 402) ไว้ ttl วินาที และไม่เกิน max_size key (เก่าสุดออกก่อน)
+    - TRANSIENT_STATUS (409 ชนกับ request อื่น, 5xx) และ error อื่นไม่ถูกเก็บ - retry ด้วย key เดิมจะทำใหม่ได้
+    - key เดิมแต่ parameter ต่างกัน -> 422
+    """
+    TRANSIENT_STATUS = {409, 429, 500, 502, 503, 504}
+
+    def __init__(self, max_size: int = 100_000, ttl: float = 24 * 3600):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, Any, asyncio.Future]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now: float):
+        entries = self._entries
+        while entries:
+            key, (expires_at, _, future) = next(iter(entries.items()))
+            if expires_at > now and len(entries) <= self._max_size:
+                break
+            if not future.done():
+                entries.move_to_end(key)  # ยังทำอยู่ - ห้ามทิ้ง
+                break
+            entries.popitem(last=False)
+
+    async def run(self, key: str, fingerprint: Any, handler: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            now = time.monotonic()
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                break
+            if entry[1] != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key reused with different request")
+            self.hits += 1
+            future = entry[2]
+            try:
+                ok, value = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    continue  # request แรกล้มโดยไม่มี response - ทำใหม่
+                raise
+            if ok:
+                return value
+            raise value
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now + self._ttl, fingerprint, future)
+        self._entries.move_to_end(key)
+        try:
+            response = await handler()
+        except HTTPException as e:
+            if e.status_code in self.TRANSIENT_STATUS and self._entries.get(key, (None, None, None))[2] is future:
+                del self._entries[key]
+            future.set_result((False, e))
+            raise
+        except BaseException:
+            if self._entries.get(key, (None, None, None))[2] is future:
+                del self._entries[key]
+            future.cancel()
+            raise
+        future.set_result((True, response))
+        return response
+
+payment_idempotency = IdempotencyStore()
+TRANSACTION_LOG_DIR = os.environ.get("TRANSACTION_LOG_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "transaction_log")
+transaction_log = TransactionLog(os.path.join(TRANSACTION_LOG_DIR, "partyroom"))
+
 @mcp.tool
 @app.get("/partyroom-payment/get_base_price/{booking_id}")
 async def get_base_price(booking_id: str):
@@ -427,15 +946,55 @@ async def get_base_price(booking_id: str):
         "deposit_required": booking.required_deposit
     }
 
+@mcp.tool
+@app.get("/partyroom-payment/bookings")
+async def find_bookings(status: Optional[str] = Query(default=None), member_id: Optional[str] = Query(default=None), start_date: Optional[date] = Query(default=None)):
+    """
+    ค้นหา booking สำหรับ staff เช่น booking ที่ยัง Pending ของวันนี้
+    กรองด้วย status (Pending / In Use), member_id และ start_date รูปแบบ YYYY-MM-DD ระบุกี่อย่างก็ได้
+    """
+    try:
+        booking_status = BookingStatus(status) if status else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Unknown Status: {status}")
+
+    bookings = BookingManager.find_bookings(member_id=member_id, status=booking_status, start_date=start_date)
+    return [
+        {
+            "booking_id": booking.id,
+            "member_id": booking.member.get_id,
+            "status": booking.status.value,
+            "start_time": booking.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "total_base_price": booking.total_base_price
+        }
+        for booking in bookings
+    ]
+
 @mcp.tool
 @app.post("/partyroom-payment/pay/{booking_id}")
-async def pay_event(booking_id: str, strategy: str, coupon_code: Optional[str] = Query(default=None)):
+async def pay_event(booking_id: str, strategy: str, coupon_code: Optional[str] = Query(default=None), idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key")):
     """
     จ่ายเงิน พร้อมรองรับ Coupon และสร้าง Transaction Log 
     รับ booking_id รูปแบบ Bxxx
     รับรูปแบบการชำระเงิน มี cash creditcard และ qrcode
     และรับ coupon_code เป็น Optional
+    ส่ง Idempotency-Key มาด้วยได้ - retry ด้วย key เดิมได้ผลเดิมโดยไม่ตัดเงินซ้ำ
     """
+    if idempotency_key is None:
+        return await _pay_booking(booking_id, strategy, coupon_code)
+    fingerprint = ("pay_event", booking_id, strategy.lower(), coupon_code)
+    return await payment_idempotency.run(idempotency_key, fingerprint, lambda: _pay_booking(booking_id, strategy, coupon_code, idempotency_key))
+
+async def _pay_booking(booking_id: str, strategy: str, coupon_code: Optional[str], reference: Optional[str] = None):
+    """จ่ายเงินของ booking ทีละ request ต่อ booking (request ซ้อนได้ 409)"""
+    if not BookingManager.start_payment(booking_id):
+        raise HTTPException(status_code=409, detail="Payment already in progress")
+    try:
+        return await _pay_event(booking_id, strategy, coupon_code, reference)
+    finally:
+        BookingManager.finish_payment(booking_id)
+
+async def _pay_event(booking_id: str, strategy: str, coupon_code: Optional[str], reference: Optional[str]):
     booking = BookingManager.get_booking_from_id(booking_id)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking Not Found")
@@ -455,37 +1014,51 @@ async def pay_event(booking_id: str, strategy: str, coupon_code: Optional[str] =
         raise HTTPException(status_code=400, detail=str(e))
     
     payment_strategy = PaymentStrategy.get_strategy(strategy)
-    success, receipt_or_msg = payment_strategy.pay(final_total)
 
-    transaction = Transaction(booking_id,final_total,strategy.lower(), "PENDING", receipt_or_msg, coupon_code if discount > 0 else None, order_type=OrderType.EVENT)
+    # ใช้คูปองก่อนตัดเงิน (ตรวจ+ใช้ในขั้นเดียว) - request ที่ซ้อนกันใช้คูปองเดียวกันได้แค่ครั้งเดียว
+    member = booking.member
+    use_coupon = bool(coupon_code and discount > 0)
+    if use_coupon and not member.use_coupon(coupon_code):
+        raise HTTPException(status_code=409, detail="Coupon already used")
 
-    if success:
-        booking.status = BookingStatus.IN_USE
-        if booking.event_order:
-            booking.event_order.status = EventOrderStatus.QUEUED
-        
-        member = booking.member
-        if coupon_code and discount > 0:
-          if not member.mark_coupon_used(coupon_code):
-              raise HTTPException(status_code=500, detail="can't mark coupon as used") 
+    # คืนคูปองทุกทางที่ booking ยังไม่เปลี่ยนสถานะ (ถูกปฏิเสธ, log ล้ม, request ถูก cancel, ...)
+    # retry ด้วย key เดิมจึงใช้คูปองได้อีก และ gateway คืนผลเดิมของ reference นั้นโดยไม่ตัดเงินซ้ำ
+    committed = False
+    try:
+        success, receipt_or_msg = await payment_strategy.pay_async(final_total, reference)
 
-        transaction.mark_success()
-        Restaurant.add_log(transaction)
+        transaction = Transaction(booking_id,final_total,strategy.lower(), "PENDING", receipt_or_msg, coupon_code if discount > 0 else None, order_type=OrderType.EVENT)
 
-        receipt = Receipt(transaction, booking)
-        member.add_receipt(receipt)
-        return receipt.generate()
-    
-    else:
-        transaction.mark_failed()
-        Restaurant.add_log(transaction)
+        if success:
+            transaction.mark_success()
+            try:
+                await Restaurant.add_log(transaction)
+            except OSError as e:
+                raise HTTPException(status_code=503, detail=f"Transaction Log Unavailable: {e}")
+
+            booking.status = BookingStatus.IN_USE
+            if booking.event_order:
+                booking.event_order.status = EventOrderStatus.QUEUED
+            committed = True
 
-        raise HTTPException(status_code=402, detail=f"Payment Failed: {receipt_or_msg}")
+            receipt = Receipt(transaction, booking)
+            member.add_receipt(receipt)
+            return receipt.generate()
+
+        else:
+            transaction.mark_failed()
+            await Restaurant.add_log(transaction)
+
+            raise HTTPException(status_code=PaymentStrategy.failure_status(receipt_or_msg), detail=f"Payment Failed: {receipt_or_msg}")
+    except BaseException:
+        if use_coupon and not committed:
+            member.return_coupon(coupon_code)
+        raise
     
 
 ## mock data ##
 
-BookingManager._booking_list.clear()
+BookingManager.clear()
 
 Restaurant.rooms = [
     Room("R01", RoomType.VIP),
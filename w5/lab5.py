@@ -13,8 +13,408 @@
 #
 ##################################################################################
 
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import secrets
+import struct
+import sys
+import threading
+import time
+import zlib
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import groupby, islice
+from datetime import date, datetime, timedelta
+from operator import itemgetter
+from types import MappingProxyType
+
+
+# ============================================================================
+# CLOCKS - วันปัจจุบันเป็นเลขวัน (date.toordinal()) สำหรับ daily limit
+# ============================================================================
+
+class SystemClock:
+    """วันปัจจุบันตามเวลาเครื่อง (local date เหมือน datetime.now().date())
+
+    เก็บเลขวันของวันนี้และเวลาที่ขึ้นวันใหม่ไว้ ทำให้ today() เป็นแค่
+    time.time() + เปรียบเทียบ float; คำนวณ datetime ใหม่แค่วันละครั้ง
+    """
+
+    def __init__(self):
+        self.__day = 0
+        self.__next_day_at = 0.0
+
+    def today(self):
+        if time.time() >= self.__next_day_at:
+            self.__roll()
+        return self.__day
+
+    def __roll(self):
+        today = datetime.now().date()
+        tomorrow = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        self.__day = today.toordinal()
+        self.__next_day_at = tomorrow.timestamp()
+
+
+class ManualClock:
+    """Clock ที่เลื่อนวันเองได้ (สำหรับทดสอบ/จำลอง)"""
+
+    def __init__(self, day=None):
+        self.__day = datetime.now().date().toordinal() if day is None else day
+
+    def today(self):
+        return self.__day
+
+    def advance(self, days=1):
+        self.__day += days
+
+
+# ============================================================================
+# EVENT SINKS - ทุก operation ส่ง event แทนการ print
+# ============================================================================
+
+class EventSink(ABC):
+    """ปลายทางของ event: emit(name, message, data)
+
+    name: ชนิด event เช่น 'deposit', 'withdraw'
+    message: ข้อความสำหรับแสดงผล (แบบที่เคย print)
+    data: dict ข้อมูลประกอบ (account_no, amount, balance, ...)
+    """
+
+    @abstractmethod
+    def emit(self, name, message, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class ConsoleSink(EventSink):
+    """print message ออก stdout (พฤติกรรมเดิมของ lab)"""
+
+    def emit(self, name, message, data):
+        print(message)
+
+
+class NullSink(EventSink):
+    """ทิ้ง event ทั้งหมด"""
+
+    def emit(self, name, message, data):
+        pass
+
+
+class RingBufferSink(EventSink):
+    """เก็บ event ล่าสุด capacity รายการไว้ใน memory"""
+
+    def __init__(self, capacity=10000):
+        self.__events = deque(maxlen=capacity)
+
+    def emit(self, name, message, data):
+        self.__events.append((time.time(), name, message, data))
+
+    def events(self, name=None):
+        """list ของ (timestamp, name, message, data) เรียงเก่า -> ใหม่"""
+        if name is None:
+            return list(self.__events)
+        return [event for event in self.__events if event[1] == name]
+
+    def __len__(self):
+        return len(self.__events)
+
+
+class BatchedFileSink(EventSink):
+    """เขียน event เป็น JSON Lines ลงไฟล์ทีละ batch_size รายการ"""
+
+    def __init__(self, path, batch_size=1000):
+        self.__file = open(path, 'a', encoding='utf-8')
+        self.__batch_size = batch_size
+        self.__buffer = []
+        self.__lock = threading.Lock()
+
+    def emit(self, name, message, data):
+        with self.__lock:
+            self.__buffer.append((time.time(), name, data))
+            if len(self.__buffer) >= self.__batch_size:
+                self.__write()
+
+    def flush(self):
+        with self.__lock:
+            self.__write()
+            self.__file.flush()
+
+    def close(self):
+        self.flush()
+        self.__file.close()
+
+    def __write(self):
+        if self.__buffer:
+            self.__file.write(''.join(json.dumps({'ts': ts, 'event': name, **data}, default=str) + '\n'
+                                      for ts, name, data in self.__buffer))
+            self.__buffer.clear()
+
+
+_event_sink = ConsoleSink()
+
+
+def set_event_sink(sink):
+    """เปลี่ยน sink ของทั้งระบบ คืน sink เดิม"""
+    global _event_sink
+    if not isinstance(sink, EventSink): raise TypeError('sink type Wrong')
+    previous, _event_sink = _event_sink, sink
+    return previous
+
+
+def get_event_sink():
+    return _event_sink
+
+
+def emit_event(name, message, **data):
+    _event_sink.emit(name, message, data)
+
+
+# ============================================================================
+# PIN SECURITY - เก็บ PIN เป็น hash, cache ผลตรวจ, ล็อกบัตรเมื่อใส่ผิดซ้ำ
+# ============================================================================
+
+class PinHasher:
+    """PBKDF2-HMAC-SHA256 พร้อม salt ต่อบัตร (ตั้งใจให้ช้าเพื่อกัน brute force ถ้า hash หลุด)"""
+
+    def __init__(self, iterations=100_000, salt_bytes=16):
+        self.iterations = iterations
+        self.salt_bytes = salt_bytes
+
+    def hash(self, pin):
+        """คืน (salt, digest, iterations) สำหรับเก็บใน Card"""
+        salt = secrets.token_bytes(self.salt_bytes)
+        return salt, self.derive(pin, salt, self.iterations), self.iterations
+
+    @staticmethod
+    def derive(pin, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', str(pin).encode('utf-8'), salt, iterations)
+
+
+class PinVerifier:
+    """ตรวจ PIN ของ Card แบบ constant-time พร้อม LRU cache และ lockout
+
+    cache: (card_no, salt) -> HMAC(key ของ process, pin) ของ PIN ที่เคยตรวจผ่าน
+        ครั้งถัดไปของบัตรเดิมตรวจด้วย HMAC ครั้งเดียวแทน PBKDF2 ทั้งชุด
+        ไม่เก็บ PIN ตรง ๆ และ salt ใหม่ (เปลี่ยน PIN) จะไม่ match entry เก่า
+        PIN ที่ผิดต้องผ่าน PBKDF2 เสมอ จึงไม่ช่วยให้เดา PIN เร็วขึ้น
+    lockout: ผิดติดกัน max_attempts ครั้ง -> บัตรถูกล็อกจนกว่าจะ unlock(); ตรวจผ่านแล้ว reset
+    """
+
+    def __init__(self, cache_size=100_000, max_attempts=3):
+        self.cache_size = cache_size
+        self.max_attempts = max_attempts
+        self.__cache = OrderedDict()
+        self.__failures = {}
+        self.__locked = set()
+        self.__key = secrets.token_bytes(32)
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, card, pin_input):
+        card_no = card.card_no
+        if card_no in self.__locked:
+            return False
+        salt, digest, iterations = card._pin_record()
+        if digest is None:
+            return False
+        key = (card_no, salt)
+        fast = hmac.new(self.__key, str(pin_input).encode('utf-8'), hashlib.sha256).digest()
+        with self.__lock:
+            cached = self.__cache.get(key)
+            if cached is not None:
+                self.__cache.move_to_end(key)
+        if cached is not None and hmac.compare_digest(cached, fast):
+            self.hits += 1
+            self.__succeeded(card_no)
+            return True
+        self.misses += 1
+        if not hmac.compare_digest(PinHasher.derive(pin_input, salt, iterations), digest):
+            self.__failed(card_no)
+            return False
+        if self.cache_size > 0:
+            with self.__lock:
+                self.__cache[key] = fast
+                self.__cache.move_to_end(key)
+                while len(self.__cache) > self.cache_size:
+                    self.__cache.popitem(last=False)
+        self.__succeeded(card_no)
+        return True
+
+    def __succeeded(self, card_no):
+        if card_no in self.__failures:
+            with self.__lock:
+                self.__failures.pop(card_no, None)
+
+    def __failed(self, card_no):
+        with self.__lock:
+            failures = self.__failures.get(card_no, 0) + 1
+            self.__failures[card_no] = failures
+            if failures < self.max_attempts:
+                return
+            self.__locked.add(card_no)
+            self.__failures.pop(card_no, None)
+        emit_event('card_locked', f'Card {card_no} locked after {failures} wrong PINs', card_no=card_no)
+
+    def is_locked(self, card_no):
+        return card_no in self.__locked
+
+    def failed_attempts(self, card_no):
+        return self.__failures.get(card_no, 0)
+
+    def unlock(self, card_no):
+        with self.__lock:
+            self.__locked.discard(card_no)
+            self.__failures.pop(card_no, None)
+
+    def forget(self, card_no):
+        """ลบ cache ของบัตร (เช่นหลังเปลี่ยน PIN หรือยกเลิกบัตร)"""
+        with self.__lock:
+            for key in [key for key in self.__cache if key[0] == card_no]:
+                del self.__cache[key]
+
+    def clear_cache(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    def __len__(self):
+        return len(self.__cache)
+
+
+# ============================================================================
+# POLICY TABLE - limit / fee / cashback ต่อ (account class, card class, channel class)
+# ============================================================================
+
+class Policy:
+    """กติกาที่ resolve แล้วสำหรับหนึ่ง (account class, card class, channel class)
+
+    daily_limit: วงเงินถอน/โอนรวมต่อวัน (None = ไม่จำกัด)
+    channel_limit: วงเงินต่อครั้งของช่องทาง (None = ไม่จำกัด)
+    tracks_daily: รายการผ่านช่องทางนี้นับเข้าวงเงินรายวัน
+    dispenses_cash: ช่องทางจ่ายเงินสด (ตรวจเงินในตู้ + กันยอดไว้จ่ายค่าธรรมเนียมรายปี)
+    session: 'card' (ATM/EDC), 'user' (Counter) หรือ None - ใช้ตรวจ session ของช่องทาง
+    fee: ค่าธรรมเนียมต่อการถอน (ตัดเป็นรายการ 'F' ต่อจาก 'W'), annual_fee: ค่าธรรมเนียมรายปีของบัตร
+         (ใช้ทั้งตอนเก็บ - Card.charge_annual_fee / Bank.apply_annual_fee - และตอนกันยอดใน withdraw)
+    cashback_rate, cashback_minimum: cashback ต่อยอดรูด EDC ขั้นต่ำ cashback_minimum
+    """
+
+    FIELDS = ('daily_limit', 'channel_limit', 'tracks_daily', 'dispenses_cash', 'session',
+              'fee', 'annual_fee', 'cashback_rate', 'cashback_minimum')
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for name in self.FIELDS:
+            setattr(self, name, values[name])
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __repr__(self):
+        return 'Policy(' + ', '.join(f'{name}={getattr(self, name)!r}' for name in self.FIELDS) + ')'
+
+
+class PolicyTable:
+    """ตาราง (account class, card class, channel class) -> Policy ที่คำนวณไว้ล่วงหน้า
+
+    ค่าเริ่มต้นมาจากค่าคงที่ในแต่ละ class (WITHDRAW_LIMIT_PER_DAY, CASHBACK_RATE, ANNUAL_FEE,
+    Withdraw_Limit_transac, FEE, ...) แล้วทับด้วย rules ตามลำดับ (rule หลังชนะ)
+    rule คือ dict: 'account' / 'card' / 'channel' เป็นชื่อ class (match subclass ด้วย, ไม่ใส่ = ทุก class)
+    ที่เหลือเป็นค่าของ Policy เช่น {'card': 'PremiumCard', 'daily_limit': 150000}
+
+    resolve() เป็น dict lookup เดียว; combination ที่ยังไม่เคยเห็น (subclass ใหม่) compile ตอนเจอครั้งแรก
+    load() เปลี่ยน rules ตอน runtime ได้โดยไม่ต้องแก้ class
+    """
+
+    def __init__(self, rules=()):
+        # (rules, table) สลับเป็นก้อนเดียวตอน load; table เติมตอน resolve
+        # (ตอนสร้าง Account.POLICIES class อื่นยังไม่ถูกนิยาม จึง compile ล่วงหน้าไม่ได้)
+        self.__state = (self._validate(rules), {})
+
+    @property
+    def rules(self):
+        return self.__state[0]
+
+    @staticmethod
+    def _validate(rules):
+        rules = tuple(dict(rule) for rule in rules)
+        for rule in rules:
+            unknown = set(rule) - set(Policy.FIELDS) - {'account', 'card', 'channel'}
+            if unknown: raise ValueError(f'Unknown policy fields: {", ".join(sorted(unknown))}')
+        return rules
+
+    def load(self, rules):
+        """ตรวจและ compile rules ชุดใหม่ทุก combination ที่รู้จัก แล้วสลับตารางทีเดียว"""
+        rules = self._validate(rules)
+        table = {key: self._compile(rules, *key) for key in self._known_keys()}
+        self.__state = (rules, table)
+        return len(table)
+
+    def resolve(self, account, card, channel):
+        key = (type(account), type(card), type(channel))
+        rules, table = self.__state
+        policy = table.get(key)
+        if policy is None:
+            policy = table[key] = self._compile(rules, *key)
+        return policy
+
+    @staticmethod
+    def _subclasses(cls):
+        found = [cls]
+        for sub in cls.__subclasses__():
+            found.extend(PolicyTable._subclasses(sub))
+        return found
+
+    def _known_keys(self):
+        accounts = [cls for cls in self._subclasses(Account) if not getattr(cls, '__abstractmethods__', None)]
+        cards = [type(None)] + [cls for cls in self._subclasses(Card) if not getattr(cls, '__abstractmethods__', None)]
+        channels = [type(None)] + [cls for cls in self._subclasses(Channel) if not getattr(cls, '__abstractmethods__', None)]
+        return [(a, c, ch) for a in accounts for c in cards for ch in channels]
+
+    @staticmethod
+    def _matches(name, cls):
+        return name is None or any(base.__name__ == name for base in cls.__mro__)
+
+    @classmethod
+    def _compile(cls, rules, account_cls, card_cls, channel_cls):
+        channel_cls = getattr(channel_cls, 'TERMINAL', None) or channel_cls  # ChannelSession ใช้กติกาของเครื่อง
+        has_card = card_cls is not type(None)
+        values = {
+            'daily_limit': (getattr(card_cls, 'WITHDRAW_LIMIT_PER_DAY', SavingAccount.WITHDRAW_LIMIT_PER_TRANSACTION)
+                            if issubclass(account_cls, SavingAccount) else None),
+            'channel_limit': getattr(channel_cls, 'Withdraw_Limit_transac', None),
+            'tracks_daily': issubclass(channel_cls, (ATM_machine, EDC_machine)),
+            'dispenses_cash': issubclass(channel_cls, ATM_machine),
+            'session': ('card' if issubclass(channel_cls, (ATM_machine, EDC_machine)) else
+                        'user' if issubclass(channel_cls, Counter) else None),
+            'fee': getattr(account_cls, 'FEE', 0),
+            'annual_fee': getattr(card_cls, 'ANNUAL_FEE', 0) if has_card else 0,
+            'cashback_rate': getattr(card_cls, 'CASHBACK_RATE', 0) if has_card else 0,
+            'cashback_minimum': getattr(card_cls, 'EDC_MINIMUM_TRANSACTION', 0) if has_card else 0,
+        }
+        for rule in rules:
+            if (cls._matches(rule.get('account'), account_cls) and cls._matches(rule.get('card'), card_cls)
+                    and cls._matches(rule.get('channel'), channel_cls)):
+                values.update((name, value) for name, value in rule.items() if name in Policy.FIELDS)
+        if values['cashback_rate'] and not issubclass(card_cls, DebitCard):
+            raise ValueError(f'cashback needs a DebitCard, not {card_cls.__name__}')
+        return Policy(**values)
 
 
 # ============================================================================
@@ -28,21 +428,30 @@ class Account(ABC):
         __account_no: หมายเลขบัญชี
         __user: เจ้าของบัญชี (User object)
         __amount: ยอดเงินคงเหลือ
+        __held: เงินที่ prepare_transfer กันไว้ - ยังรวมอยู่ใน __amount จน commit จึงไม่อยู่ใน snapshot/journal
         __card: บัตร ATM/Debit ที่เชื่อมกับบัญชี
-        __daily_withdrawn: ยอดเงินที่ถอนในวันนี้ (สำหรับ ATM/EDC)
-        __transaction_list: ประวัติการทำธุรกรรมทั้งหมด
+        __withdraw_limit: ยอดเงินที่ถอนในวันนี้ (สำหรับ ATM/EDC)
+        __withdraw_limit_day: เลขวัน (CLOCK.today()) ของ __withdraw_limit
+        __ledger: ประวัติการทำธุรกรรมทั้งหมด (columnar Ledger)
     """
 
     FEE = 0
+    CLOCK = SystemClock()  # เปลี่ยนเป็น ManualClock ได้ (Account.CLOCK = ...)
+    POLICIES = PolicyTable()  # limit / fee / cashback - Account.POLICIES.load(rules) เพื่อเปลี่ยนกติกา
+    __slots__ = ('__account_no', '__user', '__amount', '__held', '__card', '__ledger', '__withdraw_limit',
+                 '__withdraw_limit_day', '__bank', '__lock')
     
     def __init__(self, account_no, user, amount):
         self.__account_no = account_no
         self.__user = user
         self.__amount = amount
+        self.__held = 0
         self.__card = None
-        self.__transaction_list : list[Transaction] = []
+        self.__ledger = Ledger()
         self.__withdraw_limit = 0
-        self.__withdraw_limit_date = datetime.now().date()
+        self.__withdraw_limit_day = self.CLOCK.today()
+        self.__bank = None
+        self.__lock = threading.RLock()
     
     # ========== Properties (5 คะแนน) ==========
     
@@ -55,6 +464,16 @@ class Account(ABC):
         if value < 0:
             raise ValueError("amount can't <= 0")
         self.__amount = value
+
+    @property
+    def held(self):
+        """ยอดที่ prepare_transfer กันไว้และยังไม่ commit / abort"""
+        return self.__held
+
+    @property
+    def available(self):
+        """ยอดที่ใช้ได้ = amount - held (ทุกการตัดเงินตรวจกับยอดนี้)"""
+        return self.__amount - self.__held
     
     @property
     def card(self):
@@ -68,6 +487,15 @@ class Account(ABC):
     def user(self):
         return self.__user
     
+    @property
+    def bank(self):
+        return self.__bank
+    
+    @property
+    def lock(self):
+        """RLock ของบัญชี - ทุก operation ที่แก้ยอดเงิน/ledger ต้องถือ lock นี้"""
+        return self.__lock
+    
     @property
     def withdraw_limit(self):
         self._reset_dailylimit_ifnewday()
@@ -77,38 +505,106 @@ class Account(ABC):
     
     def add_card(self, card):
         if not isinstance(card, Card): raise TypeError("card Type Error")
+        if self.__bank is not None:
+            self.__bank._register_card(self, card, old_card=self.__card)
         self.__card = card
+        if self.__bank is not None and self.__bank.journal is not None:
+            self.__bank.journal.record_account(self)
+
+    def _attach_bank(self, bank):
+        """Called by Bank when this account enters the bank-wide index."""
+        self.__bank = bank
+
+    def _export_state(self):
+        """dict ข้อมูลบัญชี (ไม่รวม ledger) สำหรับ snapshot / journal"""
+        return {
+            'class': type(self).__name__,
+            'account_no': self.__account_no,
+            'citizen_id': self.__user.citizen_id,
+            'user_name': self.__user.name,
+            'amount': self.__amount,
+            'card': self.__card._export_state() if self.__card is not None else None,
+        }
 
     def card_fee(self, amount):
-        self.__amount -= amount
-        self._create_transaction(type='F', channel_type='SYSTEM', channel_id='ANNUAL_FEE',amount=amount,balance=self.__amount)
+        with self.__lock:
+            self._create_transaction(type='F', channel_type='SYSTEM', channel_id='ANNUAL_FEE',amount=amount,balance=self.__amount - amount)
     
     # ========== Security & Validation (5 คะแนน) ==========
     
-    def _validate_channel_session(self, channel):
-        if (isinstance(channel, ATM_machine) or isinstance(channel, EDC_machine)): 
+    def _policy(self, channel):
+        return self.POLICIES.resolve(self, self.__card, channel)
+
+    def _validate_channel_session(self, channel, policy=None):
+        session = (policy or self._policy(channel)).session
+        if session == 'card':
             if channel.current_card != self.__card: raise PermissionError('Wrong account / card')
-        if isinstance(channel, Counter):
+        elif session == 'user':
             if channel.current_user != self.__user: raise PermissionError('Wrong user')
 
     def _reset_dailylimit_ifnewday(self):
-        today = datetime.now().date()
-        if today != self.__withdraw_limit_date:
+        today = self.CLOCK.today()
+        if today != self.__withdraw_limit_day:
             self.__withdraw_limit = 0
-            self.__withdraw_limit_date = today
+            self.__withdraw_limit_day = today
+
+    def _reset_dailylimit(self, today):
+        """Reset ทันที (ใช้โดย Bank.reset_daily_limits ตอนขึ้นวันใหม่)"""
+        self.__withdraw_limit = 0
+        self.__withdraw_limit_day = today
+
+    def _add_withdraw_limit(self, amount):
+        """นับ amount เข้าวงเงินรายวันของวันนี้ (ใช้โดย Bank.process_batch กับรายการ 'W' / 'P')"""
+        self._reset_dailylimit_ifnewday()
+        self.__withdraw_limit += amount
     
     # ========== Transaction Recording ==========
     
-    def _create_transaction(self, type, channel_type, channel_id, amount, balance, target=None):
-        self.__transaction_list.append(Transaction(type, channel_type, channel_id, amount, balance, target))
+    def _journal(self):
+        return self.__bank.journal if self.__bank is not None else None
+
+    def _create_transaction(self, type, channel_type, channel_id, amount, balance, target=None, batch_id=None):
+        """ลงรายการแล้วตั้งยอดเป็น balance: journal ก่อน แล้วค่อย ledger + ยอดใน memory
+        (ถ้าเขียน journal ไม่ได้ exception ออกไปโดยบัญชีไม่เปลี่ยน)
+        batch_id: ยอดขายของ EDC แบบ settlement - แถวนี้ลง journal คู่กับยอดขายใน batch นั้น"""
+        journal = self._journal()
+        if journal is None:
+            self.__ledger.append(type, channel_type, channel_id, amount, balance, target)
+        else:
+            stamp = time.time()
+            if batch_id is None:
+                journal.record(self.__account_no, type, channel_type, channel_id, amount, balance, target, stamp)
+            else:
+                journal.record_sale(self.__account_no, type, channel_type, channel_id, amount, balance, target, stamp, batch_id)
+            self.__ledger.append(type, channel_type, channel_id, amount, balance, target, timestamp=stamp)
+        self.__amount = balance
+
+    def _create_transactions(self, channel_type, channel_id, rows):
+        """หลายรายการ (type, amount, balance, target) ของช่องทางเดียว - journal ในครั้งเดียวก่อนเปลี่ยนอะไร"""
+        journal = self._journal()
+        stamp = time.time()
+        if journal is not None:
+            journal.record_rows(self.__account_no, channel_type, channel_id, rows, stamp)
+        self.__ledger.extend(channel_type, channel_id, rows, timestamp=stamp)
+        self.__amount = rows[-1][2]
+
+    def export_statement(self, fp, format='csv', chunk_rows=10000):
+        """Stream ledger ของบัญชีนี้ลง fp (binary mode); คืนจำนวน bytes ที่เขียน"""
+        exporter = StatementExporter(fp, format, chunk_rows)
+        exporter.write_account(self)
+        return exporter.bytes_written
 
     def print_transactions(self):
         print(f"\n--- History for {self.__account_no} ({type(self).__name__}) Balance: {self.__amount:.2f} ---")
-        for t in self.__transaction_list: 
+        for t in self.__ledger: 
             print(t)
 
     def get_last_transaction(self):
-        return self.__transaction_list[-1] if self.__transaction_list else None
+        return self.__ledger.last()
+
+    @property
+    def ledger(self):
+        return self.__ledger
 
 
     
@@ -116,16 +612,35 @@ class Account(ABC):
     
     def get_transactions(self, count=None):
         if count is None:
-            return self.__transaction_list.copy()
-        return self.__transaction_list[-count:] if count > 0 else []
+            return self.__ledger[:]
+        return self.__ledger[-count:] if count > 0 else []
     
     def get_transaction_count(self):
-        return len(self.__transaction_list)
+        return len(self.__ledger)
+
+    def query_transactions(self, type=None, channel_id=None, start=None, end=None,
+                           offset=0, limit=None, newest_first=False):
+        """Iterator ของรายการที่กรองตาม type / channel_id / ช่วงเวลา [start, end) พร้อมแบ่งหน้า"""
+        return self.__ledger.query(type, channel_id, start, end, offset, limit, newest_first)
+
+    def iter_transaction_pages(self, page_size, **filters):
+        """Stream ทีละหน้า (list ขนาด page_size) - เปิดหน้าถัดไปเมื่อถูกขอเท่านั้น"""
+        if page_size <= 0: raise ValueError('page_size must be > 0')
+        rows = self.__ledger.query(**filters)
+        while True:
+            page = list(islice(rows, page_size))
+            if not page:
+                return
+            yield page
     
     def _get_channel_id(self, channel):
         if channel.get_id == None: return 'UNKNOWN'
         return channel.get_id
 
+    def interest_factor(self, early_withdrawal=False):
+        """ตัวคูณดอกเบี้ยต่อรอบ (interest = amount * factor); บัญชีที่ไม่มีดอกเบี้ยคืน 0"""
+        return 0
+
     # ========== Abstract Methods  ==========
     
     @abstractmethod
@@ -147,95 +662,151 @@ class Account(ABC):
         pass
     
     @abstractmethod
-    def _check_withdraw_limit(self, amount):
+    def _check_withdraw_limit(self, amount, policy=None):
         """ตรวจสอบ limit การถอนตามประเภทบัญชี
         
         Args:
             amount: จำนวนเงินที่ต้องการถอน
+            policy: Policy ที่ resolve แล้ว (None = resolve จากบัตรปัจจุบัน)
         
         Raises:
             ValueError: ถ้าเกิน limit
         """
         pass
 
-    def pay(self, channel, amount, merchant_account):
+    def pay(self, channel, amount, merchant_account, batch_id=None):
         self._validate_channel_session(channel)
-        self._reset_dailylimit_ifnewday()
-        if amount <= 0:
-            raise ValueError("amount need to be > 0")
-        if self.__amount < amount:
-            raise ValueError("Not enough money in account")
-
-        self.__amount -= amount
-        self.__withdraw_limit += amount
+        with self.__lock:
+            self._reset_dailylimit_ifnewday()
+            if amount <= 0:
+                raise ValueError("amount need to be > 0")
+            if self.available < amount:
+                raise ValueError("Not enough money in account")
 
-        self._create_transaction('P', channel.get_type, channel.get_id, amount, self.__amount, target=merchant_account.account_no)
+            self._create_transaction('P', channel.get_type, channel.get_id, amount, self.__amount - amount,
+                                     target=merchant_account.account_no, batch_id=batch_id)
+            self.__withdraw_limit += amount
     
     def deposit(self, channel, amount):
         self._validate_channel_session(channel)
-        self._reset_dailylimit_ifnewday()
-        if amount <= 0 : raise ValueError("amount need to be > 0")
-        self.__amount += amount
-        self._create_transaction('D', channel.get_type, channel.get_id, amount, self.amount, target=None)
-        print("Done")
+        with self.__lock:
+            self._reset_dailylimit_ifnewday()
+            if amount <= 0 : raise ValueError("amount need to be > 0")
+            self._create_transaction('D', channel.get_type, channel.get_id, amount, self.__amount + amount, target=None)
+        emit_event('deposit', "Done", account_no=self.__account_no, channel_id=channel.get_id, amount=amount, balance=self.__amount)
     
     def withdraw(self, channel, amount):
-        fee = self.FEE
-        self._validate_channel_session(channel)
-        self._reset_dailylimit_ifnewday()
-
-        if amount <= 0:
-            raise ValueError("amount need to > 0")
+        policy = self._policy(channel)
+        fee = policy.fee
+        self._validate_channel_session(channel, policy)
+        with self.__lock:
+            self._reset_dailylimit_ifnewday()
 
-        self._check_withdraw_limit(amount)
-
-        if self.__amount < amount + fee:
-            raise ValueError("Not enough money in account")
+            if amount <= 0:
+                raise ValueError("amount need to > 0")
 
-        if isinstance(channel, (ATM_machine, EDC_machine)):
-            channel.check_withdraw_limit(amount)
+            self._check_withdraw_limit(amount, policy)
 
-        if isinstance(channel, ATM_machine):
-            channel.has_sufficient_cash(amount)
-            if self.__card != None and (self.__amount - amount - fee) <= self.__card.annual_fee:
-                raise ValueError("Not enough money in account for annual fee")
+            if self.available < amount + fee:
+                raise ValueError("Not enough money in account")
 
-        self.__amount -= amount
+            if policy.channel_limit is not None and amount > policy.channel_limit:
+                raise ValueError('Exceded limit per trac')
 
-        if isinstance(channel, (ATM_machine, EDC_machine)):
-            self.__withdraw_limit += amount
+            if policy.dispenses_cash:
+                channel.has_sufficient_cash(amount)
+                if self.__card != None and (self.available - amount - fee) <= policy.annual_fee:
+                    raise ValueError("Not enough money in account for annual fee")
+                # จองเงินในตู้แบบ atomic ก่อนตัดยอด - ถ้าตู้อื่น/thread อื่นเอาเงินไปแล้วจะ error ตรงนี้
+                channel.reserve_cash(amount)
 
-        if isinstance(channel, ATM_machine):
-            channel.dispense_cash(amount)
+            rows = [('W', amount, self.__amount - amount, None)]
+            if fee > 0:
+                rows.append(('F', fee, self.__amount - amount - fee, None))
+            try:
+                self._create_transactions(channel.get_type, channel.get_id, rows)
+            except BaseException:
+                if policy.dispenses_cash:
+                    channel.release_cash(amount)  # ลงรายการไม่ได้ = ไม่ได้ถอน คืนเงินที่จองในตู้
+                raise
 
-        self._create_transaction('W', channel.get_type, channel.get_id, amount, self.__amount, target=None)
-        print("Done withdraw")
+            if policy.tracks_daily:
+                self.__withdraw_limit += amount
+        emit_event('withdraw', "Done withdraw", account_no=self.__account_no, channel_id=channel.get_id, amount=amount, balance=self.__amount)
     
     def transfer(self, channel, amount, target_account):
-        self._validate_channel_session(channel)
+        policy = self._policy(channel)
+        self._validate_channel_session(channel, policy)
+        if not isinstance(target_account, Account):
+            raise TypeError("target_account Type Error")
+        with locked_accounts(self, target_account):
+            self.__check_debit(amount, policy)
+            self.__post_transfer(channel, amount, target_account)
+            if policy.tracks_daily:
+                self.__withdraw_limit += amount
+        emit_event('transfer', "Done transfer", account_no=self.__account_no, channel_id=channel.get_id, amount=amount, balance=self.__amount, target=target_account.account_no)
+
+    def __post_transfer(self, channel, amount, target_account):
+        """TW ต้นทาง + TD ปลายทางลง journal ในครั้งเดียว ก่อนเปลี่ยนยอดของทั้งสองบัญชี"""
+        channel_type, channel_id = channel.get_type, channel.get_id
+        target_no = target_account.account_no
+        balance, target_balance = self.__amount - amount, target_account.amount + amount
+        journal = self._journal()
+        stamp = time.time()
+        if journal is not None:
+            journal.record_many([
+                (self.__account_no, 'TW', channel_type, channel_id, amount, balance, target_no, stamp),
+                (target_no, 'TD', channel_type, channel_id, amount, target_balance, self.__account_no, stamp)])
+        target_account._reset_dailylimit_ifnewday()
+        target_account.ledger.append('TD', channel_type, channel_id, amount, target_balance, self.__account_no, timestamp=stamp)
+        target_account.amount = target_balance
+        self.__ledger.append('TW', channel_type, channel_id, amount, balance, target_no, timestamp=stamp)
+        self.__amount = balance
+
+    def __check_debit(self, amount, policy):
+        """ตรวจเหมือนตอนโอน (ยอด, วงเงินรายวัน, วงเงินต่อครั้ง) โดยยังไม่เปลี่ยนอะไร"""
         self._reset_dailylimit_ifnewday()
 
         if amount <= 0:
             raise ValueError("amount need to > 0")
-        if not isinstance(target_account, Account):
-            raise TypeError("target_account Type Error")
-        if self.__amount < amount:
+        if self.available < amount:
             raise ValueError("Not enough money in account")
 
-        if isinstance(channel, (ATM_machine, EDC_machine)):
-            self._check_withdraw_limit(amount)
-            channel.check_withdraw_limit(amount)
+        if policy.tracks_daily:
+            self._check_withdraw_limit(amount, policy)
+            if policy.channel_limit is not None and amount > policy.channel_limit:
+                raise ValueError('Exceded limit per trac')
 
-        self.__amount -= amount
-        if isinstance(channel, (ATM_machine, EDC_machine)):
-            self.__withdraw_limit += amount
+    # ========== Two-phase transfer (ปลายทางอยู่คนละ shard) ==========
+    # เงินที่กันไว้อยู่ใน __held ไม่ได้ออกจาก __amount - ทุก balance ที่ลง ledger/journal/snapshot ระหว่างนั้น
+    # ยังรวมเงินก้อนนี้ ถ้า process ตายก่อน commit บัญชีที่ recover ได้จึงไม่มี hold (เท่ากับ abort)
 
-        target_account.receive_transfer(amount, channel, self.__account_no)
+    def prepare_transfer(self, channel, amount):
+        """ขั้นที่ 1 ฝั่งต้นทาง: ตรวจเหมือน transfer แล้วกันเงินไว้ใน held (ยังไม่ลง ledger)"""
+        policy = self._policy(channel)
+        self._validate_channel_session(channel, policy)
+        with self.__lock:
+            self.__check_debit(amount, policy)
+            self.__held += amount
+            if policy.tracks_daily:
+                self.__withdraw_limit += amount
 
-        self._create_transaction('TW', channel.get_type, channel.get_id, amount, self.__amount, target=target_account.account_no)
-        print("Done transfer")
-    
-    def receive_transfer(self, amount, channel:Channel, source_acc_no):
+    def commit_transfer(self, channel, amount, target_no):
+        """ขั้นที่ 2 (commit): บันทึก TW ของเงินที่กันไว้ใน prepare_transfer"""
+        with self.__lock:
+            self._create_transaction('TW', channel.get_type, channel.get_id, amount, self.__amount - amount, target=target_no)
+            self.__held -= amount
+        emit_event('transfer', "Done transfer", account_no=self.__account_no, channel_id=channel.get_id, amount=amount, balance=self.__amount, target=target_no)
+
+    def abort_transfer(self, channel, amount):
+        """ขั้นที่ 2 (abort): คืนเงินและวงเงินรายวันที่ prepare_transfer กันไว้"""
+        policy = self._policy(channel)
+        with self.__lock:
+            self.__held -= amount
+            if policy.tracks_daily:
+                self.__withdraw_limit = max(0, self.__withdraw_limit - amount)
+    
+    def receive_transfer(self, amount, channel:'Channel', source_acc_no):
         """รับเงินโอน
         
         Args:
@@ -247,9 +818,23 @@ class Account(ABC):
         1. เพิ่มเงินเข้าบัญชี
         2. บันทึก transaction (type='TD')
         """
-        self._reset_dailylimit_ifnewday()
-        self.amount += amount
-        self._create_transaction('TD', channel.get_type, channel.get_id, amount, self.__amount, target=source_acc_no)
+        with self.__lock:
+            self._reset_dailylimit_ifnewday()
+            self._create_transaction('TD', channel.get_type, channel.get_id, amount, self.__amount + amount, target=source_acc_no)
+
+
+@contextmanager
+def locked_accounts(*accounts):
+    """ถือ lock ของหลายบัญชีพร้อมกัน เรียงตาม account_no เสมอเพื่อไม่ให้ deadlock"""
+    ordered = sorted({id(account): account for account in accounts}.values(),
+                     key=lambda account: (str(account.account_no), id(account)))
+    for account in ordered:
+        account.lock.acquire()
+    try:
+        yield
+    finally:
+        for account in reversed(ordered):
+            account.lock.release()
 
 
 # ============================================================================
@@ -266,6 +851,7 @@ class SavingAccount(Account):
     
     INTEREST_RATE = 0.005  # 0.5%
     WITHDRAW_LIMIT_PER_TRANSACTION = 40000
+    __slots__ = ()
 
     def __init__(self, account_no, user, amount):
         super().__init__(account_no, user, amount)
@@ -275,6 +861,9 @@ class SavingAccount(Account):
         """: Return "Saving Account" """
         return "Saving Account"
     
+    def interest_factor(self, early_withdrawal=False):
+        return SavingAccount.INTEREST_RATE
+    
     def calculate_interest(self):
         """คำนวณและเพิ่มดอกเบี้ย 0.5%
         
@@ -284,19 +873,15 @@ class SavingAccount(Account):
         3. บันทึก transaction (type='I', channel='SYSTEM', id='AUTO')
         4. แสดงข้อความและ return interest
         """
-        interest = self.amount * SavingAccount.INTEREST_RATE
-        self.amount += interest
-        self._create_transaction("I",channel_id="AUTO",channel_type="SYSTEM",amount=interest,balance=self.amount,target=None)
-        print("Done Add intrest")
+        with self.lock:
+            interest = self.amount * self.interest_factor()
+            self._create_transaction("I",channel_id="AUTO",channel_type="SYSTEM",amount=interest,balance=self.amount + interest,target=None)
+        emit_event('interest', "Done Add intrest", account_no=self.account_no, amount=interest, balance=self.amount)
         return interest
     
-    def _check_withdraw_limit(self, amount):
-        limit = SavingAccount.WITHDRAW_LIMIT_PER_TRANSACTION
-        if isinstance(self.card, PremiumCard):
-            limit = self.card.DAILY_LIMIT
-        elif isinstance(self.card, ShoppingCard):
-            limit = self.card.DAILY_LIMIT
-        if self.withdraw_limit + amount > limit:
+    def _check_withdraw_limit(self, amount, policy=None):
+        limit = (policy or self._policy(None)).daily_limit
+        if limit is not None and self.withdraw_limit + amount > limit:
             raise ValueError(f"withdraw Exceded limit {limit} / d")
 
 class FixedAccount(Account):
@@ -310,19 +895,26 @@ class FixedAccount(Account):
     
     INTEREST_RATE = 0.025  # 2.5%
     EARLY_WITHDRAWAL_PENALTY = 0.5
+    __slots__ = ('__term_months', '__start_date', '__maturity_date')
     
-    def __init__(self, account_no, user, amount, term_months=12):
+    def __init__(self, account_no, user, amount, term_months=12, start_date=None):
         """:
         1. เรียก super().__init__()
         2. เก็บ term_months
-        3. เก็บ start_date = datetime.now()
+        3. เก็บ start_date = datetime.now() (หรือค่าที่ส่งมาตอน restore จาก snapshot)
         4. คำนวณ maturity_date = start_date + timedelta(days=term_months*30)
         """
         super().__init__(account_no=account_no,user=user,amount=amount)
         self.__term_months = term_months
-        self.__start_date = datetime.now()
+        self.__start_date = start_date if start_date is not None else datetime.now()
         self.__maturity_date = self.__start_date + timedelta(days=term_months*30)
 
+    def _export_state(self):
+        state = super()._export_state()
+        state['term_months'] = self.__term_months
+        state['start_date'] = self.__start_date.timestamp()
+        return state
+
     @property
     def term_months(self):
         return self.__term_months
@@ -335,6 +927,12 @@ class FixedAccount(Account):
         """: Return f"Fixed Account ({self.term_months} months)" """
         return f"Fixed Account ({self.__term_months} months)"
     
+    def interest_factor(self, early_withdrawal=False):
+        """rate (ครึ่งหนึ่งถ้าถอนก่อนกำหนด) * (term_months / 12)"""
+        rate = FixedAccount.INTEREST_RATE
+        if early_withdrawal: rate *= FixedAccount.EARLY_WITHDRAWAL_PENALTY
+        return rate * (self.__term_months / 12)
+    
     def calculate_interest(self, early_withdrawal=False):
         """คำนวณดอกเบี้ย 2.5% (หรือ 1.25% ถ้าถอนก่อนกำหนด)
         
@@ -346,22 +944,21 @@ class FixedAccount(Account):
         5. บันทึก transaction
         6. แสดงข้อความและ return interest
         """
-        rate = FixedAccount.INTEREST_RATE
-        if early_withdrawal: rate *= FixedAccount.EARLY_WITHDRAWAL_PENALTY
-        intrest = self.amount * rate * (self.__term_months / 12)
-        self.amount += intrest
-        self._create_transaction("I",channel_id="AUTO",channel_type="SYSTEM",amount=intrest,balance=self.amount,target=None)
-        print("Done Add Intrest")
+        with self.lock:
+            intrest = self.amount * self.interest_factor(early_withdrawal)
+            self._create_transaction("I",channel_id="AUTO",channel_type="SYSTEM",amount=intrest,balance=self.amount + intrest,target=None)
+        emit_event('interest', "Done Add Intrest", account_no=self.account_no, amount=intrest, balance=self.amount)
         return intrest
     
-    def _check_withdraw_limit(self, amount):
+    def _check_withdraw_limit(self, amount, policy=None):
         """ฝากประจำสามารถถอนได้ แต่แสดง warning
         
         :
         - ถ้า datetime.now() < maturity_date
         - แสดง warning message
         """
-        if datetime.now() < self.__maturity_date: print("warning! withdraw before maturity date")
+        if datetime.now() < self.__maturity_date:
+            emit_event('early_withdraw_warning', "warning! withdraw before maturity date", account_no=self.account_no, amount=amount)
 
 
 class CurrentAccount(Account):
@@ -372,6 +969,8 @@ class CurrentAccount(Account):
     - ถอนไม่จำกัดจำนวน/ครั้ง
     - มี daily limit 40,000 เฉพาะ ATM/EDC
     """
+
+    __slots__ = ()
     
     def get_account_type(self):
         """: Return "Current Account" """
@@ -384,10 +983,10 @@ class CurrentAccount(Account):
         - แสดงข้อความ "Current account: No interest"
         - return 0
         """
-        print("Current account: No interest")
+        emit_event('interest', "Current account: No interest", account_no=self.account_no, amount=0, balance=self.amount)
         return 0
     
-    def _check_withdraw_limit(self, amount):
+    def _check_withdraw_limit(self, amount, policy=None):
         """ไม่มี limit ต่อครั้ง
         
         : pass (ไม่ต้องทำอะไร)
@@ -405,14 +1004,23 @@ class Card(ABC):
     Attributes:
         __card_no: หมายเลขบัตร
         __account_no: หมายเลขบัญชีที่เชื่อมกับบัตร
-        __pin: รหัส PIN
+        __pin_salt, __pin_hash, __pin_iterations: PIN ที่ hash ด้วย PIN_HASHER (ไม่เก็บ PIN ตรง ๆ)
+
+    PIN_HASHER / PIN_VERIFIER ใช้ร่วมกันทุกบัตร (เปลี่ยนได้ เช่นลด iterations ตอนทดสอบ)
     """
+
+    PIN_HASHER = PinHasher()
+    PIN_VERIFIER = PinVerifier()
+    __slots__ = ('__card_no', '__account_no', '__pin_salt', '__pin_hash', '__pin_iterations')
     
     def __init__(self, card_no, account_no, pin):
-        """: Initialize card attributes"""
+        """: Initialize card attributes (pin=None = ยังไม่ตั้ง PIN, ใช้ตอน restore จาก hash)"""
         self.__card_no = card_no
         self.__account_no = account_no
-        self.__pin = pin
+        self.__pin_salt = self.__pin_hash = None
+        self.__pin_iterations = 0
+        if pin is not None:
+            self.__pin_salt, self.__pin_hash, self.__pin_iterations = self.PIN_HASHER.hash(pin)
     
     @property
     def card_no(self):
@@ -423,6 +1031,21 @@ class Card(ABC):
     def account_no(self):
         """: Return associated account number"""
         return self.__account_no
+
+    def _export_state(self):
+        return {'class': type(self).__name__, 'card_no': self.__card_no, 'account_no': self.__account_no,
+                'pin_salt': self.__pin_salt, 'pin_hash': self.__pin_hash, 'pin_iterations': self.__pin_iterations}
+
+    def _pin_record(self):
+        return self.__pin_salt, self.__pin_hash, self.__pin_iterations
+
+    def _load_pin_record(self, salt, digest, iterations):
+        self.__pin_salt, self.__pin_hash, self.__pin_iterations = salt, digest, iterations
+
+    def change_pin(self, old_pin, new_pin):
+        if not self.validate_pin(old_pin): raise PermissionError('Wrong PIN')
+        self.PIN_VERIFIER.forget(self.__card_no)
+        self.__pin_salt, self.__pin_hash, self.__pin_iterations = self.PIN_HASHER.hash(new_pin)
     
     def validate_pin(self, pin_input):
         """ตรวจสอบ PIN
@@ -433,9 +1056,9 @@ class Card(ABC):
         Returns:
             bool: True ถ้า PIN ถูกต้อง
         
-        : เปรียบเทียบ pin_input กับ __pin
+        : ตรวจกับ hash ผ่าน PIN_VERIFIER (constant-time, cache, lockout)
         """
-        return pin_input == self.__pin
+        return self.PIN_VERIFIER.verify(self, pin_input)
     
     @abstractmethod
     def get_card_type(self):
@@ -456,6 +1079,7 @@ class ATM_Card(Card):
     """
     
     ANNUAL_FEE = 100
+    __slots__ = ()
 
     @property
     def annual_fee(self):
@@ -467,12 +1091,14 @@ class ATM_Card(Card):
     
     def charge_annual_fee(self, account):
         if not isinstance(account,Account) : raise TypeError("Type must be Account")
-        if account.amount < self.ANNUAL_FEE: raise ValueError("Not Eough bal")
-        account.card_fee(self.ANNUAL_FEE)
-        print("charge add Yearly Fee")
+        fee = account._policy(None).annual_fee  # ANNUAL_FEE หรือค่าที่ rule ใน Account.POLICIES ทับไว้
+        if account.available < fee: raise ValueError("Not Eough bal")
+        account.card_fee(fee)
+        emit_event('annual_fee', "charge add Yearly Fee", account_no=account.account_no, card_no=self.card_no, amount=fee)
 
 class DebitCard(Card):
     ANNUAL_FEE = 300
+    __slots__ = ('__cashback_total',)
 
     def __init__(self, card_no, account_no, pin):
         super().__init__(card_no, account_no, pin)
@@ -495,11 +1121,17 @@ class DebitCard(Card):
             raise ValueError("cashback amount cannot be negative")
         self.__cashback_total += float(amount)
 
+    def _export_state(self):
+        state = super()._export_state()
+        state['cashback'] = self.__cashback_total
+        return state
+
     def charge_annual_fee(self, account):
         if not isinstance(account,Account) : raise TypeError("Type must be Account")
-        if account.amount < self.ANNUAL_FEE: raise ValueError("Not Eough bal")
-        account.card_fee(self.ANNUAL_FEE)
-        print("Done charge Yearly Fee")
+        fee = account._policy(None).annual_fee  # ANNUAL_FEE หรือค่าที่ rule ใน Account.POLICIES ทับไว้
+        if account.available < fee: raise ValueError("Not Eough bal")
+        account.card_fee(fee)
+        emit_event('annual_fee', "Done charge Yearly Fee", account_no=account.account_no, card_no=self.card_no, amount=fee)
 
     def get_card_type(self):
         return 'Debit Card'
@@ -507,6 +1139,7 @@ class DebitCard(Card):
 class PremiumCard(DebitCard):
     ANNUAL_FEE = 500
     CASHBACK_RATE = 0.02
+    __slots__ = ()
     WITHDRAW_LIMIT_PER_DAY = 100000
     def __init__(self, card_no, account_no, pin):
         super().__init__(card_no, account_no, pin)
@@ -525,9 +1158,10 @@ class PremiumCard(DebitCard):
 
     def charge_annual_fee(self, account):
         if not isinstance(account,Account) : raise TypeError("Type must be Account")
-        if account.amount < self.ANNUAL_FEE: raise ValueError("Not Eough bal")
-        account.card_fee(self.ANNUAL_FEE)
-        print("Done charge Yearly Fee")
+        fee = account._policy(None).annual_fee  # ANNUAL_FEE หรือค่าที่ rule ใน Account.POLICIES ทับไว้
+        if account.available < fee: raise ValueError("Not Eough bal")
+        account.card_fee(fee)
+        emit_event('annual_fee', "Done charge Yearly Fee", account_no=account.account_no, card_no=self.card_no, amount=fee)
 
     def get_card_type(self):
         return 'Premium Card'
@@ -536,6 +1170,7 @@ class ShoppingCard(DebitCard):
     CASHBACK_RATE = 0.01
     EDC_MINIMUM_TRANSACTION = 1000
     WITHDRAW_LIMIT_PER_DAY = 40000
+    __slots__ = ()
     LIMIT_PER_TRANSACTION = 40000
 
     def get_card_type(self):
@@ -558,6 +1193,8 @@ class ShoppingCard(DebitCard):
 class Channel(ABC):
     """Base class สำหรับช่องทางการทำธุรกรรม"""
 
+    __slots__ = ()
+
     @abstractmethod
     def get_id(self):
         pass
@@ -582,6 +1219,7 @@ class ATM_machine(Channel):
     - มี daily limit ตามประเภทบัตร
     """
 
+    TYPE = "ATM_machine"
     Withdraw_Limit_transac = 40000
     
     def __init__(self, atm_no, money):
@@ -593,6 +1231,7 @@ class ATM_machine(Channel):
         self.__atm_no = atm_no
         self.__money = money
         self.__current_card = None
+        self.__cash_lock = threading.Lock()
 
     def check_withdraw_limit(self, amount):
         if not amount <= self.Withdraw_Limit_transac: raise ValueError('Exceded limit per trac')
@@ -612,7 +1251,7 @@ class ATM_machine(Channel):
     
     @property
     def get_type(self):
-        return "ATM_machine"
+        return self.TYPE
     
 
     def authenticate(self, card, pin):
@@ -636,27 +1275,49 @@ class ATM_machine(Channel):
         if amount<0: raise ValueError("amount can't be negative")
         if amount > self.__money: raise ValueError("ATM didn't have enough money")
     
+    def reserve_cash(self, amount):
+        """ตรวจและตัดเงินในตู้ใน step เดียว (atomic) - คืนด้วย release_cash ถ้ายกเลิก"""
+        if amount<0: raise ValueError("amount can't be negative")
+        with self.__cash_lock:
+            self.has_sufficient_cash(amount=amount)
+            self.__money -= amount
+    
+    def release_cash(self, amount):
+        """คืนเงินที่ reserve_cash ไว้แล้วไม่ได้จ่าย"""
+        self.receive_cash(amount)
+    
     def dispense_cash(self, amount):
         """TODO: __money -= amount"""
-        if amount<0: raise ValueError("amount can't be negative")
-        self.has_sufficient_cash(amount=amount)
-        self.__money -= amount
+        self.reserve_cash(amount)
     
     def receive_cash(self, amount):
         """TODO: __money += amount"""
         if amount<0: raise ValueError("amount can't be negative")
-        self.__money += amount
+        with self.__cash_lock:
+            self.__money += amount
 
 class EDC_machine(Channel):
 
+    TYPE = "EDC_machine"
     Withdraw_Limit_transac = 40000
 
-    def __init__(self, id, merchant) -> None:
+    def __init__(self, id, merchant, settlement=None) -> None:
+        """settlement: SettlementPolicy = เก็บยอดขายเป็น batch แล้วเข้าบัญชีร้านค้าครั้งเดียวต่อ batch
+        (None = เข้าบัญชีร้านค้าทุกครั้งที่รูด)"""
         if not isinstance(merchant, CurrentAccount):
             raise TypeError("merchant must be CurrentAccount")
+        if settlement is not None and not isinstance(settlement, SettlementPolicy):
+            raise TypeError("settlement must be SettlementPolicy")
         self.__id = id
         self.__merchant = merchant
         self.__current_card = None
+        self.__settlement = settlement
+        self.__pending = None
+        self.__batches = deque()
+        self.__batch_seq = 0
+        self.__batch_by_seq = {}  # seq -> batch ที่ยังเก็บอยู่ (pending + batches)
+        self.__sales_index = {}  # account_no id (Ledger.STRINGS) -> array ของ (seq << 32 | index ใน batch)
+        self.__batch_lock = threading.Lock()
 
     def check_withdraw_limit(self, amount):
         if not amount <= self.Withdraw_Limit_transac: raise ValueError('Exceded limit per trac')
@@ -667,7 +1328,7 @@ class EDC_machine(Channel):
     
     @property
     def get_type(self):
-        return "EDC_machine"
+        return self.TYPE
     
     @property
     def current_card(self):
@@ -689,35 +1350,158 @@ class EDC_machine(Channel):
         self.__current_card = None
 
     def pay(self, account, amount):
+        self._charge(self, account, amount)
+
+    def _charge(self, channel, account, amount):
+        """ตัดเงินบัตรที่อยู่ใน session ของ channel (ตัวเครื่องเอง หรือ EDCSession ของเครื่องนี้)"""
         if not isinstance(account, Account):
             raise TypeError("account type error")
-        if self.__current_card is None:
+        if channel.current_card is None:
             raise PermissionError("No card in session")
-        if account.card != self.__current_card:
+        if account.card != channel.current_card:
             raise PermissionError("wrong account/card")
         if amount <= 0:
             raise ValueError('amount need to > 0')
 
-        account.pay(self, amount, merchant_account=self.__merchant)
+        if self.__settlement is not None:
+            # ร้านค้าไม่ถูก lock ต่อการขาย - ยอดเข้า pending batch ของเครื่องแทน
+            # ถือ batch lock ระหว่าง pay ให้ batch ไม่ปิดก่อนยอดนี้เข้า (แถว P กับยอดขายลง journal เป็น frame เดียว)
+            with account.lock:
+                with self.__batch_lock:
+                    pending = self.__open_batch()
+                    account.pay(channel, amount, merchant_account=self.__merchant, batch_id=pending.batch_id)
+                    self.__add_sale(pending, account.account_no, amount)
+                    batch = self.__close_if_due()
+                self.__credit_cashback(account, amount)
+            if batch is not None:
+                self.__credit_merchant(batch)
+            return
 
-        self.__merchant.amount += amount
-        self.__merchant._create_transaction('D', self.get_type, self.get_id, amount, self.__merchant.amount, target=account.account_no)
+        with locked_accounts(account, self.__merchant):
+            account.pay(channel, amount, merchant_account=self.__merchant)
 
-        
+            self.__merchant._create_transaction('D', self.get_type, self.get_id, amount, self.__merchant.amount + amount, target=account.account_no)
+
+            self.__credit_cashback(account, amount)
+
+    def __credit_cashback(self, account, amount):
+        policy = Account.POLICIES.resolve(account, account.card, self)
         cashback = 0
-        if isinstance(account.card, PremiumCard):
-            cashback = amount * (PremiumCard.CASHBACK_RATE)
-        elif isinstance(account.card, ShoppingCard) and amount >= ShoppingCard.EDC_MINIMUM_TRANSACTION:
-            cashback = amount * (ShoppingCard.CASHBACK_RATE)
+        if amount >= policy.cashback_minimum:
+            cashback = amount * policy.cashback_rate
 
         if cashback > 0:
-            account.amount += cashback
-            if isinstance(account.card, DebitCard):
-                account.card._add_cashback(cashback)
-            account._create_transaction('I', self.get_type, self.get_id, cashback, account.amount, target=None)
+            account._create_transaction('I', self.get_type, self.get_id, cashback, account.amount + cashback, target=None)
+            account.card._add_cashback(cashback)  # PolicyTable ให้ cashback เฉพาะ DebitCard
+
+    # ========== Batch Settlement ==========
+
+    @property
+    def settlement(self):
+        return self.__settlement
+
+    @property
+    def merchant(self):
+        return self.__merchant
+
+    @property
+    def batches(self):
+        """SettlementBatch ที่ปิดแล้ว ไม่เกิน settlement.keep_batches ล่าสุด (เก่า -> ใหม่)"""
+        return tuple(self.__batches)
+
+    @property
+    def pending(self):
+        """SettlementBatch ที่ยังเปิดอยู่ (None ถ้ายังไม่มียอดขาย)"""
+        return self.__pending
+
+    def __open_batch(self):
+        """pending batch ปัจจุบัน (เปิดใหม่ถ้ายังไม่มี) - ต้องถือ __batch_lock"""
+        pending = self.__pending
+        if pending is None:
+            self.__batch_seq += 1
+            pending = self.__pending = SettlementBatch(f'{self.__id}#{self.__batch_seq:06d}', self.__id)
+            self.__batch_by_seq[self.__batch_seq] = pending
+        return pending
+
+    def __add_sale(self, pending, account_no, amount):
+        """ใส่ยอดขายลง pending batch + index ของ find_sales - ต้องถือ __batch_lock
+        (journal ได้ยอดนี้แล้วพร้อมแถว P ของผู้ซื้อ - crash ก่อน settle, BankJournal.recover เข้าบัญชีร้านค้าให้)"""
+        # index เป็น array ของ int (ไม่สร้าง object ต่อการขาย -> ไม่เพิ่มงานให้ GC)
+        sale = self.__batch_seq << 32 | len(pending)
+        account_id = pending._add(account_no, amount)
+        sales = self.__sales_index.get(account_id)
+        if sales is None:
+            self.__sales_index[account_id] = array('q', (sale,))
+        else:
+            sales.append(sale)
+
+    def __close_if_due(self):
+        pending, policy = self.__pending, self.__settlement
+        if len(pending) < policy.max_sales and time.time() - pending.opened_at < policy.max_interval:
+            return None
+        self.__pending = None
+        self.__archive(pending)
+        return pending
+
+    def __archive(self, batch):
+        """เก็บ batch ที่ปิดแล้ว แล้วทิ้ง batch เก่าเกิน keep_batches (พร้อม entry ใน index)"""
+        batches, index = self.__batches, self.__sales_index
+        batches.append(batch)
+        while len(batches) > self.__settlement.keep_batches:
+            old = batches.popleft()
+            seq = next(iter(self.__batch_by_seq))  # dict เรียงตามลำดับที่เปิด batch -> ตัวแรกคือ old
+            del self.__batch_by_seq[seq]
+            limit = (seq + 1) << 32
+            for account_id in old._account_ids():
+                sales = index[account_id]
+                keep = next((i for i, sale in enumerate(sales) if sale >= limit), len(sales))
+                if keep == len(sales):
+                    del index[account_id]
+                else:
+                    del sales[:keep]
+
+    def settle(self):
+        """ปิด pending batch แล้วเข้าบัญชีร้านค้าทันที (เช่นตอนปิดวัน); คืน batch หรือ None"""
+        with self.__batch_lock:
+            batch, self.__pending = self.__pending, None
+            if batch is not None:
+                self.__archive(batch)
+        if batch is not None:
+            self.__credit_merchant(batch)
+        return batch
+
+    def _unsettled_batches(self):
+        """batch ที่ยังไม่เข้าบัญชีร้านค้า (pending + ปิดแล้วแต่ยัง credit ไม่เสร็จ) สำหรับ snapshot"""
+        batches = [batch for batch in self.__batches if batch.settled_at is None]
+        pending = self.__pending
+        if pending is not None:
+            batches.append(pending)
+        return batches
+
+    def __credit_merchant(self, batch):
+        merchant = self.__merchant
+        with merchant.lock:
+            merchant._create_transaction('D', self.get_type, self.get_id, batch.total, merchant.amount + batch.total, target=batch.batch_id)
+        batch._settled(time.time())
+        emit_event('edc_settled', f'Settled {batch.batch_id}', channel_id=self.__id, sales=len(batch), total=batch.total)
+
+    def find_sales(self, account_no):
+        """ยอดขายของบัญชีผู้ซื้อในเครื่องนี้ (batch ที่ยังเก็บไว้ + pending) เป็น (batch_id, amount, timestamp)"""
+        account_id = Ledger.STRINGS.find(account_no)
+        if account_id is None:
+            return
+        with self.__batch_lock:
+            sales = [(self.__batch_by_seq.get(sale >> 32), sale & 0xFFFFFFFF)
+                     for sale in self.__sales_index.get(account_id, ())]
+        for batch, i in sales:
+            if batch is not None:
+                yield (batch.batch_id,) + batch._sale(i)
 
 
 class Counter(Channel):
+
+    TYPE = "Counter"
+
     def __init__(self, id) -> None:
         self.__id = id
         self.__current_user = None
@@ -736,7 +1520,7 @@ class Counter(Channel):
     
     @property
     def get_type(self):
-        return "Counter"
+        return self.TYPE
     
     @property
     def current_user(self):
@@ -751,164 +1535,2389 @@ class Counter(Channel):
 
 
 # ============================================================================
-# SUPPORTING CLASSES
+# ASYNC CHANNEL SESSIONS - หลาย session ต่อเครื่อง บน asyncio event loop เดียว
 # ============================================================================
 
-class Bank:
-    """ระบบธนาคาร - จัดการ Users, ATMs, EDCs, Counters"""
-    
-    ATM_FEE = 0  # ถอน ATM ฟรีทุกบัตร
-    WITHDRAW_LIMIT = 40000  # วงเงินถอนมาตรฐาน
-    
-    def __init__(self, name):
-        self.name = name
-        self.__user_list = []
-        self.__atm_list = []
-        self.__edc_list = []
-        self.__counter_list = []
-    
-    def add_user(self, user):
-        if not isinstance(user, User): raise TypeError('User type Wrong')
-        if user in self.__user_list: raise ValueError('Already have this user')
-        self.__user_list.append(user)
-        print('Done Add user')
+class ChannelSession(Channel):
+    """state ของหนึ่ง session บนเครื่อง (ATM/EDC/Counter) - ใช้แทนตัวเครื่องเป็น channel ของ Account
 
-    def add_atm_machine(self, atm):
-        if not isinstance(atm, ATM_machine): raise TypeError('Atm type Wrong')
-        if atm in self.__atm_list: raise ValueError('Already have this atm')
-        self.__atm_list.append(atm)
-        print('Done add atm machine')
-    
-    def add_edc_machine(self, edc):
-        if not isinstance(edc, EDC_machine): raise TypeError('edc type Wrong')
-        if edc in self.__edc_list: raise ValueError('Already have this edc')
-        self.__edc_list.append(edc)
-        print('Done add edc machine')
-    
-    def add_counter(self, counter):
-        if not isinstance(counter, Counter): raise TypeError('counter type Wrong')
-        if counter in self.__counter_list: raise ValueError('Already have this counter')
-        self.__counter_list.append(counter)
-        print('Done add counter machine')
-    
-    def get_atm_by_id(self, atm_id):
-        for atm in self.__atm_list:
-            if atm.get_id == atm_id: return atm
-        return None
+    ATM_machine / EDC_machine / Counter ถือ current_card / current_user ได้ทีละคน
+    session เก็บของตัวเอง เครื่องเดียวจึงรับหลาย session ซ้อนกันได้ ส่วนเงินในตู้, batch ของ EDC,
+    id และ type ยังเป็นของเครื่อง; PolicyTable ใช้กติกาของ TERMINAL
 
-    
-    def get_edc_by_id(self, edc_id):
-        for edc in self.__edc_list:
-            if edc.get_id == edc_id: return edc
-        return None
-    
-    def get_counter_by_id(self, counter_id):
-        for counter in self.__counter_list:
-            if counter.get_id == counter_id: return counter
-        return None
-    
-    def search_account_from_card(self, card_no):
-        for user in self.__user_list:
-            account = user.search_account_from_card(card_no)
-            if account != None:
-                return account
-        return None
+    state: 'idle' -> 'authenticating' -> 'active' -> (eject) 'idle' ... -> (close) 'closed'
+    """
 
-    def apply_annual_fee(self):
-        for user in self.__user_list:
-            for account in user.get_all_accounts():
-                account.card.charge_annual_fee(account)
+    __slots__ = ('__frontend', '__terminal', '__session_id', '__state', '__card', '__user', '__account',
+                 '__operations', '__auth_attempt')
+    TERMINAL = None
 
+    def __init__(self, frontend, terminal, session_id):
+        self.__frontend = frontend
+        self.__terminal = terminal
+        self.__session_id = session_id
+        self.__state = 'idle'
+        self.__card = None
+        self.__user = None
+        self.__account = None
+        self.__operations = 0
+        self.__auth_attempt = 0
 
-class User:
-    """ผู้ใช้บริการธนาคาร"""
-    
-    def __init__(self, citizen_id, name):
-        self.__citizen_id = citizen_id
-        self.__name = name
-        self.__account_list = []
-    
-    def add_account(self, account):
-        if not isinstance(account, Account): raise TypeError("account type error")
-        if account in self.__account_list: raise ValueError("Already have this account")
-        self.__account_list.append(account)
-        print("Done Add account")
-    
-    def search_account_from_card(self, card_no):
-        for account in self.__account_list:
-            if account.card != None and account.card.card_no == card_no:
-                return account
-        return None
-    
-    def get_all_accounts(self):
-        return self.__account_list
+    @property
+    def get_id(self):
+        return self.__terminal.get_id
 
-    def check_citizen_id(self, citizen_id):
-        return citizen_id == self.__citizen_id
-    
     @property
-    def name(self):
-        return self.__name
+    def get_type(self):
+        return self.__terminal.get_type
 
+    @property
+    def frontend(self):
+        return self.__frontend
 
+    @property
+    def terminal(self):
+        return self.__terminal
 
-class Transaction:
-    """รายการทำธุรกรรม
-    
-    Transaction Types:
-        D  = Deposit (ฝากเงิน)
-        W  = Withdraw (ถอนเงิน)
-        TW = Transfer Withdraw (โอนออก)
-        TD = Transfer Deposit (รับโอน)
-        I  = Interest/Cashback (ดอกเบี้ย/เครดิตคืน)
-        P  = Payment (ชำระเงินผ่าน EDC)
-        F  = Fee (ค่าธรรมเนียม)
+    @property
+    def session_id(self):
+        return self.__session_id
+
+    @property
+    def state(self):
+        return self.__state
+
+    @property
+    def current_card(self):
+        return self.__card
+
+    @property
+    def current_user(self):
+        return self.__user
+
+    @property
+    def account(self):
+        return self.__account
+
+    @property
+    def operations(self):
+        return self.__operations
+
+    def check_withdraw_limit(self, amount):
+        self.__terminal.check_withdraw_limit(amount)
+
+    # ========== Session ==========
+
+    def _begin_auth(self):
+        """เริ่มตรวจตัวตน; คืน token ของรอบนี้ให้ส่งต่อไป _finish_auth / _abort_auth"""
+        if self.__state == 'closed': raise ValueError('Session closed')
+        if self.__state != 'idle': raise ValueError('Session already has a card / user')
+        self.__state = 'authenticating'
+        self.__auth_attempt += 1
+        return self.__auth_attempt
+
+    def _current_auth(self, token):
+        return self.__state == 'authenticating' and token == self.__auth_attempt
+
+    def _finish_auth(self, token, ok, account, card=None):
+        """คืน True ถ้าเข้า session ได้; ถ้าถูก eject/close ระหว่างรอตรวจ PIN (token เก่า) ผลจะถูกทิ้ง"""
+        if not self._current_auth(token):
+            return False
+        if not ok:
+            self.__state = 'idle'
+            return False
+        self.__card = card
+        self.__user = account.user
+        self.__account = account
+        self.__state = 'active'
+        return True
+
+    def _abort_auth(self, token):
+        if self._current_auth(token):
+            self.__state = 'idle'
+
+    def _active(self):
+        if self.__state != 'active': raise PermissionError('No card / user in session')
+        self.__operations += 1
+        return self.__account
+
+    async def insert_card(self, card, pin):
+        """ตรวจ PIN (ใน executor ของ frontend) แล้วผูกบัญชีของบัตรกับ session; คืน True/False"""
+        token = self._begin_auth()
+        try:
+            ok = await self.__frontend._verify(self.authenticate, card, pin)
+            account = self.__frontend.bank.get_account_by_no(card.account_no) if ok else None
+            if ok and account is None: raise ValueError(f'No account {card.account_no} for card')
+        except BaseException:
+            self._abort_auth(token)
+            raise
+        return self._finish_auth(token, ok, account, card)
+
+    async def eject(self):
+        """จบ session ของลูกค้าคนนี้ - เครื่องรับบัตร/ลูกค้าคนถัดไปต่อได้"""
+        if self.__state == 'closed': raise ValueError('Session closed')
+        if self.__state == 'idle': raise ValueError('No card to eject')
+        self.__state = 'idle'
+        self.__auth_attempt += 1  # ผลตรวจ PIN ที่ยังค้างอยู่กลายเป็นของรอบเก่า
+        self.__card = self.__user = self.__account = None
+
+    async def close(self):
+        self.__state = 'closed'
+        self.__auth_attempt += 1
+        self.__card = self.__user = self.__account = None
+        self.__frontend._closed(self)
+
+    # ========== Operations (logic เดิมของ Account) ==========
+
+    async def deposit(self, amount):
+        account = self._active()
+        account.deposit(self, amount)
+        return account.amount
+
+    async def withdraw(self, amount):
+        account = self._active()
+        account.withdraw(self, amount)
+        return account.amount
+
+    async def transfer(self, amount, target_account_no):
+        account = self._active()
+        target = self.__frontend.bank.get_account_by_no(target_account_no)
+        if target is None: raise ValueError(f'No account {target_account_no}')
+        account.transfer(self, amount, target)
+        return account.amount
+
+    def __str__(self):
+        return f'{type(self).__name__}({self.__session_id} @ {self.get_id}, {self.__state})'
+
+
+class ATMSession(ChannelSession):
+    """session บน ATM_machine - เงินในตู้ใช้ร่วมกันทุก session (reserve_cash ของเครื่องเป็น atomic)"""
+
+    __slots__ = ()
+    TERMINAL = ATM_machine
+
+    def authenticate(self, card, pin):
+        if not isinstance(card, Card): raise TypeError('Card Type Error')
+        return card.validate_pin(pin)
+
+    def has_sufficient_cash(self, amount):
+        self.terminal.has_sufficient_cash(amount)
+
+    def reserve_cash(self, amount):
+        self.terminal.reserve_cash(amount)
+
+    def release_cash(self, amount):
+        self.terminal.release_cash(amount)
+
+
+class EDCSession(ChannelSession):
+    """session บน EDC_machine - ยอดขายเข้าร้านค้า/batch ของเครื่องเหมือนรูดที่เครื่องตรง ๆ"""
+
+    __slots__ = ()
+    TERMINAL = EDC_machine
+
+    def authenticate(self, card, pin):
+        if not isinstance(card, DebitCard):
+            raise TypeError('EDC supports DebitCard only')
+        return card.validate_pin(pin)
+
+    async def pay(self, amount):
+        account = self._active()
+        self.terminal._charge(self, account, amount)
+        return account.amount
+
+
+class CounterSession(ChannelSession):
+    """session บน Counter - ยืนยันตัวตนด้วยเลขบัตรประชาชน ไม่ใช้บัตร"""
+
+    __slots__ = ()
+    TERMINAL = Counter
+
+    def authenticate(self, account, citizen_id):
+        if not isinstance(account, Account):
+            raise TypeError("Account type Error")
+        if account.user.check_citizen_id(citizen_id):
+            return True
+        raise PermissionError("Wrong citizen id")
+
+    async def insert_card(self, card, pin):
+        raise TypeError('Counter does not take cards, use verify_identity')
+
+    async def verify_identity(self, account_no, citizen_id):
+        token = self._begin_auth()
+        try:
+            account = self.frontend.bank.get_account_by_no(account_no)
+            if account is None: raise ValueError(f'No account {account_no}')
+            ok = self.authenticate(account, citizen_id)
+        except BaseException:
+            self._abort_auth(token)
+            raise
+        return self._finish_auth(token, ok, account)
+
+
+class AsyncChannelFrontend:
+    """asyncio front-end ของ Bank: เปิด session บนเครื่องที่ลงทะเบียนไว้ แล้วทำธุรกรรมด้วย coroutine
+
+    ธุรกรรมเรียก logic เดิมของ Account ตรง ๆ (ใช้ CPU สั้น ๆ ไม่ block) ทั้งหมดรันใน thread ของ event loop
+    มีแค่ตรวจ PIN (PBKDF2 ที่ยังไม่อยู่ใน cache) ที่ส่งไป executor - pbkdf2_hmac ปล่อย GIL
+    จึงไม่ถ่วง session อื่น; offload_pin=False ตรวจใน loop เลย (เหมาะกับ PinHasher iterations ต่ำ)
+
+    ตัวอย่าง:
+        frontend = AsyncChannelFrontend(bank)
+        session = frontend.open('ATM-001')
+        if await session.insert_card(card, '1234'):
+            await session.withdraw(500)
+            await session.eject()
+    """
+
+    SESSION_TYPES = ((ATM_machine, ATMSession), (EDC_machine, EDCSession), (Counter, CounterSession))
+
+    def __init__(self, bank, executor=None, offload_pin=True):
+        if not isinstance(bank, Bank): raise TypeError('bank type Wrong')
+        self.__bank = bank
+        self.__executor = executor
+        self.__offload_pin = offload_pin
+        self.__sessions = {}
+        self.__opened = 0
+        self.__peak = 0
+
+    @property
+    def bank(self):
+        return self.__bank
+
+    @property
+    def opened(self):
+        """จำนวน session ที่เคยเปิดทั้งหมด"""
+        return self.__opened
+
+    @property
+    def peak(self):
+        """จำนวน session ที่เปิดพร้อมกันสูงสุด"""
+        return self.__peak
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def sessions(self, channel_id=None):
+        return [session for session in self.__sessions.values() if channel_id is None or session.get_id == channel_id]
+
+    def open(self, channel_id):
+        """เปิด session ใหม่บนเครื่อง channel_id (เครื่องเดียวเปิดได้หลาย session)"""
+        terminal = self.__bank.channels.get(channel_id)
+        if terminal is None: raise ValueError(f'No channel {channel_id}')
+        for terminal_cls, session_cls in self.SESSION_TYPES:
+            if isinstance(terminal, terminal_cls):
+                break
+        else:
+            raise TypeError(f'No session type for {type(terminal).__name__}')
+        self.__opened += 1
+        session = session_cls(self, terminal, f'{channel_id}/{self.__opened}')
+        self.__sessions[session.session_id] = session
+        self.__peak = max(self.__peak, len(self.__sessions))
+        return session
+
+    def _closed(self, session):
+        self.__sessions.pop(session.session_id, None)
+
+    async def close_all(self):
+        for session in list(self.__sessions.values()):
+            await session.close()
+
+    async def _verify(self, check, *args):
+        if not self.__offload_pin:
+            return check(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, partial(check, *args))
+
+
+# ============================================================================
+# SUPPORTING CLASSES
+# ============================================================================
+
+class ChannelRegistry:
+    """ทะเบียนช่องทาง (ATM/EDC/Counter) - lookup ด้วย channel id
+
+    Attributes:
+        __by_id: channel_id -> Channel (ใช้ตรวจ id ซ้ำทุกประเภท)
+        __by_type: channel type ("ATM_machine", ...) -> {channel_id: Channel}
+    """
+
+    def __init__(self):
+        self.__by_id = {}
+        self.__by_type = {}
+
+    def __contains__(self, channel_id):
+        return channel_id in self.__by_id
+
+    def __len__(self):
+        return len(self.__by_id)
+
+    def register(self, channel):
+        if not isinstance(channel, Channel): raise TypeError('channel type Wrong')
+        channel_id = channel.get_id
+        if channel_id in self.__by_id: raise ValueError(f'Already have channel {channel_id}')
+        self.__by_id[channel_id] = channel
+        self.__by_type.setdefault(channel.get_type, {})[channel_id] = channel
+
+    def register_many(self, channels):
+        """Validate the whole batch first, then insert; returns the number added."""
+        batch = {}
+        for channel in channels:
+            if not isinstance(channel, Channel): raise TypeError('channel type Wrong')
+            channel_id = channel.get_id
+            if channel_id in self.__by_id or channel_id in batch:
+                raise ValueError(f'Already have channel {channel_id}')
+            batch[channel_id] = channel
+        self.__by_id.update(batch)
+        for channel_id, channel in batch.items():
+            self.__by_type.setdefault(channel.get_type, {})[channel_id] = channel
+        return len(batch)
+
+    def get(self, channel_id, channel_type=None):
+        """คืน channel ตาม id (ถ้าระบุ channel_type ต้องตรงประเภทด้วย)"""
+        if channel_type is None:
+            return self.__by_id.get(channel_id)
+        return self.__by_type.get(channel_type, {}).get(channel_id)
+
+    def of_type(self, channel_type):
+        """Read-only view {channel_id: Channel} ของประเภทที่ระบุ"""
+        return MappingProxyType(self.__by_type.setdefault(channel_type, {}))
+
+
+class SettlementPolicy:
+    """เงื่อนไขปิด batch ของ EDC: ครบ max_sales รายการ หรือเปิดมานานเกิน max_interval วินาที
+
+    ตรวจตอนมียอดขายเข้ามา - เครื่องที่เงียบไปต้อง settle() เอง (หรือ Bank.settle_edcs ตอนปิดวัน)
+    """
+
+    def __init__(self, max_sales=1000, max_interval=60.0, keep_batches=1000):
+        """keep_batches: จำนวน batch ที่ settle แล้วที่เครื่องเก็บไว้ให้ค้น (find_sales) - เก่ากว่านั้นทิ้ง"""
+        if max_sales <= 0 or max_interval < 0: raise ValueError('max_sales must be > 0 and max_interval >= 0')
+        if keep_batches < 0: raise ValueError('keep_batches must be >= 0')
+        self.max_sales = max_sales
+        self.max_interval = max_interval
+        self.keep_batches = keep_batches
+
+
+class SettlementBatch:
+    """ยอดขายของ EDC หนึ่งเครื่องที่เข้าบัญชีร้านค้าเป็นรายการ 'D' เดียว
+
+    รายละเอียดต่อการขายเก็บแบบ column (account_no id ใน Ledger.STRINGS, amount, timestamp)
+    """
+
+    def __init__(self, batch_id, channel_id):
+        self.batch_id = batch_id
+        self.channel_id = channel_id
+        self.opened_at = time.time()
+        self.settled_at = None
+        self.total = 0.0
+        self.__account = array('i')
+        self.__amount = array('d')
+        self.__timestamp = array('d')
+
+    def _add(self, account_no, amount):
+        """เพิ่มยอดขาย; คืน id ของ account_no ใน Ledger.STRINGS"""
+        account_id = Ledger.STRINGS.intern(account_no)
+        self.__account.append(account_id)
+        self.__amount.append(amount)
+        self.__timestamp.append(time.time())
+        self.total += amount
+        return account_id
+
+    def _settled(self, ts):
+        self.settled_at = ts
+
+    def _sale(self, i):
+        return self.__amount[i], datetime.fromtimestamp(self.__timestamp[i])
+
+    def _account_ids(self):
+        return set(self.__account)
+
+    def _export_sales(self):
+        """[(account_no, amount, epoch ts)] สำหรับ snapshot ของ BankJournal"""
+        get = Ledger.STRINGS.get
+        return [(get(a), amount, ts) for a, amount, ts in zip(self.__account, self.__amount, self.__timestamp)]
+
+    def __len__(self):
+        return len(self.__amount)
+
+    def sales(self):
+        """Iterator ของ (account_no, amount, datetime) ตามลำดับที่ขาย"""
+        get = Ledger.STRINGS.get
+        for i in range(len(self.__amount)):
+            yield get(self.__account[i]), self.__amount[i], datetime.fromtimestamp(self.__timestamp[i])
+
+    def __str__(self):
+        state = 'settled' if self.settled_at is not None else 'pending'
+        return f"SettlementBatch {self.batch_id}: {len(self)} sales, {self.total:,.2f} THB ({state})"
+
+
+class Bank:
+    """ระบบธนาคาร - จัดการ Users, ATMs, EDCs, Counters
+
+    Keeps bank-wide hash indexes so lookups don't walk every user:
+        __user_index: citizen_id -> User
+        __account_index: account_no -> Account
+        __card_index: card_no -> Account
+    The indexes are maintained by add_user, User.add_account and Account.add_card.
+    ATM/EDC/Counter live in a ChannelRegistry keyed by channel id.
+
+    Bulk jobs (process_batch, run_interest, apply_annual_fee) don't take account
+    locks; run them while no sessions are touching the same accounts.
     """
     
-    def __init__(self, type, channel_type, channel_id, amount, balance, target=None):
-        """TODO:
-        - เก็บ type, channel_type, channel_id
-        - เก็บ amount, balance, target
-        - เก็บ timestamp = datetime.now()
-        """
-        self.__type = type
-        self.__channel_type = channel_type
-        self.__channel_id = channel_id
-        self.__amount = amount
-        self.__balance = balance
-        self.__target = target
+    ATM_FEE = 0  # ถอน ATM ฟรีทุกบัตร
+    WITHDRAW_LIMIT = 40000  # วงเงินถอนมาตรฐาน
     
-    def __str__(self):
-        base = f"{self.__type}-{self.__channel_type}:{self.__channel_id}-{self.__amount:.2f}-{self.__balance:.2f}"
-        if self.__target is None:
-            return base
-        return f"{base}-{self.__target}"
+    def __init__(self, name):
+        self.name = name
+        self.__user_index = {}
+        self.__account_index = {}
+        self.__card_index = {}
+        self.__channels = ChannelRegistry()
+        self.__journal = None
     
-    @property
-    def type(self):
-        return self.__type
+    def add_user(self, user):
+        if not isinstance(user, User): raise TypeError('User type Wrong')
+        if user.citizen_id in self.__user_index: raise ValueError('Already have this user')
+        self.__user_index[user.citizen_id] = user
+        user._attach_bank(self)
+        for account in user.get_all_accounts():
+            self._register_account(account)
+        emit_event('user_added', 'Done Add user', citizen_id=user.citizen_id)
+
+    # ========== Index Maintenance ==========
+
+    def _register_account(self, account):
+        """Put account (and its card, if any) into the bank-wide indexes."""
+        current = self.__account_index.get(account.account_no)
+        if current is not None and current is not account:
+            raise ValueError(f'Account no {account.account_no} already used')
+        self.__account_index[account.account_no] = account
+        account._attach_bank(self)
+        if account.card is not None:
+            self._register_card(account, account.card)
+        if self.__journal is not None:
+            self.__journal.record_account(account)
+
+    def _register_card(self, account, card, old_card=None):
+        """Map card_no -> account, dropping the account's previous card."""
+        current = self.__card_index.get(card.card_no)
+        if current is not None and current is not account:
+            raise ValueError(f'Card no {card.card_no} already used')
+        if old_card is not None and self.__card_index.get(old_card.card_no) is account:
+            del self.__card_index[old_card.card_no]
+        self.__card_index[card.card_no] = account
+
+    # ========== Channels ==========
+
+    def add_atm_machine(self, atm):
+        if not isinstance(atm, ATM_machine): raise TypeError('Atm type Wrong')
+        if atm.get_id in self.__channels: raise ValueError('Already have this atm')
+        self.__channels.register(atm)
+        emit_event('channel_added', 'Done add atm machine', channel_id=atm.get_id, channel_type=atm.get_type)
     
-    @property
-    def amount(self):
-        return self.__amount
+    def add_edc_machine(self, edc):
+        if not isinstance(edc, EDC_machine): raise TypeError('edc type Wrong')
+        if edc.get_id in self.__channels: raise ValueError('Already have this edc')
+        self.__channels.register(edc)
+        emit_event('channel_added', 'Done add edc machine', channel_id=edc.get_id, channel_type=edc.get_type)
     
-    @property
-    def channel_type(self):
-        return self.__channel_type
+    def add_counter(self, counter):
+        if not isinstance(counter, Counter): raise TypeError('counter type Wrong')
+        if counter.get_id in self.__channels: raise ValueError('Already have this counter')
+        self.__channels.register(counter)
+        emit_event('channel_added', 'Done add counter machine', channel_id=counter.get_id, channel_type=counter.get_type)
+
+    def add_channels(self, channels):
+        """Register many ATM/EDC/Counter at once (all-or-nothing)"""
+        count = self.__channels.register_many(channels)
+        emit_event('channel_added', f'Done add {count} channels', count=count)
+        return count
     
-    @property
-    def channel_id(self):
-        return self.__channel_id
+    def get_atm_by_id(self, atm_id):
+        return self.__channels.get(atm_id, ATM_machine.TYPE)
+
+    def get_edc_by_id(self, edc_id):
+        return self.__channels.get(edc_id, EDC_machine.TYPE)
     
+    def get_counter_by_id(self, counter_id):
+        return self.__channels.get(counter_id, Counter.TYPE)
+
     @property
-    def balance(self):
-        return self.__balance
+    def channels(self):
+        return self.__channels
+
+    def settle_edcs(self):
+        """Settle pending batch ของ EDC ทุกเครื่อง (เช่นตอนปิดวัน); คืน list ของ batch ที่ settle"""
+        batches = [edc.settle() for edc in self.__channels.of_type(EDC_machine.TYPE).values()]
+        return [batch for batch in batches if batch is not None]
     
+    # ========== Journal ==========
+
     @property
-    def target(self):
-        return self.__target
+    def journal(self):
+        return self.__journal
+
+    def attach_journal(self, journal):
+        """ให้ทุกการเปลี่ยนยอดเงินถูกบันทึกลง journal ก่อนแก้ใน memory (None = ปิด)"""
+        self.__journal = journal
+
+    def get_all_accounts(self):
+        return list(self.__account_index.values())
+
+    def reset_daily_limits(self):
+        """Reset ยอดถอนรายวันของทุกบัญชีครั้งเดียวตอนขึ้นวันใหม่
+
+        หลังจากนี้ lazy check ใน Account เจอเลขวันตรงกันทุกบัญชี จึงไม่ต้อง reset ซ้ำ
+        """
+        today = Account.CLOCK.today()
+        for account in self.__account_index.values():
+            with account.lock:
+                account._reset_dailylimit(today)
+        return len(self.__account_index)
+
+    # ========== Lookup ==========
+
+    def get_user_by_citizen_id(self, citizen_id):
+        return self.__user_index.get(citizen_id)
+
+    def get_account_by_no(self, account_no):
+        return self.__account_index.get(account_no)
+
+    def search_account_from_card(self, card_no):
+        return self.__card_index.get(card_no)
+
+    def get_all_users(self):
+        return list(self.__user_index.values())
+
+    def get_account_count(self):
+        return len(self.__account_index)
+
+    def report(self):
+        """BankReport ที่นับทุกรายการถึงตอนนี้แล้ว - เรียก refresh() เพื่อรวมรายการใหม่"""
+        report = BankReport(self)
+        report.refresh()
+        return report
+
+    def export_statements(self, directory, format='csv', workers=None, chunk_rows=10000):
+        """Export statement ทุกบัญชี (ดู export_statements / StatementExporter); คืน ExportResult"""
+        return export_statements(self, directory, format, workers, chunk_rows)
+
+    def apply_annual_fee(self, chunk_size=10000, resume_from=None, max_chunks=None, on_chunk=None):
+        """เก็บค่าธรรมเนียมรายปีของทุกบัตร ทีละ chunk ตามลำดับใน account index
+
+        แต่ละ chunk จัดกลุ่มตาม class ของบัตร (ATM_Card/DebitCard/PremiumCard/ShoppingCard)
+        แล้วลงรายการ 'F' (SYSTEM:ANNUAL_FEE) ทั้งกลุ่มด้วย Ledger.post_many
+        บัญชีที่ไม่มีบัตรนับเป็น skipped, ยอดเงินไม่พอเก็บเป็น failure ใน report (ไม่หยุดงาน)
+
+        Args:
+            chunk_size: จำนวนบัญชีต่อ chunk
+            resume_from: AnnualFeeReport (หรือ report จาก AnnualFeeReport.from_checkpoint)
+                ที่จะทำต่อจาก position เดิม
+            max_chunks: หยุดหลังทำครบกี่ chunk (None = จนจบ)
+            on_chunk: callback(report) หลังจบแต่ละ chunk เช่นเขียน checkpoint ลงไฟล์
+
+        Returns:
+            AnnualFeeReport (report.done == True เมื่อครบทุกบัญชี)
+        """
+        report = resume_from if resume_from is not None else AnnualFeeReport()
+        accounts = islice(self.__account_index.values(), report.position, None)
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            start = time.perf_counter()
+            chunk = list(islice(accounts, chunk_size))
+            if not chunk:
+                report.done = True
+                break
+            self._charge_annual_fee_chunk(chunk, report)
+            report.position += len(chunk)
+            report.elapsed += time.perf_counter() - start
+            chunks += 1
+            if on_chunk is not None:
+                on_chunk(report)
+        return report
+
+    def _charge_annual_fee_chunk(self, accounts, report):
+        groups = defaultdict(list)
+        for account in accounts:
+            card = account.card
+            if card is None:
+                report.skipped += 1
+                continue
+            fee = account._policy(None).annual_fee  # ค่าเดียวกับ card.charge_annual_fee (รวม rule ใน POLICIES)
+            if fee <= 0:
+                report.skipped += 1
+            elif account.available < fee:
+                report.failures.append((account.account_no, card.get_card_type(), 'Not enough balance for annual fee'))
+            else:
+                groups[type(card), fee].append(account)
+
+        stamp = time.time()
+        for (card_cls, fee), group in groups.items():
+            balances = array('d', [account.amount - fee for account in group])
+            fees = [fee] * len(group)
+            if self.__journal is not None:
+                self.__journal.record_posts([account.account_no for account in group], 'F', 'SYSTEM', 'ANNUAL_FEE',
+                                            fees, balances, stamp)
+            for account, balance in zip(group, balances):
+                account.amount = balance
+            Ledger.post_many([account.ledger for account in group], 'F', 'SYSTEM', 'ANNUAL_FEE',
+                             fees, balances, timestamp=stamp)
+            report.add_charged(card_cls.__name__, len(group), fee * len(group))
+
+    # ========== Interest Run ==========
+
+    def run_interest(self, early_withdrawal_accounts=()):
+        """ลงดอกเบี้ยสิ้นเดือนให้ทุกบัญชีในธนาคารในรอบเดียว
+
+        จัดกลุ่มบัญชีตาม (class, interest_factor) แล้วคำนวณทั้งกลุ่มเป็น column
+        (balances * factor) ก่อนเขียนยอดเงินและรายการ 'I' (SYSTEM:AUTO) ด้วย timestamp เดียวกัน
+        บัญชีที่ factor = 0 (CurrentAccount) ข้ามไปเหมือน calculate_interest
+
+        Args:
+            early_withdrawal_accounts: account_no ของ FixedAccount ที่ถอนก่อนกำหนด
+                (ได้ดอกเบี้ย * EARLY_WITHDRAWAL_PENALTY)
+
+        Returns:
+            InterestRunResult
+        """
+        start = time.perf_counter()
+        early = set(early_withdrawal_accounts)
+        groups = defaultdict(list)
+        for account in self.__account_index.values():
+            factor = account.interest_factor(account.account_no in early)
+            if factor:
+                groups[(type(account), factor)].append(account)
+
+        result = InterestRunResult()
+        stamp = time.time()
+        for (account_cls, factor), accounts in groups.items():
+            balances = array('d', [account.amount for account in accounts])
+            interests = array('d', [balance * factor for balance in balances])
+            new_balances = array('d', [b + i for b, i in zip(balances, interests)])
+            if self.__journal is not None:
+                self.__journal.record_posts([account.account_no for account in accounts], 'I', 'SYSTEM', 'AUTO',
+                                            interests, new_balances, stamp)
+            for account, balance in zip(accounts, new_balances):
+                account.amount = balance
+            Ledger.post_many([account.ledger for account in accounts], 'I', 'SYSTEM', 'AUTO',
+                             interests, new_balances, timestamp=stamp)
+            result.add_group(account_cls.__name__, factor, len(accounts), sum(interests))
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    # ========== Batch Processing ==========
+
+    def process_batch(self, operations, channel_id='BATCH'):
+        """ประมวลผลรายการ settlement หลายรายการในรอบเดียว
+
+        Args:
+            operations: iterable ของ tuple
+                ('D', account_no, amount)              ฝาก
+                ('W', account_no, amount)              ถอน
+                ('TW', account_no, amount, target_no)  โอน (TW ต้นทาง / TD ปลายทาง)
+                ('P', account_no, amount, merchant_no) ชำระเงิน (P ผู้จ่าย / D ร้านค้า)
+            channel_id: channel id ที่บันทึกใน ledger (channel_type = 'SYSTEM')
+
+        ตรวจเหมือนเรียกทีละ method: 'W' ตรวจ _check_withdraw_limit + ยอดพอจ่าย fee ของ Policy
+        (ลงแถว 'F' ถ้า fee > 0), 'P' ไม่ตรวจวงเงินเหมือน Account.pay; ทั้ง 'W' และ 'P' นับเข้าวงเงินรายวัน
+        (รายการถัดไปใน batch เดียวกันเห็นยอดนั้นแล้ว) รายการที่ fail (รวม tuple ผิดรูปแบบ) ไม่กระทบรายการอื่น
+
+        ตอนจบเขียนทุกแถวลง journal ใน frame เดียวก่อน แล้วค่อยแก้ยอดเงิน/ledger/วงเงินของแต่ละบัญชี
+        ถ้าเขียน journal ไม่ได้จะไม่มีบัญชีไหนเปลี่ยน และทุกรายการที่ผ่านการตรวจได้ error นั้นใน BatchResult
+
+        Returns:
+            BatchResult
+        """
+        result = BatchResult()
+        add_result = result.results.append
+        start = time.perf_counter()
+        balances = {}
+        daily = {}
+        pending = defaultdict(list)
+        get_account = self.__account_index.get
+
+        for op in operations:
+            try:
+                kind, account_no, amount = op[0], op[1], op[2]
+                account = get_account(account_no)
+                if account is None: raise LookupError(f'Account {account_no} not found')
+                if amount <= 0: raise ValueError("amount need to be > 0")
+                balance = balances[account] if account in balances else account.amount
+
+                if kind == 'D':
+                    balance += amount
+                    pending[account].append(('D', amount, balance, None))
+                elif kind == 'W':
+                    fee = account._policy(None).fee
+                    account._check_withdraw_limit(daily.get(account, 0) + amount)
+                    if balance - account.held < amount + fee: raise ValueError("Not enough money in account")
+                    balance -= amount
+                    pending[account].append(('W', amount, balance, None))
+                    if fee > 0:
+                        balance -= fee
+                        pending[account].append(('F', fee, balance, None))
+                    daily[account] = daily.get(account, 0) + amount
+                elif kind == 'TW' or kind == 'P':
+                    target_no = op[3]
+                    target = get_account(target_no)
+                    if target is None: raise LookupError(f'Account {target_no} not found')
+                    if target is account: raise ValueError("target must be another account")
+                    if balance - account.held < amount: raise ValueError("Not enough money in account")
+                    if kind == 'P':
+                        daily[account] = daily.get(account, 0) + amount
+                    balance -= amount
+                    target_balance = (balances[target] if target in balances else target.amount) + amount
+                    balances[target] = target_balance
+                    pending[account].append((kind, amount, balance, target_no))
+                    pending[target].append(('TD' if kind == 'TW' else 'D', amount, target_balance, account_no))
+                else:
+                    raise ValueError(f"Unknown operation {kind}")
+                balances[account] = balance
+                add_result((op, None))
+            except (ValueError, LookupError, TypeError) as e:
+                add_result((op, e))
+
+        stamp = time.time()
+        if self.__journal is not None:
+            try:
+                self.__journal.record_many([(account.account_no, type, 'SYSTEM', channel_id, amount, balance, target, stamp)
+                                            for account in balances for type, amount, balance, target in pending[account]])
+            except Exception as e:
+                result.results = [(op, e if error is None else error) for op, error in result.results]
+                result.elapsed = time.perf_counter() - start
+                return result
+        for account, balance in balances.items():
+            account.amount = balance
+            account.ledger.extend('SYSTEM', channel_id, pending[account], timestamp=stamp)
+        for account, amount in daily.items():
+            account._add_withdraw_limit(amount)
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+class BatchResult:
+    """ผลลัพธ์ของ Bank.process_batch - หนึ่ง (operation, error) ต่อหนึ่งรายการ"""
+
+    def __init__(self):
+        self.results = []
+        self.elapsed = 0.0
+
+    @property
+    def succeeded(self):
+        return sum(1 for _, error in self.results if error is None)
+
+    @property
+    def failed(self):
+        return len(self.results) - self.succeeded
+
+    @property
+    def throughput(self):
+        """operations ต่อวินาที"""
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+    def errors(self):
+        return [(op, error) for op, error in self.results if error is not None]
+
+    def __str__(self):
+        return (f"BatchResult: {self.succeeded} ok / {self.failed} failed "
+                f"in {self.elapsed:.3f}s ({self.throughput:,.0f} ops/s)")
+
+
+class InterestRunResult:
+    """ผลลัพธ์ของ Bank.run_interest แยกตามกลุ่ม (class, factor)"""
+
+    def __init__(self):
+        self.groups = []
+        self.elapsed = 0.0
+
+    def add_group(self, account_type, factor, count, total_interest):
+        self.groups.append((account_type, factor, count, total_interest))
+
+    @property
+    def accounts(self):
+        return sum(group[2] for group in self.groups)
+
+    @property
+    def total_interest(self):
+        return sum(group[3] for group in self.groups)
+
+    @property
+    def throughput(self):
+        """accounts ต่อวินาที"""
+        return self.accounts / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"InterestRunResult: {self.accounts} accounts, interest {self.total_interest:,.2f} "
+                f"in {self.elapsed:.3f}s ({self.throughput:,.0f} accounts/s)")
+
+
+class AnnualFeeReport:
+    """ผลลัพธ์ / checkpoint ของ Bank.apply_annual_fee
+
+    Attributes:
+        position: จำนวนบัญชีใน account index ที่ประมวลผลแล้ว (จุด resume)
+        charged: card class name -> [จำนวนบัตร, ยอดค่าธรรมเนียม]
+        failures: list ของ (account_no, card type, reason)
+        skipped: จำนวนบัญชีที่ไม่มีบัตร
+    """
+
+    def __init__(self):
+        self.position = 0
+        self.charged = {}
+        self.failures = []
+        self.skipped = 0
+        self.done = False
+        self.elapsed = 0.0
+
+    def add_charged(self, card_type, count, total_fee):
+        entry = self.charged.setdefault(card_type, [0, 0])
+        entry[0] += count
+        entry[1] += total_fee
+
+    @property
+    def charged_count(self):
+        return sum(entry[0] for entry in self.charged.values())
+
+    @property
+    def total_fee(self):
+        return sum(entry[1] for entry in self.charged.values())
+
+    def to_checkpoint(self):
+        """dict ที่ json.dump ได้ สำหรับ resume ภายหลัง"""
+        return {
+            'position': self.position,
+            'charged': self.charged,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'done': self.done,
+            'elapsed': self.elapsed,
+        }
+
+    @classmethod
+    def from_checkpoint(cls, data):
+        report = cls()
+        report.position = data['position']
+        report.charged = {k: list(v) for k, v in data['charged'].items()}
+        report.failures = [tuple(f) for f in data['failures']]
+        report.skipped = data['skipped']
+        report.done = data['done']
+        report.elapsed = data['elapsed']
+        return report
+
+    def __str__(self):
+        return (f"AnnualFeeReport: {self.charged_count} charged ({self.total_fee:,.2f} THB), "
+                f"{len(self.failures)} failed, {self.skipped} without card, position {self.position}"
+                f"{' (done)' if self.done else ''}")
+
+
+class User:
+    """ผู้ใช้บริการธนาคาร"""
+
+    __slots__ = ('__citizen_id', '__name', '__account_list', '__bank')
+    
+    def __init__(self, citizen_id, name):
+        self.__citizen_id = citizen_id
+        self.__name = name
+        self.__account_list = []
+        self.__bank = None
+    
+    def add_account(self, account):
+        if not isinstance(account, Account): raise TypeError("account type error")
+        if account in self.__account_list: raise ValueError("Already have this account")
+        if self.__bank is not None:
+            self.__bank._register_account(account)
+        self.__account_list.append(account)
+        emit_event('account_added', "Done Add account", citizen_id=self.__citizen_id, account_no=account.account_no)
+
+    def _attach_bank(self, bank):
+        self.__bank = bank
+    
+    def search_account_from_card(self, card_no):
+        for account in self.__account_list:
+            if account.card != None and account.card.card_no == card_no:
+                return account
+        return None
+    
+    def get_all_accounts(self):
+        return self.__account_list
+
+    def check_citizen_id(self, citizen_id):
+        return citizen_id == self.__citizen_id
+    
+    @property
+    def citizen_id(self):
+        return self.__citizen_id
+    
+    @property
+    def name(self):
+        return self.__name
+    
+    @property
+    def bank(self):
+        return self.__bank
+
+
+
+class Transaction:
+    """รายการทำธุรกรรม
+    
+    Transaction Types:
+        D  = Deposit (ฝากเงิน)
+        W  = Withdraw (ถอนเงิน)
+        TW = Transfer Withdraw (โอนออก)
+        TD = Transfer Deposit (รับโอน)
+        I  = Interest/Cashback (ดอกเบี้ย/เครดิตคืน)
+        P  = Payment (ชำระเงินผ่าน EDC)
+        F  = Fee (ค่าธรรมเนียม)
+
+    Account ledgers store rows in a columnar Ledger; this class is the
+    standalone record (e.g. from LedgerView.to_transaction()).
+    """
+
+    __slots__ = ('__type', '__channel_type', '__channel_id', '__amount', '__balance', '__target', '__timestamp')
+    
+    def __init__(self, type, channel_type, channel_id, amount, balance, target=None, timestamp=None):
+        """TODO:
+        - เก็บ type, channel_type, channel_id
+        - เก็บ amount, balance, target
+        - เก็บ timestamp = datetime.now()
+        """
+        self.__type = type
+        self.__channel_type = channel_type
+        self.__channel_id = channel_id
+        self.__amount = amount
+        self.__balance = balance
+        self.__target = target
+        self.__timestamp = timestamp if timestamp is not None else datetime.now()
+    
+    def __str__(self):
+        return _format_transaction(self)
+    
+    @property
+    def type(self):
+        return self.__type
+    
+    @property
+    def amount(self):
+        return self.__amount
+    
+    @property
+    def channel_type(self):
+        return self.__channel_type
+    
+    @property
+    def channel_id(self):
+        return self.__channel_id
+    
+    @property
+    def balance(self):
+        return self.__balance
+    
+    @property
+    def target(self):
+        return self.__target
+    
+    @property
+    def timestamp(self):
+        return self.__timestamp
+
+
+def _format_transaction(t):
+    base = f"{t.type}-{t.channel_type}:{t.channel_id}-{t.amount:.2f}-{t.balance:.2f}"
+    if t.target is None:
+        return base
+    return f"{base}-{t.target}"
+
+
+# ============================================================================
+# LEDGER - columnar transaction storage
+# ============================================================================
+
+class StringPool:
+    """Intern table: string <-> small int id (ใช้ร่วมกันทุก Ledger)"""
+
+    def __init__(self):
+        self.__ids = {}
+        self.__values = []
+        self.__lock = threading.Lock()
+
+    def intern(self, value):
+        idx = self.__ids.get(value)
+        if idx is None:
+            with self.__lock:
+                idx = self.__ids.get(value)
+                if idx is None:
+                    idx = len(self.__values)
+                    self.__values.append(value)
+                    self.__ids[value] = idx
+        return idx
+
+    def get(self, idx):
+        return self.__values[idx]
+
+    def find(self, value):
+        """id ของ value หรือ None ถ้ายังไม่เคย intern (ไม่เพิ่มเข้า pool)"""
+        return self.__ids.get(value)
+
+    def values(self):
+        return list(self.__values)
+
+    def __len__(self):
+        return len(self.__values)
+
+
+class Ledger:
+    """ประวัติธุรกรรมของบัญชี เก็บแบบ column ใน typed array
+
+    Columns (หนึ่ง index ต่อหนึ่งรายการ):
+        type: array('B') - index ใน TYPE_CODES
+        channel_type, channel_id, target: array('i') - id ใน STRINGS (-1 = None)
+        amount, balance: array('d')
+        timestamp: array('d') - epoch seconds
+    """
+
+    TYPE_CODES = ('D', 'W', 'TW', 'TD', 'I', 'P', 'F')
+    TYPE_INDEX = {code: i for i, code in enumerate(TYPE_CODES)}
+    COLUMNS = ('type', 'channel_type', 'channel_id', 'amount', 'balance', 'target', 'timestamp')
+    STRINGS = StringPool()
+    _ATTRS = {name: f'_Ledger__{name}' for name in COLUMNS}
+    _STRING_COLUMNS = frozenset(('channel_type', 'channel_id', 'target'))
+    __slots__ = tuple(f'__{name}' for name in COLUMNS) + ('__index',)
+
+    def __init__(self):
+        self.__type = array('B')
+        self.__channel_type = array('i')
+        self.__channel_id = array('i')
+        self.__amount = array('d')
+        self.__balance = array('d')
+        self.__target = array('i')
+        self.__timestamp = array('d')
+        self.__index = None
+
+    @property
+    def index(self):
+        """Secondary index (type / channel_id / timestamp) - สร้างเมื่อ query ครั้งแรก"""
+        if self.__index is None:
+            self.__index = LedgerIndex(self)
+        return self.__index
+
+    def query(self, type=None, channel_id=None, start=None, end=None, offset=0, limit=None, newest_first=False):
+        """Iterator ของ LedgerView ที่ตรงเงื่อนไข - ดู LedgerIndex.query"""
+        return self.index.query(type, channel_id, start, end, offset, limit, newest_first)
+
+    def append(self, type, channel_type, channel_id, amount, balance, target=None, timestamp=None):
+        intern = self.STRINGS.intern
+        self.__type.append(self.TYPE_INDEX[type])
+        self.__channel_type.append(intern(channel_type))
+        self.__channel_id.append(intern(channel_id))
+        self.__amount.append(amount)
+        self.__balance.append(balance)
+        self.__target.append(-1 if target is None else intern(target))
+        self.__timestamp.append(time.time() if timestamp is None else timestamp)
+
+    def extend(self, channel_type, channel_id, rows, timestamp=None):
+        """Bulk append rows of (type, amount, balance, target) from one channel"""
+        rows = rows if isinstance(rows, list) else list(rows)
+        intern = self.STRINGS.intern
+        type_index = self.TYPE_INDEX
+        n = len(rows)
+        self.__type.extend([type_index[r[0]] for r in rows])
+        self.__channel_type.extend([intern(channel_type)] * n)
+        self.__channel_id.extend([intern(channel_id)] * n)
+        self.__amount.extend([r[1] for r in rows])
+        self.__balance.extend([r[2] for r in rows])
+        self.__target.extend([-1 if r[3] is None else intern(r[3]) for r in rows])
+        self.__timestamp.extend([time.time() if timestamp is None else timestamp] * n)
+
+    @classmethod
+    def post_many(cls, ledgers, type, channel_type, channel_id, amounts, balances, timestamp=None):
+        """ลงรายการแบบเดียวกัน (เช่น 'I' SYSTEM:AUTO) ให้หลาย ledger - intern ครั้งเดียว"""
+        type_code = cls.TYPE_INDEX[type]
+        channel_type_id = cls.STRINGS.intern(channel_type)
+        channel_id_id = cls.STRINGS.intern(channel_id)
+        stamp = time.time() if timestamp is None else timestamp
+        for ledger, amount, balance in zip(ledgers, amounts, balances):
+            ledger.__type.append(type_code)
+            ledger.__channel_type.append(channel_type_id)
+            ledger.__channel_id.append(channel_id_id)
+            ledger.__amount.append(amount)
+            ledger.__balance.append(balance)
+            ledger.__target.append(-1)
+            ledger.__timestamp.append(stamp)
+
+    def __len__(self):
+        return len(self.__type)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [LedgerView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ledger index out of range')
+        return LedgerView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield LedgerView(self, i)
+
+    def last(self):
+        return LedgerView(self, len(self) - 1) if len(self) else None
+
+    def row(self, index):
+        """คืน tuple (type, channel_type, channel_id, amount, balance, target, timestamp)"""
+        get = self.STRINGS.get
+        target = self.__target[index]
+        return (self.TYPE_CODES[self.__type[index]],
+                get(self.__channel_type[index]),
+                get(self.__channel_id[index]),
+                self.__amount[index],
+                self.__balance[index],
+                None if target < 0 else get(target),
+                self.__timestamp[index])
+
+    def value(self, index, name):
+        """ค่าของ column เดียวในแถว index (decode type code / string id แล้ว)"""
+        raw = getattr(self, self._ATTRS[name])[index]
+        if name == 'type':
+            return self.TYPE_CODES[raw]
+        if name in self._STRING_COLUMNS:
+            return None if raw < 0 else self.STRINGS.get(raw)
+        return raw
+
+    def column(self, name):
+        """Read-only memoryview ของ column ดิบ (ไม่ copy)"""
+        if name not in self._ATTRS: raise KeyError(name)
+        return memoryview(getattr(self, self._ATTRS[name])).toreadonly()
+
+    def _raw(self, name):
+        """array ภายในของ column (ไม่ copy, ห้ามแก้) - ต่างจาก column() ตรงที่ไม่ export buffer
+        จึงไม่ทำให้ append ของ thread อื่นชน BufferError"""
+        return getattr(self, self._ATTRS[name])
+
+    def export_columns(self):
+        """dict column name -> bytes (string columns เป็น id ใน STRINGS ของ process นี้)"""
+        return {name: getattr(self, attr).tobytes() for name, attr in self._ATTRS.items()}
+
+    def load_columns(self, columns, string_map=None):
+        """เติม rows จาก export_columns(); string_map แปลง id เดิม -> id ใน STRINGS ปัจจุบัน"""
+        loaded = {}
+        for name, attr in self._ATTRS.items():
+            values = array(getattr(self, attr).typecode)
+            values.frombytes(columns[name])
+            if string_map is not None and name in self._STRING_COLUMNS:
+                values = array('i', [string_map[v] for v in values])
+            loaded[attr] = values
+        if len({len(values) for values in loaded.values()}) > 1:
+            raise ValueError('ledger columns have different lengths')
+        for attr, values in loaded.items():
+            getattr(self, attr).extend(values)
+
+    def nbytes(self):
+        """Bytes used by the column buffers (ไม่รวม StringPool ที่ใช้ร่วมกัน)"""
+        return sum(sys.getsizeof(getattr(self, attr)) for attr in self._ATTRS.values())
+
+
+class LedgerView:
+    """มุมมองหนึ่งแถวใน Ledger - property เหมือน Transaction แต่ไม่ copy ข้อมูล"""
+
+    __slots__ = ('_ledger', '_index')
+
+    def __init__(self, ledger, index):
+        self._ledger = ledger
+        self._index = index
+
+    def __str__(self):
+        return _format_transaction(self)
+
+    def __repr__(self):
+        return f"LedgerView({self})"
+
+    @property
+    def type(self):
+        return self._ledger.value(self._index, 'type')
+
+    @property
+    def channel_type(self):
+        return self._ledger.value(self._index, 'channel_type')
+
+    @property
+    def channel_id(self):
+        return self._ledger.value(self._index, 'channel_id')
+
+    @property
+    def amount(self):
+        return self._ledger.value(self._index, 'amount')
+
+    @property
+    def balance(self):
+        return self._ledger.value(self._index, 'balance')
+
+    @property
+    def target(self):
+        return self._ledger.value(self._index, 'target')
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self._ledger.value(self._index, 'timestamp'))
+
+    def to_transaction(self):
+        type, channel_type, channel_id, amount, balance, target, ts = self._ledger.row(self._index)
+        return Transaction(type, channel_type, channel_id, amount, balance, target,
+                           timestamp=datetime.fromtimestamp(ts))
+
+
+
+class LedgerIndex:
+    """Secondary index ของ Ledger หนึ่งตัว
+
+    posting lists (array('I') ของตำแหน่งแถว เรียงจากเก่าไปใหม่):
+        type -> rows, channel_id -> rows, (type, channel_id) -> rows
+    ช่วงเวลาใช้ bisect บน timestamp ของ posting list (timestamp ใน ledger เรียงตามเวลาอยู่แล้ว)
+    ดังนั้น query หนึ่งครั้ง = O(log n + ขนาดผลลัพธ์)
+
+    Index ตามทันแบบ lazy: append ไม่แตะ index เลย ตอน query จะ index เฉพาะแถวที่เพิ่มมาใหม่
+    ถ้า timestamp ไม่เรียง (เช่น load จากแหล่งอื่น) ช่วงเวลาจะ fallback เป็นการกรองทีละแถว
+    """
+
+    def __init__(self, ledger):
+        self.__ledger = ledger
+        self.__by_type = defaultdict(lambda: array('I'))
+        self.__by_channel = defaultdict(lambda: array('I'))
+        self.__by_type_channel = defaultdict(lambda: array('I'))
+        self.__indexed = 0
+        self.__last_timestamp = float('-inf')
+        self.__sorted = True
+        self.__lock = threading.Lock()
+
+    def refresh(self):
+        """Index แถวที่เพิ่มเข้ามาตั้งแต่ครั้งก่อน; คืนจำนวนแถวที่ index แล้วทั้งหมด"""
+        with self.__lock:
+            ledger = self.__ledger
+            start, stop = self.__indexed, len(ledger)
+            if start == stop:
+                return stop
+            types = ledger._raw('type')
+            channels = ledger._raw('channel_id')
+            timestamps = ledger._raw('timestamp')
+            by_type, by_channel, by_type_channel = self.__by_type, self.__by_channel, self.__by_type_channel
+            last, is_sorted = self.__last_timestamp, self.__sorted
+            for i in range(start, stop):
+                type, channel = types[i], channels[i]
+                by_type[type].append(i)
+                by_channel[channel].append(i)
+                by_type_channel[type, channel].append(i)
+                if is_sorted:
+                    ts = timestamps[i]
+                    if ts < last:
+                        is_sorted = False
+                    last = ts
+            self.__indexed, self.__last_timestamp, self.__sorted = stop, last, is_sorted
+            return stop
+
+    def _positions(self, type=None, channel_id=None):
+        """posting list ของเงื่อนไข (range ถ้าไม่มีเงื่อนไข, tuple ว่างถ้าไม่มีแถวตรงเลย)"""
+        stop = self.refresh()
+        if type is not None:
+            if type not in Ledger.TYPE_INDEX: raise ValueError(f'Unknown transaction type {type!r}')
+            type = Ledger.TYPE_INDEX[type]
+        if channel_id is not None:
+            channel_id = Ledger.STRINGS.find(channel_id)
+            if channel_id is None:
+                return ()
+        if type is not None and channel_id is not None:
+            return self.__by_type_channel.get((type, channel_id), ())
+        if type is not None:
+            return self.__by_type.get(type, ())
+        if channel_id is not None:
+            return self.__by_channel.get(channel_id, ())
+        return range(stop)
+
+    def _span(self, positions, start, end):
+        """[lo, hi) ใน positions ที่ timestamp อยู่ใน [start, end)"""
+        lo, hi = 0, len(positions)
+        if not self.__sorted or (start is None and end is None):
+            return lo, hi
+        key = self.__ledger._raw('timestamp').__getitem__
+        if start is not None:
+            lo = bisect_left(positions, _epoch(start), key=key)
+        if end is not None:
+            hi = bisect_left(positions, _epoch(end), lo, key=key)
+        return lo, hi
+
+    def query(self, type=None, channel_id=None, start=None, end=None, offset=0, limit=None, newest_first=False):
+        """Iterator ของ LedgerView ตาม type / channel_id / ช่วงเวลา [start, end)
+
+        start/end เป็น datetime หรือ epoch seconds; offset/limit ใช้แบ่งหน้า
+        (หน้าแรกของ newest_first คือรายการล่าสุด)
+        """
+        if offset < 0 or (limit is not None and limit < 0): raise ValueError('offset/limit must be >= 0')
+        positions = self._positions(type, channel_id)
+        ledger = self.__ledger
+        if not self.__sorted and (start is not None or end is not None):
+            timestamps = ledger._raw('timestamp')
+            lower = float('-inf') if start is None else _epoch(start)
+            upper = float('inf') if end is None else _epoch(end)
+            rows = (i for i in (reversed(positions) if newest_first else positions) if lower <= timestamps[i] < upper)
+            rows = islice(rows, offset, None if limit is None else offset + limit)
+            return (LedgerView(ledger, i) for i in rows)
+
+        lo, hi = self._span(positions, start, end)
+        if newest_first:
+            hi -= offset
+            lo = max(lo, hi - limit) if limit is not None else lo
+            order = range(hi - 1, lo - 1, -1)
+        else:
+            lo += offset
+            hi = min(hi, lo + limit) if limit is not None else hi
+            order = range(lo, hi)
+        return (LedgerView(ledger, positions[k]) for k in order)
+
+    def count(self, type=None, channel_id=None, start=None, end=None):
+        """จำนวนแถวที่ตรงเงื่อนไข (ใช้คำนวณจำนวนหน้า)"""
+        positions = self._positions(type, channel_id)
+        if not self.__sorted and (start is not None or end is not None):
+            return sum(1 for _ in self.query(type, channel_id, start, end))
+        lo, hi = self._span(positions, start, end)
+        return hi - lo
+
+
+def _epoch(value):
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+
+
+# ============================================================================
+# JOURNAL & SNAPSHOT - write-ahead log ของการเปลี่ยนยอดเงิน
+# ============================================================================
+
+_ACCOUNT_CLASSES = {cls.__name__: cls for cls in (SavingAccount, FixedAccount, CurrentAccount)}
+_CARD_CLASSES = {cls.__name__: cls for cls in (ATM_Card, DebitCard, PremiumCard, ShoppingCard)}
+
+
+def _restore_card(state):
+    card = _CARD_CLASSES[state['class']](state['card_no'], state['account_no'], None)
+    card._load_pin_record(state['pin_salt'], state['pin_hash'], state['pin_iterations'])
+    if state.get('cashback'):
+        card._add_cashback(state['cashback'])
+    return card
+
+
+def _restore_account(bank, state):
+    """สร้าง (หรืออัปเดต) บัญชีจาก Account._export_state() แล้วใส่เข้า bank"""
+    account = bank.get_account_by_no(state['account_no'])
+    if account is None:
+        user = bank.get_user_by_citizen_id(state['citizen_id'])
+        if user is None:
+            user = User(state['citizen_id'], state['user_name'])
+            bank.add_user(user)
+        cls = _ACCOUNT_CLASSES[state['class']]
+        if cls is FixedAccount:
+            account = cls(state['account_no'], user, state['amount'], term_months=state['term_months'],
+                          start_date=datetime.fromtimestamp(state['start_date']))
+        else:
+            account = cls(state['account_no'], user, state['amount'])
+        user.add_account(account)
+    if state['card'] is not None and (account.card is None or account.card.card_no != state['card']['card_no']):
+        account.add_card(_restore_card(state['card']))
+    return account
+
+
+class BankJournal:
+    """Append-only binary journal ของทุกรายการที่เปลี่ยนยอดเงิน (D, W, TW, TD, I, P, F)
+    พร้อม snapshot เป็นระยะ
+
+    ไฟล์ใน directory:
+        snapshot-<seq>.bin  สถานะทั้งธนาคาร (users, accounts, cards, ledgers) ตอนเริ่ม segment
+        journal-<seq>.log   รายการหลัง snapshot-<seq> เท่านั้น
+
+    Journal เป็น frame ต่อกัน (header = tag 1 byte + uint32):
+        b'S' n    : n string definitions (uint32 id, uint16 len, utf-8) - id ใช้ภายใน segment
+        b'N' len  : pickle ของ Account._export_state() (บัญชี/บัตรใหม่หลัง snapshot)
+        b'T' n    : n records แบบ fixed-size (RECORD) ของ ledger row
+        b'E' n    : n ยอดขาย (SALE = RECORD แถว P ของผู้ซื้อ + batch_id) ที่เข้า pending batch ของ EDC
+                    แบบ settlement - ยังไม่อยู่ในบัญชีร้านค้า; เงินออกจากผู้ซื้อกับยอดรอเข้าร้านค้าอยู่ frame เดียวกัน
+
+    snapshot เก็บ batch ของ EDC ที่ยังไม่เข้าบัญชีร้านค้าด้วย; ตอน recover batch ที่ไม่มีรายการ 'D'
+    (target = batch_id) ของร้านค้าตามมาจะถูกเข้าบัญชีร้านค้าทันที ยอดรวมทั้งธนาคารจึงไม่หาย
+
+    ลำดับการเขียน: Account._create_transaction / _create_transactions และ process_batch, run_interest,
+    apply_annual_fee เขียน journal ก่อนแล้วค่อยแก้ ledger + ยอดใน memory - เขียนไม่ได้ = บัญชีไม่เปลี่ยน
+    (โอนในธนาคารเขียน TW + TD เป็น frame เดียว) ส่วนความทนทานขึ้นกับ sync_every ดู start()
+
+    ใช้งาน:
+        journal = BankJournal.start(directory, bank)   # snapshot แรก + เปิด journal
+        ...
+        bank, stats = BankJournal.recover(directory)   # snapshot ล่าสุด + replay journal
+    """
+
+    RECORD = struct.Struct('<IBIIddid')  # account, type, channel_type, channel_id, amount, balance, target, ts
+    SALE = struct.Struct('<IBIIddidI')  # RECORD (target = ร้านค้า) + batch_id
+    HEADER = struct.Struct('<cI')
+    STRING = struct.Struct('<IH')
+
+    def __init__(self, directory, bank, seq, sync_every=0, snapshot_every=0):
+        self.__directory = directory
+        self.__bank = bank
+        self.__seq = seq
+        self.__sync_every = sync_every
+        self.__snapshot_every = snapshot_every
+        self.__lock = threading.RLock()
+        self.__file = None
+        self.__strings = {}
+        self.__unsynced = 0
+        self.__records = 0
+        self.__open_segment()
+
+    # ========== Lifecycle ==========
+
+    @classmethod
+    def start(cls, directory, bank, sync_every=0, snapshot_every=0):
+        """เขียน snapshot ของ bank แล้วเริ่ม journal segment ใหม่ต่อจาก seq ล่าสุดใน directory
+
+        Args:
+            sync_every: flush + fsync ทุก ๆ กี่ records (0 = เฉพาะตอน sync()/snapshot()/close())
+                ระหว่างนั้น record อยู่ใน buffer 1 MiB ของ process - process ตายก็หายได้
+                ต้องการให้ทุกรายการที่ตอบลูกค้าแล้วรอด crash ให้ใช้ sync_every=1 (ช้าลงตาม fsync)
+            snapshot_every: ตั้ง snapshot_due เมื่อ segment ยาวเกินกี่ records (0 = ไม่ตั้ง)
+                snapshot() ไม่ถูกเรียกจากใน record() - pickle ทั้งธนาคารใน request จะค้างทุกรายการ
+                และต้องไม่มี session แก้ยอดระหว่าง snapshot เหมือน bulk job อื่นของ Bank
+        """
+        os.makedirs(directory, exist_ok=True)
+        seq = cls._latest_seq(directory, 'snapshot') + 1
+        cls._write_snapshot(directory, seq, bank)
+        journal = cls(directory, bank, seq, sync_every, snapshot_every)
+        bank.attach_journal(journal)
+        return journal
+
+    def snapshot(self):
+        """Compact: เขียน snapshot ใหม่ เริ่ม segment ใหม่ แล้วลบ segment เก่า"""
+        with self.__lock:
+            self.sync()
+            self.__file.close()
+            self.__seq += 1
+            self._write_snapshot(self.__directory, self.__seq, self.__bank)
+            self.__open_segment()
+            for name in os.listdir(self.__directory):
+                kind, seq = self._parse_name(name)
+                if kind is not None and seq < self.__seq:
+                    os.remove(os.path.join(self.__directory, name))
+
+    def sync(self):
+        with self.__lock:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__unsynced = 0
+
+    def close(self):
+        with self.__lock:
+            self.sync()
+            self.__file.close()
+            if self.__bank.journal is self:
+                self.__bank.attach_journal(None)
+
+    @property
+    def seq(self):
+        return self.__seq
+
+    @property
+    def records(self):
+        """จำนวน records (ledger rows, ยอดขาย, บัญชีใหม่) ที่เขียนใน segment ปัจจุบัน"""
+        return self.__records
+
+    @property
+    def snapshot_due(self):
+        """segment ปัจจุบันยาวถึง snapshot_every แล้ว - ให้งานปิดวัน/งาน maintenance เรียก snapshot()"""
+        return bool(self.__snapshot_every) and self.__records >= self.__snapshot_every
+
+    # ========== Recording (เรียกโดย Account/Bank) ==========
+
+    def record(self, account_no, type, channel_type, channel_id, amount, balance, target, timestamp):
+        with self.__lock:
+            self.__write_records([(account_no, type, channel_type, channel_id, amount, balance, target, timestamp)])
+
+    def record_many(self, records):
+        """records เต็มรูป (account_no, type, channel_type, channel_id, amount, balance, target, ts)
+        ของหลายบัญชีในครั้งเดียว เช่น TW + TD ของการโอน"""
+        with self.__lock:
+            self.__write_records(records)
+
+    def record_rows(self, account_no, channel_type, channel_id, rows, timestamp):
+        """rows ของ (type, amount, balance, target) จากบัญชีเดียว/ช่องทางเดียว"""
+        with self.__lock:
+            self.__write_records([(account_no, type, channel_type, channel_id, amount, balance, target, timestamp)
+                                  for type, amount, balance, target in rows])
+
+    def record_posts(self, account_nos, type, channel_type, channel_id, amounts, balances, timestamp):
+        """รายการแบบเดียวกันหลายบัญชี (interest run, annual fee)"""
+        with self.__lock:
+            self.__write_records([(account_no, type, channel_type, channel_id, amount, balance, None, timestamp)
+                                  for account_no, amount, balance in zip(account_nos, amounts, balances)])
+
+    def record_sale(self, account_no, type, channel_type, channel_id, amount, balance, target, timestamp, batch_id):
+        """แถว P ของผู้ซื้อ + ยอดขายที่เข้า pending batch ของ EDC (target = ร้านค้า) ใน frame เดียว
+        replay เจอทั้งคู่หรือไม่เจอเลย - เงินที่ออกจากผู้ซื้อจะมียอดรอเข้าร้านค้าเสมอ"""
+        with self.__lock:
+            new_strings = []
+            sid = partial(self.__sid, new_strings=new_strings)
+            frame = self.HEADER.pack(b'E', 1) + self.SALE.pack(
+                sid(account_no), Ledger.TYPE_INDEX[type], sid(channel_type), sid(channel_id),
+                amount, balance, sid(target), timestamp, sid(batch_id))
+            self.__append(new_strings, frame, 1)
+
+    def record_account(self, account):
+        """บันทึกบัญชีใหม่ / บัตรใหม่ที่เกิดหลัง snapshot"""
+        payload = pickle.dumps(account._export_state(), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.__lock:
+            self.__append((), self.HEADER.pack(b'N', len(payload)) + payload, 1)
+
+    def __sid(self, value, new_strings):
+        if value is None:
+            return -1
+        strings = self.__strings
+        idx = strings.get(value)
+        if idx is None:
+            idx = strings[value] = len(strings)
+            new_strings.append((idx, value))
+        return idx
+
+    def __write_strings(self, new_strings):
+        if new_strings:
+            parts = [self.HEADER.pack(b'S', len(new_strings))]
+            for idx, value in new_strings:
+                encoded = str(value).encode('utf-8')
+                parts.append(self.STRING.pack(idx, len(encoded)) + encoded)
+            self.__file.write(b''.join(parts))
+
+    def __write_records(self, rows):
+        new_strings = []
+        sid = partial(self.__sid, new_strings=new_strings)
+        type_index = Ledger.TYPE_INDEX
+        pack = self.RECORD.pack
+        body = b''.join([pack(sid(account_no), type_index[type], sid(channel_type), sid(channel_id),
+                              amount, balance, sid(target), timestamp)
+                         for account_no, type, channel_type, channel_id, amount, balance, target, timestamp in rows])
+        self.__append(new_strings, self.HEADER.pack(b'T', len(rows)) + body, len(rows))
+
+    def __append(self, new_strings, frame, count):
+        """เขียน frame (ตามหลัง string ใหม่ที่ frame อ้างถึง) แล้วนับเข้า records / sync_every"""
+        self.__write_strings(new_strings)
+        self.__file.write(frame)
+        self.__records += count
+        self.__unsynced += count
+        if self.__sync_every and self.__unsynced >= self.__sync_every:
+            self.sync()
+
+    def __open_segment(self):
+        path = os.path.join(self.__directory, f'journal-{self.__seq}.log')
+        self.__file = open(path, 'ab', buffering=1 << 20)
+        self.__strings = {}
+        self.__records = 0
+        self.__unsynced = 0
+
+    # ========== Snapshot files ==========
+
+    @staticmethod
+    def _parse_name(name):
+        for kind, suffix in (('snapshot', '.bin'), ('journal', '.log')):
+            if name.startswith(kind + '-') and name.endswith(suffix):
+                seq = name[len(kind) + 1:-len(suffix)]
+                if seq.isdigit():
+                    return kind, int(seq)
+        return None, -1
+
+    @classmethod
+    def _latest_seq(cls, directory, kind):
+        seqs = [seq for k, seq in map(cls._parse_name, os.listdir(directory)) if k == kind]
+        return max(seqs, default=-1)
+
+    @staticmethod
+    def _write_snapshot(directory, seq, bank):
+        accounts = []
+        for account in bank.get_all_accounts():
+            state = account._export_state()
+            state['ledger'] = account.ledger.export_columns()
+            accounts.append(state)
+        settlements = [(edc.get_id, batch.batch_id, edc.merchant.account_no, batch._export_sales())
+                       for edc in bank.channels.of_type(EDC_machine.TYPE).values()
+                       for batch in edc._unsettled_batches()]
+        data = {'seq': seq, 'bank': bank.name, 'created': time.time(),
+                'strings': Ledger.STRINGS.values(), 'accounts': accounts, 'settlements': settlements}
+        path = os.path.join(directory, f'snapshot-{seq}.bin')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    # ========== Recovery ==========
+
+    @classmethod
+    def recover(cls, directory):
+        """โหลด snapshot ล่าสุดแล้ว replay journal ของ segment นั้น
+
+        Returns:
+            (bank, stats) - stats: dict seq, accounts, replayed, settled_batches, snapshot_seconds, replay_seconds
+            settled_batches = batch ของ EDC ที่ค้างอยู่ตอน crash แล้วถูกเข้าบัญชีร้านค้าตอน recover
+        """
+        seq = cls._latest_seq(directory, 'snapshot')
+        if seq < 0: raise FileNotFoundError(f'No snapshot in {directory}')
+        previous_sink = set_event_sink(NullSink())
+        try:
+            start = time.perf_counter()
+            with open(os.path.join(directory, f'snapshot-{seq}.bin'), 'rb') as f:
+                data = pickle.load(f)
+            bank = Bank(data['bank'])
+            string_map = [Ledger.STRINGS.intern(value) for value in data['strings']]
+            if string_map == list(range(len(string_map))):
+                string_map = None
+            else:
+                string_map.append(-1)  # target = -1 (None) ต้อง map เป็น -1
+            for state in data['accounts']:
+                account = _restore_account(bank, state)
+                account.ledger.load_columns(state['ledger'], string_map)
+            snapshot_seconds = time.perf_counter() - start
+
+            open_batches = {}  # batch_id -> [channel_id, merchant_no, total]
+            for channel_id, batch_id, merchant_no, sales in data.get('settlements', ()):
+                open_batches[batch_id] = [channel_id, merchant_no, sum(amount for _, amount, _ in sales)]
+            settled = set()
+
+            start = time.perf_counter()
+            replayed = cls._replay(os.path.join(directory, f'journal-{seq}.log'), bank, open_batches, settled)
+            settled_batches = cls._settle_open_batches(bank, open_batches, settled)
+            replay_seconds = time.perf_counter() - start
+        finally:
+            set_event_sink(previous_sink)
+        stats = {'seq': seq, 'accounts': bank.get_account_count(), 'replayed': replayed,
+                 'settled_batches': settled_batches,
+                 'snapshot_seconds': snapshot_seconds, 'replay_seconds': replay_seconds}
+        return bank, stats
+
+    @classmethod
+    def _replay(cls, path, bank, open_batches, settled):
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        strings = {}
+        type_codes = Ledger.TYPE_CODES
+        header_size, record_size, string_size = cls.HEADER.size, cls.RECORD.size, cls.STRING.size
+        sale_size = cls.SALE.size
+        pos, replayed, end = 0, 0, len(data)
+        while pos + header_size <= end:
+            tag, n = cls.HEADER.unpack_from(data, pos)
+            body = pos + header_size
+            if tag == b'S':
+                for _ in range(n):
+                    if body + string_size > end: return replayed  # frame ขาด (crash ระหว่างเขียน)
+                    idx, length = cls.STRING.unpack_from(data, body)
+                    strings[idx] = data[body + string_size:body + string_size + length].decode('utf-8')
+                    body += string_size + length
+                if body > end: return replayed
+                pos = body
+            elif tag == b'N':
+                if body + n > end: return replayed
+                _restore_account(bank, pickle.loads(data[body:body + n]))
+                pos = body + n
+            elif tag == b'T':
+                if body + n * record_size > end: return replayed
+                cls._apply_records(bank, cls.RECORD.iter_unpack(data[body:body + n * record_size]),
+                                   strings, type_codes, settled)
+                replayed += n
+                pos = body + n * record_size
+            elif tag == b'E':
+                if body + n * sale_size > end: return replayed
+                sales = list(cls.SALE.iter_unpack(data[body:body + n * sale_size]))
+                cls._apply_records(bank, [sale[:-1] for sale in sales], strings, type_codes, settled)
+                for sale in sales:
+                    batch = open_batches.setdefault(strings[sale[8]], [strings[sale[3]], strings[sale[6]], 0.0])
+                    batch[2] += sale[4]
+                replayed += n
+                pos = body + n * sale_size
+            else:
+                raise ValueError(f'Corrupt journal frame {tag!r} at offset {pos}')
+        return replayed
+
+    @staticmethod
+    def _apply_records(bank, records, strings, type_codes, settled):
+        # รายการจาก record_rows/_create_transaction มาเป็นช่วงที่บัญชี/ช่องทาง/เวลาเดียวกัน -> Ledger.extend ทีละช่วง
+        for (account_id, channel_type, channel_id, ts), run in groupby(records, key=itemgetter(0, 2, 3, 7)):
+            account = bank.get_account_by_no(strings[account_id])
+            rows = [(type_codes[r[1]], r[4], r[5], None if r[6] < 0 else strings[r[6]]) for r in run]
+            account.ledger.extend(strings[channel_type], strings[channel_id], rows, timestamp=ts)
+            account.amount = rows[-1][2]
+            if strings[channel_type] == EDC_machine.TYPE:
+                settled.update(row[3] for row in rows if row[0] == 'D')  # ร้านค้าได้ batch นี้แล้ว
+                cashback = sum(row[1] for row in rows if row[0] == 'I')
+                if cashback and account.card is not None:
+                    account.card._add_cashback(cashback)  # ยอดสะสมบนบัตร (snapshot มีถึงตอนเริ่ม segment)
+
+    @staticmethod
+    def _settle_open_batches(bank, open_batches, settled):
+        """batch ที่ตัดเงินผู้ซื้อไปแล้วแต่ยังไม่เข้าบัญชีร้านค้าตอน crash -> เข้าบัญชีร้านค้าเลย; คืนจำนวน batch"""
+        stamp, count = time.time(), 0
+        for batch_id, (channel_id, merchant_no, total) in open_batches.items():
+            if batch_id in settled or total <= 0:
+                continue
+            merchant = bank.get_account_by_no(merchant_no)
+            merchant.amount += total
+            merchant.ledger.extend(EDC_machine.TYPE, channel_id, [('D', total, merchant.amount, batch_id)], timestamp=stamp)
+            count += 1
+        return count
+
+
+
+# ============================================================================
+# STATEMENT EXPORT - stream ledger ออกไฟล์ทีละ chunk (หน่วยความจำคงที่)
+# ============================================================================
+
+class StatementExporter:
+    """เขียน statement ของบัญชีเป็น CSV, JSON Lines หรือ binary ทีละ chunk_rows แถว
+
+    ทุก format มี account_no ในทุกแถว/frame จึงต่อหลายบัญชีในไฟล์เดียวได้
+        csv   : header ครั้งเดียว + account_no,type,channel_type,channel_id,amount,balance,target,timestamp
+        jsonl : หนึ่ง object ต่อบรรทัด (key เดียวกับ csv)
+        binary: MAGIC ครั้งเดียว แล้วเป็น frame ต่อ chunk
+                b'S' uint32 n + (uint32 id, uint16 len, utf-8) - string ที่ยังไม่เคยเขียนในไฟล์นี้
+                b'R' uint32 n + uint16 len + account_no + column bytes ตาม Ledger.COLUMNS
+    timestamp ใน csv/jsonl เป็น ISO 8601 (เวลาท้องถิ่น), ใน binary เป็น epoch seconds (double)
+    """
+
+    FORMATS = ('csv', 'jsonl', 'binary')
+    EXTENSIONS = {'csv': 'csv', 'jsonl': 'jsonl', 'binary': 'bin'}
+    FIELDS = ('account_no',) + Ledger.COLUMNS
+    MAGIC = b'LAB5STMT\x01'
+    HEADER = struct.Struct('<cI')
+    STRING = struct.Struct('<IH')
+
+    def __init__(self, fp, format='csv', chunk_rows=10000):
+        """fp: ไฟล์ที่เปิดแบบ binary ('wb')"""
+        if format not in self.FORMATS: raise ValueError(f'Unknown statement format {format!r}')
+        if chunk_rows <= 0: raise ValueError('chunk_rows must be > 0')
+        self.__fp = fp
+        self.__format = format
+        self.__chunk_rows = chunk_rows
+        self.__written_strings = set()
+        self.bytes_written = 0
+        self.rows_written = 0
+        if format == 'csv':
+            self.__write((','.join(self.FIELDS) + '\r\n').encode('utf-8'))
+        elif format == 'binary':
+            self.__write(self.MAGIC)
+
+    def write_account(self, account):
+        """Stream ทั้ง ledger ของบัญชี; คืนจำนวนแถวที่เขียน"""
+        ledger = account.ledger
+        total = len(ledger)  # แถวที่เพิ่มระหว่าง export จะไปอยู่ใน statement รอบหน้า
+        write_chunk = getattr(self, f'_write_{self.__format}')
+        for start in range(0, total, self.__chunk_rows):
+            stop = min(start + self.__chunk_rows, total)
+            write_chunk(account.account_no, {name: ledger._raw(name)[start:stop] for name in Ledger.COLUMNS})
+        self.rows_written += total
+        return total
+
+    def __write(self, data):
+        self.__fp.write(data)
+        self.bytes_written += len(data)
+
+    @staticmethod
+    def _decode(columns, encode=None):
+        """แปลง chunk ของ column ดิบเป็น tuple ของค่าที่อ่านได้ (string/ISO timestamp)
+
+        string และ timestamp แปลงครั้งเดียวต่อค่าใน chunk (รายการ batch ใช้เวลาเดียวกันทั้งชุด)
+        encode (ถ้ามี) ใช้กับค่า string/timestamp หลังแปลง เช่น json.dumps
+        """
+        get = Ledger.STRINGS.get
+        encode = encode or (lambda value: value)
+        names = {i: encode(get(i)) for name in Ledger._STRING_COLUMNS for i in set(columns[name])}
+        names[-1] = encode(None)
+        codes = [encode(code) for code in Ledger.TYPE_CODES]
+        stamps = {ts: encode(datetime.fromtimestamp(ts).isoformat()) for ts in set(columns['timestamp'])}
+        return zip([codes[t] for t in columns['type']],
+                   [names[i] for i in columns['channel_type']],
+                   [names[i] for i in columns['channel_id']],
+                   columns['amount'], columns['balance'],
+                   [names[i] for i in columns['target']],
+                   [stamps[ts] for ts in columns['timestamp']])
+
+    def _write_csv(self, account_no, columns):
+        # quote string ครั้งเดียวต่อค่าใน _decode แล้วประกอบบรรทัดเอง (csv.writer ช้าที่ float)
+        prefix = _csv_field(account_no)
+        lines = [f'{prefix},{type},{channel_type},{channel_id},{amount!r},{balance!r},{target},{ts}\r\n'
+                 for type, channel_type, channel_id, amount, balance, target, ts in self._decode(columns, _csv_field)]
+        self.__write(''.join(lines).encode('utf-8'))
+
+    def _write_jsonl(self, account_no, columns):
+        # string ถูก json.dumps ไว้แล้วใน _decode จึงประกอบบรรทัดเองได้ (เร็วกว่า json.dumps ทั้ง dict)
+        dumps = partial(json.dumps, ensure_ascii=False)
+        prefix = '{"account_no": ' + dumps(account_no)
+        lines = [f'{prefix}, "type": {type}, "channel_type": {channel_type}, "channel_id": {channel_id}, '
+                 f'"amount": {amount!r}, "balance": {balance!r}, "target": {target}, "timestamp": {ts}}}\n'
+                 for type, channel_type, channel_id, amount, balance, target, ts in self._decode(columns, dumps)]
+        self.__write(''.join(lines).encode('utf-8'))
+
+    def _write_binary(self, account_no, columns):
+        used = set()
+        for name in Ledger._STRING_COLUMNS:
+            used.update(columns[name])
+        used.discard(-1)
+        new = used - self.__written_strings
+        if new:
+            parts = [self.HEADER.pack(b'S', len(new))]
+            for idx in sorted(new):
+                encoded = str(Ledger.STRINGS.get(idx)).encode('utf-8')
+                parts.append(self.STRING.pack(idx, len(encoded)) + encoded)
+            self.__write(b''.join(parts))
+            self.__written_strings |= new
+        encoded = str(account_no).encode('utf-8')
+        parts = [self.HEADER.pack(b'R', len(columns['type'])), struct.pack('<H', len(encoded)), encoded]
+        parts.extend(columns[name].tobytes() for name in Ledger.COLUMNS)
+        self.__write(b''.join(parts))
+
+
+def _csv_field(value):
+    """ค่าหนึ่ง field ตามกฎ quoting ของ csv module (QUOTE_MINIMAL)"""
+    if value is None:
+        return ''
+    value = str(value)
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class ExportResult:
+    """ผลลัพธ์ของ Bank.export_statements"""
+
+    def __init__(self, files, accounts, rows, bytes_written, elapsed, workers):
+        self.files = files
+        self.accounts = accounts
+        self.rows = rows
+        self.bytes_written = bytes_written
+        self.elapsed = elapsed
+        self.workers = workers
+
+    @property
+    def throughput_mb(self):
+        """MB (10^6 bytes) ต่อวินาที"""
+        return self.bytes_written / 1e6 / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"ExportResult: {self.accounts:,} accounts / {self.rows:,} rows -> {len(self.files)} files, "
+                f"{self.bytes_written / 1e6:,.1f} MB in {self.elapsed:.2f}s ({self.throughput_mb:,.1f} MB/s)")
+
+
+_EXPORT_BANK = None  # bank ที่ worker process ได้มาตอน fork
+
+
+def _export_shard(path, account_nos, format, chunk_rows, bank=None):
+    bank = bank if bank is not None else _EXPORT_BANK
+    with open(path, 'wb', buffering=1 << 20) as fp:
+        exporter = StatementExporter(fp, format, chunk_rows)
+        for account_no in account_nos:
+            exporter.write_account(bank.get_account_by_no(account_no))
+    return len(account_nos), exporter.rows_written, exporter.bytes_written
+
+
+def export_statements(bank, directory, format='csv', workers=None, chunk_rows=10000):
+    """Export ทุกบัญชีของ bank ลง directory แบ่งเป็น shard ละไฟล์ต่อ worker
+
+    workers > 1 ใช้ process pool แบบ fork (worker อ่าน ledger จาก memory ที่ได้ตอน fork
+    ไม่ต้อง pickle ข้อมูล); platform ที่ไม่มี fork จะ export ใน process นี้แทน
+    """
+    global _EXPORT_BANK
+    if format not in StatementExporter.FORMATS: raise ValueError(f'Unknown statement format {format!r}')
+    os.makedirs(directory, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        workers = 1
+    account_nos = [account.account_no for account in bank.get_all_accounts()]
+    shards = [account_nos[i::workers] for i in range(workers)]
+    shards = [shard for shard in shards if shard] or [[]]
+    extension = StatementExporter.EXTENSIONS[format]
+    paths = [os.path.join(directory, f'statements-{i:03d}.{extension}') for i in range(len(shards))]
+
+    start = time.perf_counter()
+    if len(shards) == 1:
+        results = [_export_shard(paths[0], shards[0], format, chunk_rows, bank)]
+    else:
+        _EXPORT_BANK = bank
+        try:
+            with ProcessPoolExecutor(len(shards), mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(_export_shard, paths, shards, [format] * len(shards),
+                                        [chunk_rows] * len(shards)))
+        finally:
+            _EXPORT_BANK = None
+    elapsed = time.perf_counter() - start
+    accounts, rows, written = (sum(column) for column in zip(*results))
+    return ExportResult(paths, accounts, rows, written, elapsed, len(shards))
+
+
+
+# ============================================================================
+# REPORTING - ยอดรวมทั้งธนาคารจาก ledger แบบ incremental
+# ============================================================================
+
+class BankReport:
+    """ยอดรวม deposits / withdrawals / transfers / payments / fees / interest / cashback
+    แยกตาม channel_type, channel_id, card_type และวัน (local date)
+
+    ทุกแถวของ ledger ถูกนับครั้งเดียวเข้า "cube" ที่ key เป็น
+    (card_type, category, channel_type id, channel_id id, day ordinal) -> [count, amount]
+    รายงานแต่ละมิติคือการ roll-up cube ซึ่งเล็กมากเมื่อเทียบกับจำนวนรายการ
+
+    refresh() อ่านเฉพาะแถวที่เพิ่มมาหลังรอบก่อน (จำจำนวนแถวที่นับแล้วของแต่ละบัญชี)
+    card_type คือบัตรของบัญชีตอนที่แถวถูกนับ (ledger ไม่ได้เก็บบัตรไว้ในแต่ละรายการ)
+    'I' ผ่าน SYSTEM คือดอกเบี้ย, 'I' ผ่านช่องทางอื่น (EDC) คือ cashback
+    """
+
+    CATEGORIES = ('deposits', 'withdrawals', 'transfers_out', 'transfers_in', 'interest', 'payments', 'fees', 'cashback')
+    TYPE_CATEGORY = {'D': 0, 'W': 1, 'TW': 2, 'TD': 3, 'I': 4, 'P': 5, 'F': 6}
+    CASHBACK = 7
+    DIMENSIONS = ('channel_type', 'channel_id', 'card_type', 'day')
+    NO_CARD = 'No Card'
+
+    def __init__(self, bank):
+        self.__bank = bank
+        self.__cube = {}
+        self.__seen = {}  # account_no -> จำนวนแถวใน ledger ที่นับแล้ว
+        self.__lock = threading.Lock()
+        self.__categories = [self.TYPE_CATEGORY[code] for code in Ledger.TYPE_CODES]
+        self.__system = Ledger.STRINGS.intern('SYSTEM')
+        self.__day = (0, 0.0, -1.0)  # (ordinal, เริ่มวัน, เริ่มวันถัดไป) ของวันล่าสุดที่เจอ
+        self.rows = 0
+
+    def refresh(self):
+        """นับแถวใหม่ของทุกบัญชีเข้า cube; คืนจำนวนแถวที่เพิ่ม"""
+        with self.__lock:
+            added = 0
+            seen = self.__seen
+            for account in self.__bank.get_all_accounts():
+                start = seen.get(account.account_no, 0)
+                stop = len(account.ledger)
+                if stop > start:
+                    card_type = account.card.get_card_type() if account.card is not None else self.NO_CARD
+                    self._aggregate(account.ledger, start, stop, card_type)
+                    seen[account.account_no] = stop
+                    added += stop - start
+            self.rows += added
+            return added
+
+    def _aggregate(self, ledger, start, stop, card_type):
+        categories, system, cashback = self.__categories, self.__system, self.CASHBACK
+        interest = self.TYPE_CATEGORY['I']
+        cube = self.__cube
+        day, day_start, day_end = self.__day
+        raw = ledger._raw
+        for type, channel_type, channel_id, amount, ts in zip(
+                raw('type')[start:stop], raw('channel_type')[start:stop], raw('channel_id')[start:stop],
+                raw('amount')[start:stop], raw('timestamp')[start:stop]):
+            if not day_start <= ts < day_end:
+                day, day_start, day_end = _local_day(ts)
+            category = categories[type]
+            if category == interest and channel_type != system:
+                category = cashback
+            key = (card_type, category, channel_type, channel_id, day)
+            cell = cube.get(key)
+            if cell is None:
+                cube[key] = [1, amount]
+            else:
+                cell[0] += 1
+                cell[1] += amount
+        self.__day = (day, day_start, day_end)
+
+    def summary(self, by=None):
+        """{group: {category: (count, amount)}} - by เป็นหนึ่งใน DIMENSIONS หรือ None (ยอดรวมทั้งธนาคาร)"""
+        if by is not None and by not in self.DIMENSIONS: raise ValueError(f'Unknown dimension {by!r}')
+        get = Ledger.STRINGS.get
+        group_of = {
+            None: lambda key: 'ALL',
+            'card_type': lambda key: key[0],
+            'channel_type': lambda key: get(key[2]),
+            'channel_id': lambda key: get(key[3]),
+            'day': lambda key: date.fromordinal(key[4]),
+        }[by]
+        result = defaultdict(dict)
+        with self.__lock:
+            for key, (count, amount) in self.__cube.items():
+                group = result[group_of(key)]
+                category = self.CATEGORIES[key[1]]
+                previous_count, previous_amount = group.get(category, (0, 0.0))
+                group[category] = (previous_count + count, previous_amount + amount)
+        return dict(result)
+
+    def totals(self, by=None):
+        """เหมือน summary แต่เหลือแค่ amount: {group: {category: amount}}"""
+        return {group: {category: amount for category, (_, amount) in values.items()}
+                for group, values in self.summary(by).items()}
+
+    def format(self, by=None):
+        """ตารางข้อความของ totals(by)"""
+        totals = self.totals(by)
+        lines = [f"{by or 'bank':<20}" + ''.join(f"{category:>15}" for category in self.CATEGORIES)]
+        for group in sorted(totals, key=str):
+            values = totals[group]
+            lines.append(f"{str(group):<20}" + ''.join(f"{values.get(category, 0):>15,.2f}" for category in self.CATEGORIES))
+        return '\n'.join(lines)
+
+
+def _local_day(ts):
+    """(day ordinal, เวลาเริ่มวัน, เวลาเริ่มวันถัดไป) ของ timestamp ตามเวลาท้องถิ่น"""
+    day = datetime.fromtimestamp(ts).date()
+    start = datetime.combine(day, datetime.min.time()).timestamp()
+    end = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
+    return day.toordinal(), start, end
+
+
+# ============================================================================
+# SHARDED BANK - แบ่งบัญชีตาม account_no ไปหลาย process, โอนข้าม shard แบบ two-phase
+# ============================================================================
+
+class ShardLink(Channel):
+    """ช่องทางของธุรกรรมที่ ShardedBank ส่งเข้า shard - ไม่มี session และวงเงินต่อช่องทาง"""
+
+    TYPE = "SHARD"
+
+    def __init__(self, shard_id):
+        self.__id = shard_id
+
+    @property
+    def get_id(self):
+        return self.__id
+
+    @property
+    def get_type(self):
+        return self.TYPE
+
+    def authenticate(self, *args, **kwargs):
+        return True
+
+
+class _ShardServer:
+    """state ของหนึ่ง shard ใน worker process: Bank ของตัวเอง + transfer ที่ prepare ค้างไว้
+
+    คำสั่ง (ส่งมาเป็น list ทีละ batch):
+        ('D', account_no, amount) / ('W', account_no, amount)   ฝาก / ถอน
+        ('TW', account_no, amount, target_no)                   โอนใน shard เดียวกัน (Account.transfer)
+        ('PD', txid, account_no, amount, target_no)             prepare ฝั่งต้นทาง: กันเงินไว้
+        ('PC', txid, account_no, amount, source_no)             prepare ฝั่งปลายทาง: ตรวจว่ามีบัญชี
+    """
+
+    def __init__(self, index):
+        self.bank = Bank(f'Shard {index}')
+        self.link = ShardLink(f'SHARD-{index}')
+        self.prepared = {}  # txid -> (account, amount, other account_no, is_debit)
+
+    def account(self, account_no):
+        account = self.bank.get_account_by_no(account_no)
+        if account is None: raise LookupError(f'Account {account_no} not found')
+        return account
+
+    def open(self, states):
+        for state in states:
+            _restore_account(self.bank, state)
+        return self.bank.get_account_count()
+
+    def run(self, commands):
+        results = []
+        link = self.link
+        for command in commands:
+            try:
+                kind = command[0]
+                if kind == 'D':
+                    self.account(command[1]).deposit(link, command[2])
+                elif kind == 'W':
+                    self.account(command[1]).withdraw(link, command[2])
+                elif kind == 'TW':
+                    self.account(command[1]).transfer(link, command[2], self.account(command[3]))
+                elif kind == 'PD':
+                    _, txid, account_no, amount, target_no = command
+                    account = self.account(account_no)
+                    account.prepare_transfer(link, amount)
+                    self.prepared[txid] = (account, amount, target_no, True)
+                elif kind == 'PC':
+                    _, txid, account_no, amount, source_no = command
+                    self.prepared[txid] = (self.account(account_no), amount, source_no, False)
+                else:
+                    raise ValueError(f"Unknown operation {kind}")
+                results.append(None)
+            except (ValueError, LookupError, PermissionError, TypeError) as e:
+                results.append(e)
+        return results
+
+    def abort(self, txids):
+        """ยกเลิก txid ที่ prepare ค้างไว้ (ใช้เมื่อรอบ prepare ล้ม); txid ที่ไม่มีข้ามไป คืนจำนวนที่ยกเลิก"""
+        link = self.link
+        aborted = 0
+        for txid in txids:
+            entry = self.prepared.pop(txid, None)
+            if entry is None:
+                continue
+            account, amount, _, is_debit = entry
+            if is_debit:
+                account.abort_transfer(link, amount)
+            aborted += 1
+        return aborted
+
+    def finish(self, decisions):
+        """ขั้นที่ 2: (txid, commit) - debit ลง TW หรือคืนเงิน, credit รับเงินเข้า (TD) หรือทิ้ง
+
+        ส่งซ้ำได้: txid ที่ทำไปแล้วถูกข้าม; ถ้ารายการไหน error จะคืนเข้า prepared แล้ว raise
+        (ShardedBank ส่ง decisions ชุดนั้นซ้ำรอบหน้า)
+        """
+        link = self.link
+        for txid, commit in decisions:
+            entry = self.prepared.pop(txid, None)
+            if entry is None:
+                continue
+            account, amount, other, is_debit = entry
+            try:
+                if is_debit:
+                    if commit:
+                        account.commit_transfer(link, amount, other)
+                    else:
+                        account.abort_transfer(link, amount)
+                elif commit:
+                    account.receive_transfer(amount, link, other)
+            except BaseException:
+                self.prepared[txid] = entry
+                raise
+
+    def balances(self, account_nos=None):
+        if account_nos is None:
+            return {account.account_no: account.amount for account in self.bank.get_all_accounts()}
+        return {account_no: self.account(account_no).amount for account_no in account_nos}
+
+    def stats(self):
+        accounts = self.bank.get_all_accounts()
+        return {'accounts': len(accounts), 'rows': sum(len(account.ledger) for account in accounts),
+                'total': sum(account.amount for account in accounts), 'prepared': len(self.prepared)}
+
+
+def _shard_main(index, conn):
+    """loop ของ worker process: รับ (method, args) ทาง Pipe แล้วตอบ (ok, result / exception)"""
+    server = _ShardServer(index)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        method, args = message
+        try:
+            conn.send((True, getattr(server, method)(*args)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+
+class ShardedBank:
+    """บัญชีกระจายไป shards process ตาม crc32(account_no) - แต่ละ shard มี Bank, บัญชีและ ledger ของตัวเอง
+
+    process() แบ่ง operation ตาม shard แล้วส่งเป็น batch ทาง Pipe ทุก shard พร้อมกัน (shard ทำงานขนานกัน):
+    - D / W / TW ที่ต้นทางและปลายทางอยู่ shard เดียวกัน ใช้ Account.deposit / withdraw / transfer ตรง ๆ
+    - TW ข้าม shard เป็น two-phase: รอบแรก prepare ทั้งสองฝั่ง (ต้นทางกันเงิน, ปลายทางตรวจบัญชี)
+      รอบสองส่ง commit ถ้าทั้งคู่ผ่าน ไม่งั้น abort ให้ฝั่งที่ prepare แล้ว (ต้นทางได้เงินคืน)
+      เงินเข้าปลายทางตอน commit คือหลังรายการอื่นใน batch เดียวกัน
+      รอบสองของ shard ที่ส่งไม่สำเร็จถูกเก็บไว้ (unfinished) แล้วส่งซ้ำก่อนเริ่ม process() ครั้งถัดไป
+      - ตัดสินแล้วต้องทำตามนั้น ไม่ abort ทิ้ง เพราะอีกฝั่งอาจ commit ไปแล้ว
+
+    ใช้จาก thread เดียว หรือผ่าน process() / ฟังก์ชันอื่นที่ lock ไว้แล้ว; ปิดด้วย close() หรือ with
+    """
+
+    def __init__(self, shards=2, context=None):
+        if shards < 1: raise ValueError('shards need to be >= 1')
+        ctx = multiprocessing.get_context(context)
+        self.__conns = []
+        self.__processes = []
+        for index in range(shards):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_shard_main, args=(index, child), name=f'shard-{index}', daemon=True)
+            process.start()
+            child.close()
+            self.__conns.append(parent)
+            self.__processes.append(process)
+        self.__next_txid = 0
+        self.__unfinished = {}  # shard -> decisions ของรอบสองที่ยังส่งไม่สำเร็จ
+        self.__lock = threading.Lock()
+
+    @property
+    def shards(self):
+        return len(self.__conns)
+
+    @property
+    def unfinished(self):
+        """จำนวน transfer (นับต่อฝั่ง) ที่ตัดสินแล้วแต่ shard ยังไม่ได้ finish"""
+        return sum(len(batch) for batch in self.__unfinished.values())
+
+    def shard_of(self, account_no):
+        return zlib.crc32(str(account_no).encode()) % len(self.__conns)
+
+    def __call(self, requests):
+        """ส่ง {shard: (method, args)} ทุก shard ก่อนแล้วค่อยรอคำตอบ; error แรกถูก raise หลังรับครบ"""
+        if not self.__conns: raise ValueError('ShardedBank closed')
+        for shard, message in requests.items():
+            self.__conns[shard].send(message)
+        results, error = {}, None
+        for shard in requests:
+            ok, value = self.__conns[shard].recv()
+            if ok:
+                results[shard] = value
+            elif error is None:
+                error = value
+        if error is not None:
+            raise error
+        return results
+
+    def add_user(self, user):
+        """ส่งบัญชี (พร้อมบัตร) ของ user ไป shard ของแต่ละบัญชี; คืนจำนวนบัญชีที่ส่ง"""
+        return self.add_users([user])
+
+    def add_users(self, users):
+        states = defaultdict(list)
+        for user in users:
+            if not isinstance(user, User): raise TypeError('user type Wrong')
+            for account in user.get_all_accounts():
+                states[self.shard_of(account.account_no)].append(account._export_state())
+        with self.__lock:
+            self.__call({shard: ('open', (batch,)) for shard, batch in states.items()})
+        return sum(len(batch) for batch in states.values())
+
+    OPERATIONS = {'D': 3, 'W': 3, 'TW': 4}  # opcode -> ขนาด tuple; PD/PC เป็นคำสั่งภายใน ส่งตรงไม่ได้
+
+    def process(self, operations):
+        """ประมวลผล ('D', no, amount) / ('W', no, amount) / ('TW', no, amount, target_no); คืน BatchResult
+
+        op ที่ไม่รู้จัก / ขนาดผิดได้ ValueError ของ op นั้นโดยไม่ถูกส่งไป shard
+        ถ้า shard ล้มระหว่างรอบ prepare ทุก txid ที่ prepare แล้วถูก abort (เงินต้นทางคืน) ก่อน raise
+        ถ้าส่งรอบสองไม่สำเร็จ raise หลังเก็บ decisions ไว้ส่งซ้ำ (ผลใน batch นี้ตัดสินแล้ว)
+        """
+        result = BatchResult()
+        start = time.perf_counter()
+        operations = list(operations)
+        commands = [[] for _ in self.__conns]
+        places = []
+        shard_of = self.shard_of
+        with self.__lock:
+            if self.__unfinished:
+                self.__finish({})
+            txids = defaultdict(list)  # shard -> txid ที่ส่ง PD/PC ไป
+            for op in operations:
+                kind = op[0] if len(op) else None
+                if self.OPERATIONS.get(kind) != len(op):
+                    places.append((None, ValueError(f"Unknown operation {op!r}")))
+                    continue
+                source = shard_of(op[1])
+                if kind == 'TW' and (target := shard_of(op[3])) != source:
+                    txid = self.__next_txid = self.__next_txid + 1
+                    commands[source].append(('PD', txid, op[1], op[2], op[3]))
+                    commands[target].append(('PC', txid, op[3], op[2], op[1]))
+                    txids[source].append(txid)
+                    txids[target].append(txid)
+                    places.append((txid, None, (source, len(commands[source]) - 1), (target, len(commands[target]) - 1)))
+                else:
+                    commands[source].append(op)
+                    places.append((None, None, (source, len(commands[source]) - 1)))
+
+            try:
+                votes = self.__call({shard: ('run', (batch,)) for shard, batch in enumerate(commands) if batch})
+            except BaseException:
+                if txids:
+                    try:
+                        self.__call({shard: ('abort', (batch,)) for shard, batch in txids.items()})
+                    except Exception:
+                        pass  # pipe เสียด้วย - ให้ error ของรอบ prepare ออกไปแทน
+                raise
+            decisions = defaultdict(list)
+            for op, (txid, error, *sides) in zip(operations, places):
+                errors = [votes[shard][position] for shard, position in sides]
+                error = next((e for e in errors if e is not None), error)
+                if txid is not None:
+                    for (shard, _), side_error in zip(sides, errors):
+                        if side_error is None:
+                            decisions[shard].append((txid, error is None))
+                result.results.append((op, error))
+            if decisions:
+                self.__finish(decisions)
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def __finish(self, decisions):
+        """ส่งรอบสอง {shard: [(txid, commit)]} รวมกับที่ค้างจากรอบก่อน
+        shard ที่ส่ง/ตอบไม่สำเร็จถูกเก็บไว้ใน __unfinished แล้ว raise error แรก"""
+        for shard, batch in self.__unfinished.items():
+            decisions[shard] = batch + decisions.get(shard, [])
+        self.__unfinished = {}
+        sent, error = [], None
+        for shard, batch in decisions.items():
+            try:
+                self.__conns[shard].send(('finish', (batch,)))
+                sent.append(shard)
+            except OSError as e:
+                self.__unfinished[shard] = batch
+                error = error or e
+        for shard in sent:
+            try:
+                ok, value = self.__conns[shard].recv()
+            except (EOFError, OSError) as e:
+                ok, value = False, e
+            if not ok:
+                self.__unfinished[shard] = decisions[shard]
+                error = error or value
+        if error is not None:
+            raise error
+
+    def __single(self, op):
+        (_, error), = self.process([op]).results
+        if error is not None:
+            raise error
+
+    def deposit(self, account_no, amount):
+        self.__single(('D', account_no, amount))
+
+    def withdraw(self, account_no, amount):
+        self.__single(('W', account_no, amount))
+
+    def transfer(self, account_no, amount, target_no):
+        self.__single(('TW', account_no, amount, target_no))
+
+    def balance(self, account_no):
+        shard = self.shard_of(account_no)
+        with self.__lock:
+            return self.__call({shard: ('balances', ([account_no],))})[shard][account_no]
+
+    def balances(self):
+        """{account_no: amount} ของทุก shard"""
+        with self.__lock:
+            results = self.__call({shard: ('balances', ()) for shard in range(len(self.__conns))})
+        return {account_no: amount for shard in results.values() for account_no, amount in shard.items()}
+
+    def stats(self):
+        """list ต่อ shard: accounts, rows (ledger), total (ยอดรวม), prepared (transfer ที่ค้าง)"""
+        with self.__lock:
+            results = self.__call({shard: ('stats', ()) for shard in range(len(self.__conns))})
+        return [results[shard] for shard in range(len(self.__conns))]
+
+    def close(self):
+        with self.__lock:
+            for conn in self.__conns:
+                try:
+                    conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+                conn.close()
+            for process in self.__processes:
+                process.join(timeout=5)
+            self.__conns, self.__processes = [], []
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
 
 
 
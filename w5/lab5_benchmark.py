@@ -0,0 +1,910 @@
+##################################################################################
+# BENCHMARKS สำหรับระบบธนาคาร lab5
+#
+# วิธีใช้:
+#   python lab5_benchmark.py                 # รันทุก benchmark
+#   python lab5_benchmark.py card_lookup     # รันเฉพาะที่ระบุ
+#
+##################################################################################
+
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from lab5 import (
+    Bank, User, SavingAccount, CurrentAccount, FixedAccount,
+    Card, ATM_Card, DebitCard, PremiumCard, ShoppingCard, PinHasher, PinVerifier,
+    ATM_machine, EDC_machine, Counter, SettlementPolicy, AsyncChannelFrontend, ShardedBank, ShardLink,
+    Ledger, Transaction, AnnualFeeReport, BankJournal, BankReport,
+    Account, SystemClock, ManualClock,
+    set_event_sink, ConsoleSink, NullSink, RingBufferSink, BatchedFileSink,
+)
+from lab5_loadgen import LoadBank, LoadConfig, LoadResult, run_load
+
+
+# ============================================================================
+# HELPERS
+# ============================================================================
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the lab's events and console output while building large fixtures."""
+    previous = set_event_sink(NullSink())
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        set_event_sink(previous)
+
+
+@contextlib.contextmanager
+def fast_pins():
+    """PBKDF2 1 รอบระหว่างสร้าง fixture - บัตรเป็นล้านใบด้วย hash จริงใช้เวลาหลายชั่วโมง"""
+    previous, Card.PIN_HASHER = Card.PIN_HASHER, PinHasher(iterations=1)
+    try:
+        yield
+    finally:
+        Card.PIN_HASHER = previous
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def print_header(title):
+    print("\n" + "="*70)
+    print(title)
+    print("="*70)
+
+
+def saving_account(i, account_no, user):
+    return SavingAccount(account_no, user, 100000)
+
+
+def mixed_account(i, account_no, user):
+    """Saving / Fixed 6, 12, 24 เดือน / Current สลับกัน"""
+    kind = i % 5
+    if kind == 0:
+        return CurrentAccount(account_no, user, 100000)
+    if kind == 1:
+        return SavingAccount(account_no, user, 100000)
+    return FixedAccount(account_no, user, 100000, term_months=(6, 12, 24)[kind - 2])
+
+
+def build_bank(n_accounts, accounts_per_user=1, with_cards=True, account_factory=saving_account):
+    """สร้าง Bank ที่มี n_accounts บัญชี (default SavingAccount + บัตรสลับประเภท)"""
+    card_types = (ATM_Card, DebitCard, PremiumCard, ShoppingCard)
+    bank = Bank("Benchmark Bank")
+    with quiet(), fast_pins():
+        user = None
+        for i in range(n_accounts):
+            if i % accounts_per_user == 0:
+                if user is not None:
+                    bank.add_user(user)
+                user = User(f'C{i:012d}', f'User {i}')
+            account_no = f'{i:010d}'
+            account = account_factory(i, account_no, user)
+            if with_cards:
+                card_cls = card_types[i % len(card_types)]
+                account.add_card(card_cls(f'9{i:011d}', account_no, '1234'))
+            user.add_account(account)
+        if user is not None:
+            bank.add_user(user)
+    return bank
+
+
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+def bench_card_lookup(sizes=(1_000, 10_000, 100_000, 1_000_000), lookups=100_000):
+    """Bank.search_account_from_card latency ต้องคงที่ไม่ว่าจะมีกี่บัญชี"""
+    print_header("Card -> Account lookup latency (hash index)")
+    print(f"{'accounts':>12} {'build (s)':>10} {'card ns/op':>11} {'acct ns/op':>11} {'user ns/op':>11}")
+    rng = random.Random(42)
+    for n in sizes:
+        bank, build_time = timed(build_bank, n)
+        picks = [rng.randrange(n) for _ in range(lookups)]
+        card_nos = [f'9{i:011d}' for i in picks]
+        account_nos = [f'{i:010d}' for i in picks]
+        citizen_ids = [f'C{i:012d}' for i in picks]
+
+        _, t_card = timed(lambda: [bank.search_account_from_card(c) for c in card_nos])
+        _, t_acct = timed(lambda: [bank.get_account_by_no(a) for a in account_nos])
+        _, t_user = timed(lambda: [bank.get_user_by_citizen_id(c) for c in citizen_ids])
+
+        assert bank.search_account_from_card(card_nos[0]).account_no == account_nos[0]
+        print(f"{n:>12,} {build_time:>10.2f} {t_card / lookups * 1e9:>11.0f} "
+              f"{t_acct / lookups * 1e9:>11.0f} {t_user / lookups * 1e9:>11.0f}")
+        del bank
+
+
+def bench_channel_registry(sizes=(1_000, 10_000, 100_000), lookups=100_000):
+    """ลงทะเบียน EDC ทีละเครื่อง / แบบ bulk และ lookup ด้วย id"""
+    print_header("Channel registry: registration and lookup")
+    print(f"{'terminals':>12} {'add_edc (s)':>12} {'bulk (s)':>10} {'lookup ns/op':>13}")
+    rng = random.Random(42)
+    with quiet():
+        merchant = CurrentAccount('9000000001', User('M', 'Merchant'), 0)
+    for n in sizes:
+        edcs = [EDC_machine(f'EDC-{i:07d}', merchant) for i in range(n)]
+        bank = Bank("Benchmark Bank")
+        with quiet():
+            _, t_single = timed(lambda: [bank.add_edc_machine(edc) for edc in edcs])
+            bulk_bank = Bank("Benchmark Bank")
+            channels = edcs + [ATM_machine(f'ATM-{i:07d}', 1000000) for i in range(n // 10)]
+            channels += [Counter(f'COUNTER-{i:05d}') for i in range(n // 100)]
+            _, t_bulk = timed(bulk_bank.add_channels, channels)
+        ids = [f'EDC-{rng.randrange(n):07d}' for _ in range(lookups)]
+        _, t_lookup = timed(lambda: [bank.get_edc_by_id(i) for i in ids])
+        assert bank.get_edc_by_id(ids[0]).get_id == ids[0]
+        print(f"{n:>12,} {t_single:>12.3f} {t_bulk:>10.3f} {t_lookup / lookups * 1e9:>13.0f}")
+
+
+def _ledger_rows(n):
+    types = Ledger.TYPE_CODES
+    for i in range(n):
+        yield (types[i % len(types)], 'ATM_machine', f'ATM-{i % 50:04d}',
+               float(i % 5000), float(100000 + i), None if i % 3 else f'{i % 1000:010d}')
+
+
+def bench_ledger_memory(rows=(10_000, 100_000, 1_000_000)):
+    """หน่วยความจำต่อรายการ: list[Transaction] เทียบกับ columnar Ledger"""
+    print_header("Ledger memory per transaction")
+    print(f"{'rows':>12} {'list[Transaction] B/row':>24} {'Ledger B/row':>13} {'append ns/op':>13}")
+    for n in rows:
+        data = list(_ledger_rows(n))
+
+        tracemalloc.start()
+        legacy = [Transaction(*row) for row in data]
+        legacy_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del legacy
+
+        # first pass fills the shared StringPool, so the traced pass below
+        # counts only the per-row column storage
+        fresh = Ledger()
+        _, t_append = timed(lambda: [fresh.append(*row) for row in data])
+        del fresh
+
+        tracemalloc.start()
+        ledger = Ledger()
+        for row in data:
+            ledger.append(*row)
+        ledger_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        assert str(ledger[-1]) == str(Transaction(*data[-1]))
+        print(f"{n:>12,} {legacy_bytes / n:>24.1f} {ledger_bytes / n:>13.1f} {t_append / n * 1e9:>13.0f}")
+        print(f"{'':>12} Ledger.nbytes() = {ledger.nbytes():,} bytes")
+
+
+def _settlement_ops(n_ops, n_accounts, rng):
+    ops = []
+    for _ in range(n_ops):
+        src = f'{rng.randrange(n_accounts):010d}'
+        roll = rng.random()
+        if roll < 0.4:
+            ops.append(('D', src, rng.randint(100, 5000)))
+        elif roll < 0.7:
+            ops.append(('W', src, rng.randint(100, 2000)))
+        else:
+            dst = f'{rng.randrange(n_accounts):010d}'
+            if dst == src:
+                dst = f'{(int(src) + 1) % n_accounts:010d}'
+            ops.append(('TW' if roll < 0.85 else 'P', src, rng.randint(100, 2000), dst))
+    return ops
+
+
+def bench_batch_engine(n_accounts=10_000, n_ops=200_000):
+    """Replay settlement: เรียก deposit/withdraw/transfer/pay ทีละรายการ vs Bank.process_batch"""
+    print_header(f"Batch engine: {n_ops:,} operations over {n_accounts:,} accounts")
+    rng = random.Random(7)
+    ops = _settlement_ops(n_ops, n_accounts, rng)
+
+    # ทีละรายการผ่าน Counter (บัญชีทั้งหมดเป็นของ user เดียว จึง authenticate ครั้งเดียว)
+    bank = build_bank(n_accounts, accounts_per_user=n_accounts, with_cards=False)
+    counter = Counter('COUNTER-01')
+    first = bank.get_account_by_no(f'{0:010d}')
+    counter.verify_identity(first, first.user.citizen_id)
+    get = bank.get_account_by_no
+
+    def one_by_one():
+        failed = 0
+        for op in ops:
+            account = get(op[1])
+            try:
+                if op[0] == 'D':
+                    account.deposit(counter, op[2])
+                elif op[0] == 'W':
+                    account.withdraw(counter, op[2])
+                elif op[0] == 'TW':
+                    account.transfer(counter, op[2], get(op[3]))
+                else:
+                    account.pay(counter, op[2], get(op[3]))
+                    get(op[3]).amount += op[2]
+            except ValueError:
+                failed += 1
+        return failed
+
+    with quiet():
+        failed, t_single = timed(one_by_one)
+    total_single = sum(get(f'{i:010d}').amount for i in range(n_accounts))
+
+    bank = build_bank(n_accounts, accounts_per_user=n_accounts, with_cards=False)
+    with quiet():
+        result = bank.process_batch(ops)
+    total_batch = sum(bank.get_account_by_no(f'{i:010d}').amount for i in range(n_accounts))
+
+    print(f"{'mode':>14} {'seconds':>9} {'ops/s':>12} {'failed':>8}")
+    print(f"{'one-by-one':>14} {t_single:>9.3f} {n_ops / t_single:>12,.0f} {failed:>8,}")
+    print(f"{'process_batch':>14} {result.elapsed:>9.3f} {result.throughput:>12,.0f} {result.failed:>8,}")
+    print(f"speedup: {t_single / result.elapsed:.1f}x  (total balance {total_single:,.0f} vs {total_batch:,.0f})")
+
+
+def bench_interest_run(sizes=(10_000, 100_000, 1_000_000)):
+    """calculate_interest ทีละบัญชี vs Bank.run_interest"""
+    print_header("Month-end interest posting")
+    print(f"{'accounts':>12} {'loop acc/s':>12} {'run_interest acc/s':>19} {'speedup':>8}")
+    for n in sizes:
+        bank = build_bank(n, with_cards=False, account_factory=mixed_account)
+        accounts = [bank.get_account_by_no(f'{i:010d}') for i in range(n)]
+        with quiet():
+            _, t_loop = timed(lambda: [account.calculate_interest() for account in accounts])
+            result = bank.run_interest()
+        print(f"{n:>12,} {n / t_loop:>12,.0f} {n / result.elapsed:>19,.0f} {t_loop / result.elapsed:>7.1f}x")
+        for account_type, factor, count, total in result.groups:
+            print(f"{'':>12} {account_type:<14} factor={factor:.5f} accounts={count:,} interest={total:,.2f}")
+        del bank, accounts
+
+
+def bench_annual_fee(sizes=(10_000, 100_000, 1_000_000), chunk_size=50_000):
+    """charge_annual_fee ทีละบัตร vs Bank.apply_annual_fee (chunk + checkpoint/resume)"""
+    print_header("Annual fee run")
+    print(f"{'cards':>12} {'loop cards/s':>13} {'job cards/s':>12} {'speedup':>8} {'failed':>7}")
+    for n in sizes:
+        bank = build_bank(n)
+        accounts = [bank.get_account_by_no(f'{i:010d}') for i in range(n)]
+        with quiet():
+            _, t_loop = timed(lambda: [a.card.charge_annual_fee(a) for a in accounts])
+
+        # ทำครึ่งแรก เขียน checkpoint ลงไฟล์ แล้ว resume จากไฟล์จนจบ
+        bank = build_bank(n)
+        half = max(1, n // chunk_size // 2)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'annual_fee.json')
+
+            def save(report):
+                with open(path, 'w') as f:
+                    json.dump(report.to_checkpoint(), f)
+
+            bank.apply_annual_fee(chunk_size=chunk_size, max_chunks=half, on_chunk=save)
+            with open(path) as f:
+                resumed = AnnualFeeReport.from_checkpoint(json.load(f))
+            report = bank.apply_annual_fee(chunk_size=chunk_size, resume_from=resumed, on_chunk=save)
+        assert report.done and report.charged_count + len(report.failures) + report.skipped == n
+        print(f"{n:>12,} {n / t_loop:>13,.0f} {n / report.elapsed:>12,.0f} "
+              f"{t_loop / report.elapsed:>7.1f}x {len(report.failures):>7,}")
+        del bank, accounts
+
+
+def bench_concurrent_transfers(n_accounts=1_000, n_transfers=20_000, thread_counts=(1, 2, 4, 8, 16)):
+    """Stress test: โอนเงินพร้อมกันหลาย thread แล้วตรวจว่ายอดรวมไม่หาย/ไม่ติดลบ"""
+    print_header(f"Concurrent transfers: {n_transfers:,} transfers over {n_accounts:,} accounts")
+    print(f"{'threads':>8} {'seconds':>9} {'transfers/s':>12} {'rejected':>9} {'conserved':>10}")
+    for threads in thread_counts:
+        bank = build_bank(n_accounts, accounts_per_user=n_accounts, with_cards=False)
+        accounts = [bank.get_account_by_no(f'{i:010d}') for i in range(n_accounts)]
+        for account in accounts:
+            account.amount = 1000
+        total_before = sum(account.amount for account in accounts)
+        counter = Counter('COUNTER-01')
+        counter.verify_identity(accounts[0], accounts[0].user.citizen_id)
+        rng = random.Random(threads)
+        jobs = []
+        while len(jobs) < n_transfers:
+            src, dst = rng.randrange(n_accounts), rng.randrange(n_accounts)
+            if src != dst:
+                jobs.append((src, dst, rng.randint(1, 400)))
+
+        def run(chunk):
+            rejected = 0
+            for src, dst, amount in chunk:
+                try:
+                    accounts[src].transfer(counter, amount, accounts[dst])
+                except ValueError:
+                    rejected += 1
+            return rejected
+
+        chunks = [jobs[i::threads] for i in range(threads)]
+        with quiet(), ThreadPoolExecutor(max_workers=threads) as pool:
+            rejected, elapsed = timed(lambda: sum(pool.map(run, chunks)))
+
+        total_after = sum(account.amount for account in accounts)
+        assert abs(total_after - total_before) < 1e-6, "money created or destroyed"
+        assert all(account.amount >= 0 for account in accounts), "overdrawn account"
+        for account in accounts:
+            rows = account.get_transactions()
+            assert all(abs(b.balance - a.balance - (b.amount if b.type == 'TD' else -b.amount)) < 1e-6
+                       for a, b in zip(rows, rows[1:])), "ledger out of order"
+        print(f"{threads:>8} {elapsed:>9.3f} {n_transfers / elapsed:>12,.0f} {rejected:>9,} {'yes':>10}")
+
+    # ATM: หลาย thread ถอนจากตู้เดียวที่เงินไม่พอ - ต้องไม่จ่ายเกินเงินในตู้
+    with quiet():
+        user = User('C-ATM', 'ATM stress')
+        account = CurrentAccount('ATM-STRESS', user, 10_000_000)
+        account.add_card(ATM_Card('ATM-CARD', 'ATM-STRESS', '1234'))
+        user.add_account(account)
+    atm = ATM_machine('ATM-STRESS', 500_000)
+    atm.insert_card(account.card, '1234')
+
+    def withdraw(_):
+        try:
+            account.withdraw(atm, 500)
+            return 1
+        except ValueError:
+            return 0
+
+    with quiet(), ThreadPoolExecutor(max_workers=16) as pool:
+        dispensed = sum(pool.map(withdraw, range(2_000)))
+    assert atm.money == 0 and dispensed == 1_000
+    assert account.amount == 10_000_000 - 500_000
+    print(f"ATM: 2,000 concurrent withdrawals of 500 from 500,000 cash -> {dispensed:,} dispensed, "
+          f"cash left {atm.money:,}")
+
+
+class LegacyClock:
+    """พฤติกรรมเดิม: datetime.now().date() ทุกครั้งที่เช็ค daily limit"""
+
+    def today(self):
+        return datetime.now().date().toordinal()
+
+
+def bench_daily_limit(n_ops=200_000):
+    """withdraw hot path: datetime.now().date() ทุก call vs SystemClock (cached day)"""
+    print_header(f"Daily-limit check on the withdraw hot path ({n_ops:,} ops)")
+    print(f"{'clock':>12} {'today() ns':>11} {'withdraw ns/op':>15}")
+    original = Account.CLOCK
+    try:
+        for name, clock in (('legacy', LegacyClock()), ('SystemClock', SystemClock()),
+                            ('ManualClock', ManualClock())):
+            Account.CLOCK = clock
+            _, t_today = timed(lambda: [clock.today() for _ in range(n_ops)])
+            with quiet():
+                user = User('C-LIMIT', 'Limit bench')
+                account = SavingAccount('LIMIT-1', user, 10 ** 12)
+                account.add_card(ATM_Card('LIMIT-CARD', 'LIMIT-1', '1234'))
+                user.add_account(account)
+                counter = Counter('COUNTER-01')
+                counter.verify_identity(account, 'C-LIMIT')
+                _, t_withdraw = timed(lambda: [account.withdraw(counter, 1) for _ in range(n_ops)])
+            print(f"{name:>12} {t_today / n_ops * 1e9:>11.0f} {t_withdraw / n_ops * 1e9:>15.0f}")
+
+        Account.CLOCK = ManualClock()
+        bank = build_bank(100_000)
+        Account.CLOCK.advance()
+        _, t_reset = timed(bank.reset_daily_limits)
+        print(f"Bank.reset_daily_limits over 100,000 accounts: {t_reset * 1e3:.1f} ms")
+    finally:
+        Account.CLOCK = original
+
+
+def bench_event_sinks(n_ops=200_000):
+    """deposit throughput กับ sink แต่ละแบบ (console ไป devnull และไปไฟล์จริง)"""
+    print_header(f"Event sinks: {n_ops:,} Counter deposits")
+    print(f"{'sink':>24} {'ops/s':>12}")
+    with quiet():
+        user = User('C-SINK', 'Sink bench')
+        account = CurrentAccount('SINK-1', user, 0)
+        user.add_account(account)
+        counter = Counter('COUNTER-01')
+        counter.verify_identity(account, 'C-SINK')
+
+    def deposits():
+        for _ in range(n_ops):
+            account.deposit(counter, 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        console_file = open(os.path.join(tmp, 'console.txt'), 'w')
+        file_sink = BatchedFileSink(os.path.join(tmp, 'events.jsonl'), batch_size=4096)
+        sinks = (
+            ('ConsoleSink -> file', ConsoleSink(), console_file),
+            ('NullSink', NullSink(), None),
+            ('RingBufferSink(100k)', RingBufferSink(100_000), None),
+            ('BatchedFileSink(4096)', file_sink, None),
+        )
+        for name, sink, stdout in sinks:
+            previous = set_event_sink(sink)
+            try:
+                if stdout is not None:
+                    with contextlib.redirect_stdout(stdout):
+                        _, elapsed = timed(deposits)
+                else:
+                    _, elapsed = timed(deposits)
+                sink.flush()
+            finally:
+                set_event_sink(previous)
+            print(f"{name:>24} {n_ops / elapsed:>12,.0f}")
+        file_sink.close()
+        console_file.close()
+
+
+def bench_journal_recovery(n_accounts=100_000, n_transactions=10_000_000, batch_size=100_000):
+    """เขียน journal ผ่าน process_batch แล้ววัดเวลา recover (snapshot + replay)"""
+    print_header(f"Journal: {n_transactions:,} transactions over {n_accounts:,} accounts")
+    rng = random.Random(11)
+    bank = build_bank(n_accounts, with_cards=True)
+    with tempfile.TemporaryDirectory() as directory:
+        journal = BankJournal.start(directory, bank)
+        written, t_write = 0, 0.0
+        with quiet():
+            while written < n_transactions:
+                ops = _settlement_ops(min(batch_size, n_transactions - written), n_accounts, rng)
+                result = bank.process_batch(ops)
+                written += len(ops)
+                t_write += result.elapsed
+        _, t_sync = timed(journal.close)
+        rows = sum(len(account.ledger) for account in bank.get_all_accounts())
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        recovered, stats = BankJournal.recover(directory)
+        mismatched = sum(recovered.get_account_by_no(account.account_no).amount != account.amount
+                         for account in bank.get_all_accounts())
+
+    print(f"write:    {t_write:.2f}s ({written / t_write:,.0f} ops/s, {rows:,} ledger rows), fsync {t_sync:.3f}s")
+    print(f"on disk:  {size / 2**20:,.1f} MiB")
+    print(f"recover:  snapshot {stats['snapshot_seconds']:.2f}s + replay {stats['replayed']:,} rows "
+          f"{stats['replay_seconds']:.2f}s ({stats['replayed'] / max(stats['replay_seconds'], 1e-9):,.0f} rows/s)")
+    print(f"balances mismatched after recovery: {mismatched}")
+
+
+def bench_history_query(rows=(100_000, 1_000_000), page_size=50, queries=200):
+    """Statement แบบกรอง: scan get_transactions() ทั้งหมด vs Ledger.query บน LedgerIndex"""
+    print_header("Filtered history query (one page)")
+    print(f"{'rows':>12} {'filter':>22} {'scan ms':>9} {'index ms':>9} {'index build ms':>15}")
+    for n in rows:
+        ledger = Ledger()
+        start = time.time() - n
+        for i, row in enumerate(_ledger_rows(n)):
+            ledger.append(*row, timestamp=start + i)
+        _, t_build = timed(ledger.index.refresh)
+        middle = start + n / 2
+        filters = (
+            ('type=P', dict(type='P')),
+            ('channel=ATM-0007', dict(channel_id='ATM-0007')),
+            ('P @ ATM-0007 + range', dict(type='P', channel_id='ATM-0007', start=middle, end=middle + n / 4)),
+        )
+        for name, query in filters:
+            def scan():
+                page = []
+                for t in ledger[:]:
+                    if ('type' in query and t.type != query['type']) or \
+                       ('channel_id' in query and t.channel_id != query['channel_id']) or \
+                       ('start' in query and not query['start'] <= t.timestamp.timestamp() < query['end']):
+                        continue
+                    page.append(t)
+                return page[-page_size:]
+
+            def indexed():
+                for _ in range(queries):
+                    page = list(ledger.query(**query, limit=page_size, newest_first=True))
+                return page
+
+            expected, t_scan = timed(scan)
+            got, t_index = timed(indexed)
+            assert [t._index for t in got] == [t._index for t in reversed(expected)]
+            print(f"{n:>12,} {name:>22} {t_scan * 1e3:>9.1f} {t_index / queries * 1e3:>9.3f} {t_build * 1e3:>15.1f}")
+
+
+def bench_statement_export(n_accounts=20_000, n_ops=1_000_000, worker_counts=(1, 2, 4)):
+    """Export statement ทุกบัญชีเป็น csv / jsonl / binary - MB/s ตามจำนวน worker process"""
+    print_header(f"Statement export: {n_accounts:,} accounts, {n_ops:,} batch operations")
+    bank = build_bank(n_accounts, with_cards=False)
+    rng = random.Random(5)
+    with quiet():
+        for done in range(0, n_ops, 200_000):
+            bank.process_batch(_settlement_ops(min(200_000, n_ops - done), n_accounts, rng))
+    rows = sum(len(account.ledger) for account in bank.get_all_accounts())
+    print(f"{rows:,} ledger rows, cpu_count={os.cpu_count()}")
+    print(f"{'format':>8} {'workers':>8} {'MB':>8} {'seconds':>8} {'MB/s':>8} {'rows/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for format in ('csv', 'jsonl', 'binary'):
+            for workers in worker_counts:
+                result = bank.export_statements(os.path.join(directory, f'{format}-{workers}'), format, workers)
+                assert result.rows == rows
+                print(f"{format:>8} {result.workers:>8} {result.bytes_written / 1e6:>8.1f} {result.elapsed:>8.2f} "
+                      f"{result.throughput_mb:>8.1f} {result.rows / result.elapsed:>12,.0f}")
+
+
+def bench_reporting(n_accounts=100_000, n_ops=1_000_000, increment=50_000):
+    """BankReport: นับทั้งธนาคารครั้งแรก vs refresh หลังมีรายการใหม่ (ไม่ rescan)"""
+    print_header(f"Reporting: {n_accounts:,} accounts, {n_ops:,} batch operations")
+    bank = build_bank(n_accounts, account_factory=mixed_account)
+    rng = random.Random(9)
+    with quiet():
+        for done in range(0, n_ops, 200_000):
+            bank.process_batch(_settlement_ops(min(200_000, n_ops - done), n_accounts, rng))
+        bank.run_interest()
+        bank.apply_annual_fee()
+
+    report = BankReport(bank)
+    rows, t_full = timed(report.refresh)
+    print(f"full pass:   {rows:>12,} rows {t_full:>8.3f}s ({rows / t_full:,.0f} rows/s)")
+
+    with quiet():
+        bank.process_batch(_settlement_ops(increment, n_accounts, rng))
+    added, t_incremental = timed(report.refresh)
+    _, t_rescan = timed(BankReport(bank).refresh)
+    print(f"incremental: {added:>12,} rows {t_incremental:>8.3f}s  (rescan everything: {t_rescan:.3f}s)")
+    for by in BankReport.DIMENSIONS:
+        groups, t_rollup = timed(report.summary, by)
+        print(f"roll-up by {by:<13} {len(groups):>8,} groups {t_rollup * 1e3:>8.2f} ms")
+
+
+def bench_pin_auth(n_cards=100, cached_auths=200_000, uncached_auths=200):
+    """ATM insert_card ต่อวินาที: PBKDF2 ทุกครั้ง (cache_size=0) vs LRU verification cache"""
+    print_header(f"PIN authentication ({PinHasher().iterations:,} PBKDF2 iterations, {n_cards} cards)")
+    cards = [ATM_Card(f'PIN-{i:06d}', f'ACC-{i:06d}', f'{i % 10000:04d}') for i in range(n_cards)]
+    atm = ATM_machine('ATM-PIN', 0)
+    previous = Card.PIN_VERIFIER
+    try:
+        for name, verifier, n in (('no cache', PinVerifier(cache_size=0), uncached_auths),
+                                  ('LRU cache', PinVerifier(cache_size=n_cards), cached_auths)):
+            Card.PIN_VERIFIER = verifier
+
+            def sessions():
+                for k in range(n):
+                    i = k % n_cards
+                    assert atm.insert_card(cards[i], f'{i % 10000:04d}')
+                    atm.eject_card()
+
+            _, elapsed = timed(sessions)
+            print(f"{name:>10} {n / elapsed:>14,.0f} auth/s  (hits {verifier.hits:,}, misses {verifier.misses:,})")
+
+        verifier = Card.PIN_VERIFIER
+        for _ in range(verifier.max_attempts):
+            atm.insert_card(cards[0], 'wrong')
+        print(f"lockout after {verifier.max_attempts} wrong PINs: locked={verifier.is_locked(cards[0].card_no)}, "
+              f"correct PIN accepted={atm.insert_card(cards[0], '0000')}")
+    finally:
+        Card.PIN_VERIFIER = previous
+
+
+def bench_load(users=1000, sessions=100_000, process_counts=(1, 2, 4)):
+    """Load generator: session mix บน ATM/EDC/Counter หลายเครื่อง, p50/p99 ต่อ operation"""
+    print_header(f"Multi-ATM load: {users:,} users, {sessions:,} sessions")
+    config = LoadConfig(users=users, sessions=sessions)
+    for processes in process_counts:
+        print(run_load(config, processes).format())
+        print()
+
+
+def bench_edc_settlement(n_accounts=10_000, n_sales=200_000, terminals=8, batch_size=1_000):
+    """ร้านค้าเดียวหลายเครื่อง EDC: เข้าบัญชีร้านค้าทุกการขาย vs batch settlement"""
+    print_header(f"EDC settlement: {n_sales:,} sales on {terminals} terminals, one merchant")
+    rng = random.Random(16)
+    print(f"{'mode':>22} {'seconds':>9} {'sales/s':>10} {'merchant rows':>14} {'merchant total':>16}")
+    for name, policy in (('per sale', None), (f'batch of {batch_size:,}', SettlementPolicy(max_sales=batch_size))):
+        bank = build_bank(n_accounts)
+        payers = [account for account in bank.get_all_accounts() if isinstance(account.card, DebitCard)]
+        with quiet():
+            owner = User('C-MERCHANT', 'Merchant')
+            merchant = CurrentAccount('MERCHANT-1', owner, 0)
+            owner.add_account(merchant)
+            bank.add_user(owner)
+            edcs = [EDC_machine(f'EDC-{i:03d}', merchant, settlement=policy) for i in range(terminals)]
+            bank.add_channels(edcs)
+        sales = [(rng.choice(payers), rng.randint(10, 200)) for _ in range(n_sales)]
+
+        def run(terminal):
+            edc = edcs[terminal]
+            for account, amount in sales[terminal::terminals]:
+                edc.swipe_card(account.card, '1234')
+                edc.pay(account, amount)
+                edc.eject_card()
+
+        with quiet(), ThreadPoolExecutor(max_workers=terminals) as pool:
+            _, elapsed = timed(lambda: list(pool.map(run, range(terminals))))
+            bank.settle_edcs()
+        assert merchant.amount == sum(amount for _, amount in sales)
+        print(f"{name:>22} {elapsed:>9.3f} {n_sales / elapsed:>10,.0f} {len(merchant.ledger):>14,} "
+              f"{merchant.amount:>16,.0f}")
+    lookups = payers[:1000]
+    found, elapsed = timed(lambda: sum(len(list(edc.find_sales(account.account_no)))
+                                       for account in lookups for edc in edcs))
+    print(f"find_sales (account index): {len(lookups) * terminals:,} lookups, {found:,} sales, "
+          f"{elapsed / (len(lookups) * terminals) * 1e6:.1f} us each; "
+          f"{sum(len(edc.batches) for edc in edcs)} batches kept")
+
+
+def _legacy_withdraw_rules(account, card, channel, amount):
+    """การตัดสินใจเดิมของ withdraw + SavingAccount._check_withdraw_limit (isinstance ทุกครั้ง)"""
+    limit = None
+    if isinstance(account, SavingAccount):
+        limit = SavingAccount.WITHDRAW_LIMIT_PER_TRANSACTION
+        if isinstance(card, PremiumCard):
+            limit = card.DAILY_LIMIT
+        elif isinstance(card, ShoppingCard):
+            limit = card.DAILY_LIMIT
+    channel_limit = channel.Withdraw_Limit_transac if isinstance(channel, (ATM_machine, EDC_machine)) else None
+    dispenses = isinstance(channel, ATM_machine)
+    tracks = isinstance(channel, (ATM_machine, EDC_machine))
+    annual_fee = card.annual_fee if card is not None else 0
+    return limit, channel_limit, dispenses, tracks, annual_fee
+
+
+def _legacy_cashback(card, amount):
+    if isinstance(card, PremiumCard):
+        return amount * PremiumCard.CASHBACK_RATE
+    if isinstance(card, ShoppingCard) and amount >= ShoppingCard.EDC_MINIMUM_TRANSACTION:
+        return amount * ShoppingCard.CASHBACK_RATE
+    return 0
+
+
+def bench_policy_table(n_ops=200_000):
+    """isinstance chain เดิม vs PolicyTable.resolve (decision เท่านั้น และ withdraw/pay ทั้ง method)"""
+    print_header(f"Policy table: {n_ops:,} decisions")
+    bank = build_bank(400)
+    accounts = bank.get_all_accounts()
+    with quiet():
+        owner = User('C-SHOP', 'Shop')
+        merchant = CurrentAccount('SHOP-1', owner, 0)
+        owner.add_account(merchant)
+    atm = ATM_machine('ATM-POLICY', 10 ** 12)
+    edc = EDC_machine('EDC-POLICY', merchant)
+    policies = Account.POLICIES
+    cases = [(accounts[i % len(accounts)], (atm, edc)[i % 2]) for i in range(n_ops)]
+
+    def legacy():
+        for account, channel in cases:
+            _legacy_withdraw_rules(account, account.card, channel, 100)
+            _legacy_cashback(account.card, 1500)
+
+    def table():
+        for account, channel in cases:
+            policy = policies.resolve(account, account.card, channel)
+            policy.daily_limit, policy.channel_limit, policy.dispenses_cash, policy.tracks_daily, policy.annual_fee
+            1500 * policy.cashback_rate if 1500 >= policy.cashback_minimum else 0
+
+    _, t_legacy = timed(legacy)
+    _, t_table = timed(table)
+    print(f"{'decision':>12} isinstance {t_legacy / n_ops * 1e9:>6.0f} ns  table {t_table / n_ops * 1e9:>6.0f} ns  "
+          f"speedup {t_legacy / t_table:.1f}x")
+
+    # withdraw / pay ทั้ง method ผ่าน ATM / EDC (ใช้ policy table อยู่แล้ว)
+    debit = [account for account in accounts if isinstance(account.card, DebitCard)]
+    n_calls = min(n_ops, 50_000)
+
+    def withdraws():
+        for k in range(n_calls):
+            account = accounts[k % len(accounts)]
+            atm.insert_card(account.card, '1234')
+            account.withdraw(atm, 1)
+            atm.eject_card()
+
+    def pays():
+        for k in range(n_calls):
+            account = debit[k % len(debit)]
+            edc.swipe_card(account.card, '1234')
+            edc.pay(account, 1)
+            edc.eject_card()
+
+    with quiet():
+        _, t_withdraw = timed(withdraws)
+        _, t_pay = timed(pays)
+    print(f"{'withdraw':>12} {n_calls / t_withdraw:>12,.0f} sessions/s")
+    print(f"{'pay':>12} {n_calls / t_pay:>12,.0f} sessions/s")
+
+    # เปลี่ยนกติกาตอน runtime: Premium daily limit 150,000
+    policies.load([{'card': 'PremiumCard', 'daily_limit': 150_000}])
+    premium = next(account for account in accounts if isinstance(account.card, PremiumCard))
+    print(f"reloaded rules -> Premium daily limit {policies.resolve(premium, premium.card, atm).daily_limit:,}")
+    policies.load([])
+
+
+def _layout_pair(cls):
+    """คลาสจำลองที่มี field เท่ากับ cls: แบบ __slots__ และแบบ __dict__ (layout ก่อนเพิ่ม slots)"""
+    names = [f"_{klass.__name__.lstrip('_')}{name}" if name.startswith('__') else name
+             for klass in cls.__mro__ for name in klass.__dict__.get('__slots__', ())]
+    body = ''.join(f'    self.{name} = None\n' for name in names) or '    pass\n'
+    namespace = {}
+    exec('def __init__(self):\n' + body, namespace)
+    slotted = type(f'Slotted{cls.__name__}', (), {'__slots__': tuple(names), '__init__': namespace['__init__']})
+    plain = type(f'Dict{cls.__name__}', (), {'__init__': namespace['__init__']})
+    return len(names), slotted, plain
+
+
+def _shell_bytes(obj):
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+
+
+def bench_object_memory(n=200_000):
+    """Bytes ต่อ object และความเร็วสร้าง object: __slots__ vs __dict__ layout ที่มี field เท่ากัน"""
+    print_header(f"Domain object layout ({n:,} objects each)")
+    user = User('C-MEM', 'Memory')
+    samples = {
+        'User': lambda i: User(f'C{i:012d}', 'User'),
+        'SavingAccount': lambda i: SavingAccount(f'{i:010d}', user, 1000),
+        'FixedAccount': lambda i: FixedAccount(f'{i:010d}', user, 1000),
+        'ATM_Card': lambda i: ATM_Card(f'9{i:011d}', f'{i:010d}', '1234'),
+        'PremiumCard': lambda i: PremiumCard(f'9{i:011d}', f'{i:010d}', '1234'),
+        'Transaction': lambda i: Transaction('D', 'ATM_machine', 'ATM-1', 100.0, 1000.0),
+        'Ledger': lambda i: Ledger(),
+    }
+    classes = {'User': User, 'SavingAccount': SavingAccount, 'FixedAccount': FixedAccount, 'ATM_Card': ATM_Card,
+               'PremiumCard': PremiumCard, 'Transaction': Transaction, 'Ledger': Ledger}
+    print(f"{'class':>14} {'fields':>7} {'slots B':>8} {'dict B':>8} {'saved':>7} "
+          f"{'slots ns':>9} {'dict ns':>8} {'real B/obj':>11} {'real ns':>8}")
+    rows = []
+    with quiet(), fast_pins():
+        for name, make in samples.items():
+            fields, slotted, plain = _layout_pair(classes[name])
+            slots_bytes, dict_bytes = _shell_bytes(slotted()), _shell_bytes(plain())
+            _, t_slots = timed(lambda: [slotted() for _ in range(n)])
+            _, t_dict = timed(lambda: [plain() for _ in range(n)])
+
+            tracemalloc.start()
+            objects, t_real = timed(lambda: [make(i) for i in range(n)])
+            real_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del objects
+            rows.append((name, fields, slots_bytes, dict_bytes, t_slots, t_dict, real_bytes, t_real))
+    for name, fields, slots_bytes, dict_bytes, t_slots, t_dict, real_bytes, t_real in rows:
+        print(f"{name:>14} {fields:>7} {slots_bytes:>8} {dict_bytes:>8} {1 - slots_bytes / dict_bytes:>6.0%} "
+              f"{t_slots / n * 1e9:>9.0f} {t_dict / n * 1e9:>8.0f} {real_bytes / n:>11.0f} {t_real / n * 1e9:>8.0f}")
+    print("slots/dict B: object shell only; real B/obj: everything the real constructor allocates "
+          "(strings, Ledger arrays, lock, PIN hash ...)")
+
+
+async def _drive_terminals(frontend, load, customers, ops_per_customer, think, seed):
+    """หนึ่ง coroutine ต่อเครื่อง: ลูกค้าทีละคน insert_card -> ops (คั่นด้วย think time) -> eject"""
+    latencies = {'insert_card': [], 'withdraw': [], 'pay': [], 'eject': []}
+    errors = defaultdict(int)
+    clock = time.perf_counter_ns
+
+    async def terminal(channel_id, is_edc, rng):
+        session = frontend.open(channel_id)
+        op, pool = ('pay', load.debit_accounts) if is_edc else ('withdraw', range(len(load.accounts)))
+        for _ in range(customers):
+            index = rng.choice(pool)
+            account = load.accounts[index]
+            await asyncio.sleep(rng.random() * think)
+            start = clock()
+            if not await session.insert_card(account.card, load.pins[index]):
+                errors['insert_card'] += 1
+                continue
+            latencies['insert_card'].append(clock() - start)
+            for _ in range(ops_per_customer):
+                await asyncio.sleep(rng.random() * think)
+                start = clock()
+                try:
+                    await (session.pay if is_edc else session.withdraw)(rng.randrange(1, 20) * 100)
+                except (ValueError, PermissionError):
+                    errors[op] += 1
+                latencies[op].append(clock() - start)
+            start = clock()
+            await session.eject()
+            latencies['eject'].append(clock() - start)
+        await session.close()
+
+    rng = random.Random(seed)
+    terminals = [terminal(atm.get_id, False, random.Random(rng.random())) for atm in load.atms] + \
+                [terminal(edc.get_id, True, random.Random(rng.random())) for edc in load.edcs]
+    await asyncio.gather(*terminals)
+    return latencies, errors
+
+
+def bench_async_sessions(terminals=10_000, customers=3, ops_per_customer=3, think=0.005):
+    """asyncio front-end: หลายพันเครื่อง (ATM + EDC) พร้อมกันใน event loop เดียว, p50/p99 ต่อ operation"""
+    print_header(f"Async sessions: {terminals:,} terminals x {customers} customers x {ops_per_customer} ops, "
+                 f"think <= {think * 1e3:.0f} ms")
+    edcs = terminals * 3 // 10
+    config = LoadConfig(users=max(1, terminals // 3), atms=terminals - edcs, edcs=edcs, counters=0, pin_iterations=1)
+    print(f"bank: {config.users * 3:,} accounts, {config.atms:,} ATM + {config.edcs:,} EDC (rebuilt per run)")
+    print(f"{'pin check':>10} {'seconds':>8} {'ops/s':>9} {'peak':>7} {'operation':>12} {'count':>8} "
+          f"{'errors':>7} {'p50 us':>8} {'p99 us':>9}")
+    for offload in (False, True):
+        with quiet():
+            load = LoadBank(config)
+        frontend = AsyncChannelFrontend(load.bank, offload_pin=offload)
+        with quiet():
+            (latencies, errors), elapsed = timed(
+                asyncio.run, _drive_terminals(frontend, load, customers, ops_per_customer, think, seed=19))
+        total = sum(len(values) for values in latencies.values())
+        label = 'executor' if offload else 'in loop'
+        for i, (op, values) in enumerate(latencies.items()):
+            values.sort()
+            head = f"{label:>10} {elapsed:>8.2f} {total / elapsed:>9,.0f} {frontend.peak:>7,}" if i == 0 else ' ' * 37
+            print(f"{head} {op:>12} {len(values):>8,} {errors.get(op, 0):>7,} "
+                  f"{LoadResult.percentile(values, 50) / 1e3:>8.1f} {LoadResult.percentile(values, 99) / 1e3:>9.1f}")
+
+
+def bench_sharded_bank(n_accounts=20_000, n_ops=200_000, shard_counts=(1, 2, 4), batch_size=10_000):
+    """ShardedBank: throughput รวมเมื่อเพิ่มจำนวน shard process (โอน 50% เป็นแบบสุ่มปลายทาง -> ข้าม shard ส่วนใหญ่)"""
+    print_header(f"Sharded bank: {n_accounts:,} accounts, {n_ops:,} ops in batches of {batch_size:,} "
+                 f"({os.cpu_count()} CPU)")
+    rng = random.Random(20)
+    bank = build_bank(n_accounts, account_factory=lambda i, no, user: CurrentAccount(no, user, 1_000_000))
+    account_nos = [account.account_no for account in bank.get_all_accounts()]
+    ops = []
+    for kind in rng.choices(('TW', 'D', 'W'), (2, 1, 1), k=n_ops):
+        account_no = rng.choice(account_nos)
+        amount = rng.randrange(1, 50) * 10
+        ops.append(('TW', account_no, amount, rng.choice(account_nos)) if kind == 'TW' else (kind, account_no, amount))
+    batches = [ops[i:i + batch_size] for i in range(0, n_ops, batch_size)]
+
+    print(f"{'shards':>10} {'seconds':>9} {'ops/s':>10} {'cross-shard':>12} {'failed':>8} {'ledger rows':>12}")
+    link = ShardLink('SHARD-0')
+    accounts = {account.account_no: account for account in bank.get_all_accounts()}
+
+    def in_process():
+        for op in ops:
+            account = accounts[op[1]]
+            if op[0] == 'TW':
+                account.transfer(link, op[2], accounts[op[3]])
+            elif op[0] == 'D':
+                account.deposit(link, op[2])
+            else:
+                account.withdraw(link, op[2])
+
+    with quiet():
+        _, elapsed = timed(in_process)
+    rows = sum(len(account.ledger) for account in accounts.values())
+    print(f"{'in-process':>10} {elapsed:>9.2f} {n_ops / elapsed:>10,.0f} {'-':>12} {0:>8,} {rows:>12,}")
+
+    for shards in shard_counts:
+        bank = build_bank(n_accounts, account_factory=lambda i, no, user: CurrentAccount(no, user, 1_000_000))
+        with quiet(), ShardedBank(shards) as sharded:
+            sharded.add_users(bank.get_all_users())
+            total_before = sum(sharded.balances().values())
+            cross = sum(1 for op in ops if op[0] == 'TW' and sharded.shard_of(op[1]) != sharded.shard_of(op[3]))
+            results, elapsed = timed(lambda: [sharded.process(batch) for batch in batches])
+            stats = sharded.stats()
+        failed = sum(result.failed for result in results)
+        assert all(shard['prepared'] == 0 for shard in stats)
+        assert sum(shard['total'] for shard in stats) <= total_before + sum(op[2] for op in ops if op[0] == 'D')
+        print(f"{shards:>10} {elapsed:>9.2f} {n_ops / elapsed:>10,.0f} {cross / n_ops:>12.0%} {failed:>8,} "
+              f"{sum(shard['rows'] for shard in stats):>12,}")
+
+
+BENCHMARKS = {
+    'card_lookup': bench_card_lookup,
+    'channel_registry': bench_channel_registry,
+    'ledger_memory': bench_ledger_memory,
+    'object_memory': bench_object_memory,
+    'history_query': bench_history_query,
+    'batch_engine': bench_batch_engine,
+    'interest_run': bench_interest_run,
+    'annual_fee': bench_annual_fee,
+    'concurrent_transfers': bench_concurrent_transfers,
+    'daily_limit': bench_daily_limit,
+    'event_sinks': bench_event_sinks,
+    'journal_recovery': bench_journal_recovery,
+    'statement_export': bench_statement_export,
+    'reporting': bench_reporting,
+    'pin_auth': bench_pin_auth,
+    'load': bench_load,
+    'async_sessions': bench_async_sessions,
+    'sharded_bank': bench_sharded_bank,
+    'edc_settlement': bench_edc_settlement,
+    'policy_table': bench_policy_table,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit(f"Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+        BENCHMARKS[name]()
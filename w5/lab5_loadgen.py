@@ -0,0 +1,333 @@
+##################################################################################
+# LOAD GENERATOR สำหรับระบบธนาคาร lab5
+#
+# จำลองลูกค้าใช้ ATM / EDC / Counter พร้อมกันหลายเครื่อง แล้ววัด latency ต่อ session
+#
+# วิธีใช้:
+#   python lab5_loadgen.py                                   # ค่า default, process เดียว
+#   python lab5_loadgen.py --users 5000 --sessions 500000 --processes 4
+#   python lab5_loadgen.py --mix withdraw=0.5,pay=0.5 --save base.json
+#   python lab5_loadgen.py --baseline base.json              # exit 1 ถ้าช้าลงเกิน tolerance
+#
+##################################################################################
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from lab5 import (
+    Bank, User, SavingAccount, FixedAccount, CurrentAccount,
+    Card, ATM_Card, DebitCard, PremiumCard, ShoppingCard, PinHasher,
+    ATM_machine, EDC_machine, Counter,
+    set_event_sink, NullSink,
+)
+
+
+OPERATIONS = ('insert_card', 'withdraw', 'deposit', 'transfer', 'pay')
+DEFAULT_MIX = {'insert_card': 0.15, 'withdraw': 0.30, 'deposit': 0.20, 'transfer': 0.20, 'pay': 0.15}
+
+
+class LoadConfig:
+    """ขนาดของธนาคารจำลองและสัดส่วน session
+
+    users: จำนวนลูกค้า แต่ละคนมี accounts_per_type บัญชีของทุกประเภท (Saving/Fixed/Current) พร้อมบัตร
+    atms / edcs / counters: จำนวนเครื่องแต่ละแบบ (EDC แต่ละเครื่องมีบัญชีร้านค้าของตัวเอง)
+    mix: operation -> น้ำหนัก (ไม่ต้องรวมกันได้ 1)
+    pin_iterations: PBKDF2 iterations ของบัตรที่สร้าง (ค่าจริงทำให้สร้างบัตรหลายพันใบช้ามาก)
+    """
+
+    def __init__(self, users=1000, accounts_per_type=1, atms=20, edcs=10, counters=5,
+                 sessions=100_000, mix=None, seed=1, pin_iterations=1000):
+        self.users = users
+        self.accounts_per_type = accounts_per_type
+        self.atms = atms
+        self.edcs = edcs
+        self.counters = counters
+        self.sessions = sessions
+        self.mix = dict(mix or DEFAULT_MIX)
+        self.seed = seed
+        self.pin_iterations = pin_iterations
+        unknown = set(self.mix) - set(OPERATIONS)
+        if unknown: raise ValueError(f'Unknown operations in mix: {", ".join(sorted(unknown))}')
+        if not any(weight > 0 for weight in self.mix.values()): raise ValueError('mix needs a positive weight')
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class LoadBank:
+    """ธนาคารที่ LoadConfig อธิบาย - สร้างซ้ำได้เหมือนเดิมทุกครั้ง (ใช้ใน worker process)"""
+
+    CARD_TYPES = (PremiumCard, ShoppingCard, DebitCard, ATM_Card)
+
+    def __init__(self, config):
+        self.bank = Bank('Load Bank')
+        self.accounts = []
+        self.pins = []
+        self.debit_accounts = []  # index ใน accounts ที่ใช้ EDC ได้
+        previous, Card.PIN_HASHER = Card.PIN_HASHER, PinHasher(iterations=config.pin_iterations)
+        try:
+            self.__build(config)
+        finally:
+            Card.PIN_HASHER = previous
+
+    def __build(self, config):
+        bank = self.bank
+        n = 0
+        for u in range(config.users):
+            user = User(f'L{u:012d}', f'Load User {u}')
+            for _ in range(config.accounts_per_type):
+                for account_cls in (SavingAccount, FixedAccount, CurrentAccount):
+                    account_no = f'L{n:010d}'
+                    account = account_cls(account_no, user, 1_000_000)
+                    pin = f'{n % 10000:04d}'
+                    card_cls = self.CARD_TYPES[n % len(self.CARD_TYPES)] if account_cls is SavingAccount else \
+                        (ATM_Card if account_cls is FixedAccount else DebitCard)
+                    account.add_card(card_cls(f'8{n:011d}', account_no, pin))
+                    user.add_account(account)
+                    if isinstance(account.card, DebitCard):
+                        self.debit_accounts.append(len(self.accounts))
+                    self.accounts.append(account)
+                    self.pins.append(pin)
+                    n += 1
+            bank.add_user(user)
+
+        merchants = User('M000000000000', 'Load Merchants')
+        self.atms = [ATM_machine(f'ATM-L{i:04d}', 10 ** 12) for i in range(config.atms)]
+        self.edcs = []
+        for i in range(config.edcs):
+            merchant = CurrentAccount(f'M{i:010d}', merchants, 0)
+            merchants.add_account(merchant)
+            self.edcs.append(EDC_machine(f'EDC-L{i:04d}', merchant))
+        bank.add_user(merchants)
+        self.counters = [Counter(f'CTR-L{i:04d}') for i in range(config.counters)]
+        bank.add_channels(self.atms + self.edcs + self.counters)
+
+
+def build_schedule(config, n_accounts, debit_accounts):
+    """รายการ session ที่กำหนดด้วย seed: (op, account, channel, amount, target)"""
+    rng = random.Random(config.seed)
+    ops = [op for op in OPERATIONS if config.mix.get(op, 0) > 0]
+    if 'pay' in ops and not (debit_accounts and config.edcs):
+        ops.remove('pay')
+    weights = [config.mix[op] for op in ops]
+    channels = {'insert_card': config.atms, 'withdraw': config.atms, 'transfer': config.atms,
+                'deposit': config.counters, 'pay': config.edcs}
+    if not ops or any(channels[op] <= 0 for op in ops): raise ValueError('mix needs at least one machine per operation')
+    schedule = []
+    for op in rng.choices(ops, weights, k=config.sessions):
+        account = rng.choice(debit_accounts) if op == 'pay' else rng.randrange(n_accounts)
+        target = rng.randrange(n_accounts)
+        if target == account:
+            target = (target + 1) % n_accounts
+        schedule.append((op, account, rng.randrange(channels[op]), rng.randrange(1, 20) * 100, target))
+    return schedule
+
+
+def _session(load, op, account_index, channel_index, amount, target_index):
+    account = load.accounts[account_index]
+    if op == 'deposit':
+        counter = load.counters[channel_index]
+        counter.authenticate(account, account.user.citizen_id)
+        try:
+            account.deposit(counter, amount)
+        finally:
+            counter.clear_session()
+        return
+    if op == 'pay':
+        edc = load.edcs[channel_index]
+        if not edc.swipe_card(account.card, load.pins[account_index]): raise PermissionError('Wrong PIN')
+        try:
+            edc.pay(account, amount)
+        finally:
+            edc.eject_card()
+        return
+    atm = load.atms[channel_index]
+    if not atm.insert_card(account.card, load.pins[account_index]): raise PermissionError('Wrong PIN')
+    try:
+        if op == 'withdraw':
+            account.withdraw(atm, amount)
+        elif op == 'transfer':
+            account.transfer(atm, amount, load.accounts[target_index])
+    finally:
+        atm.eject_card()
+
+
+def run_sessions(load, schedule):
+    """รัน schedule ต่อกันใน thread นี้; คืน (latencies ns: op -> array('q'), errors: op -> count, elapsed)"""
+    latencies = {op: array('q') for op in OPERATIONS}
+    errors = dict.fromkeys(OPERATIONS, 0)
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for op, account, channel, amount, target in schedule:
+        begin = clock()
+        try:
+            _session(load, op, account, channel, amount, target)
+        except (ValueError, PermissionError):
+            errors[op] += 1  # เงินไม่พอ / เกินวงเงิน ฯลฯ - ยังนับ latency ตามปกติ
+        latencies[op].append(clock() - begin)
+    return latencies, errors, time.perf_counter() - start
+
+
+def _worker(config, worker, workers):
+    """รันใน process ลูก: สร้างธนาคารเอง แล้วรัน session ส่วนของตัวเอง (schedule[worker::workers])"""
+    previous = set_event_sink(NullSink())
+    try:
+        load = LoadBank(config)
+        schedule = build_schedule(config, len(load.accounts), load.debit_accounts)[worker::workers]
+        latencies, errors, elapsed = run_sessions(load, schedule)
+    finally:
+        set_event_sink(previous)
+    return {op: values.tobytes() for op, values in latencies.items()}, errors, elapsed
+
+
+class LoadResult:
+    """latency ของทุก session แยกตาม operation (ns) + จำนวน error + เวลารวม"""
+
+    def __init__(self, config, processes, latencies, errors, elapsed, build_seconds):
+        self.config = config
+        self.processes = processes
+        self.latencies = {op: sorted(values) for op, values in latencies.items()}
+        self.errors = errors
+        self.elapsed = elapsed
+        self.build_seconds = build_seconds
+
+    @property
+    def sessions(self):
+        return sum(len(values) for values in self.latencies.values())
+
+    @staticmethod
+    def percentile(sorted_values, p):
+        """nearest-rank percentile ของ list ที่เรียงแล้ว"""
+        if not sorted_values:
+            return 0
+        rank = max(1, -(-len(sorted_values) * p // 100))
+        return sorted_values[int(rank) - 1]
+
+    def stats(self):
+        """op -> dict(count, errors, throughput, p50_us, p99_us, max_us); 'ALL' = รวมทุก op"""
+        rows = {}
+        everything = sorted(v for values in self.latencies.values() for v in values)
+        for op, values in list(self.latencies.items()) + [('ALL', everything)]:
+            if not values:
+                continue
+            rows[op] = {
+                'count': len(values),
+                'errors': self.errors.get(op, 0) if op != 'ALL' else sum(self.errors.values()),
+                'throughput': len(values) / self.elapsed if self.elapsed else 0.0,
+                'p50_us': self.percentile(values, 50) / 1e3,
+                'p99_us': self.percentile(values, 99) / 1e3,
+                'max_us': values[-1] / 1e3,
+            }
+        return rows
+
+    def to_dict(self):
+        return {'config': self.config.to_dict(), 'processes': self.processes, 'elapsed': self.elapsed,
+                'stats': self.stats()}
+
+    def format(self):
+        lines = [f"{self.sessions:,} sessions in {self.elapsed:.2f}s with {self.processes} process(es) "
+                 f"(bank build {self.build_seconds:.2f}s)",
+                 f"{'operation':>12} {'count':>10} {'errors':>8} {'ops/s':>12} {'p50 us':>9} {'p99 us':>9} {'max us':>10}"]
+        for op, row in self.stats().items():
+            lines.append(f"{op:>12} {row['count']:>10,} {row['errors']:>8,} {row['throughput']:>12,.0f} "
+                         f"{row['p50_us']:>9.1f} {row['p99_us']:>9.1f} {row['max_us']:>10.1f}")
+        return '\n'.join(lines)
+
+
+def run_load(config, processes=1):
+    """รัน load ตาม config - processes=1 รันใน process นี้, มากกว่านั้นแบ่ง schedule ให้ process pool
+
+    ใน process pool แต่ละ worker มีธนาคารของตัวเอง (ไม่แชร์ยอดเงินกัน) จึงวัด throughput
+    ของทั้งเครื่องได้โดยไม่ติด GIL; elapsed คือเวลาของ worker ที่ช้าที่สุด
+    """
+    if processes <= 1:
+        previous = set_event_sink(NullSink())
+        try:
+            start = time.perf_counter()
+            load = LoadBank(config)
+            schedule = build_schedule(config, len(load.accounts), load.debit_accounts)
+            build_seconds = time.perf_counter() - start
+            latencies, errors, elapsed = run_sessions(load, schedule)
+        finally:
+            set_event_sink(previous)
+        return LoadResult(config, 1, latencies, errors, elapsed, build_seconds)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as pool:
+        parts = list(pool.map(_worker, [config] * processes, range(processes), [processes] * processes))
+    wall = time.perf_counter() - start
+    latencies = {op: array('q') for op in OPERATIONS}
+    errors = dict.fromkeys(OPERATIONS, 0)
+    for part_latencies, part_errors, _ in parts:
+        for op in OPERATIONS:
+            latencies[op].frombytes(part_latencies[op])
+            errors[op] += part_errors[op]
+    elapsed = max(part[2] for part in parts)
+    return LoadResult(config, processes, latencies, errors, elapsed, wall - elapsed)
+
+
+def compare(result, baseline, tolerance=0.2):
+    """รายการ regression เทียบกับ baseline (to_dict ที่ save ไว้): throughput ลด / p99 เพิ่มเกิน tolerance"""
+    regressions = []
+    current = result.stats()
+    for op, before in baseline['stats'].items():
+        now = current.get(op)
+        if now is None:
+            continue
+        if now['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{op}: throughput {before['throughput']:,.0f} -> {now['throughput']:,.0f} ops/s")
+        if now['p99_us'] > before['p99_us'] * (1 + tolerance):
+            regressions.append(f"{op}: p99 {before['p99_us']:.1f} -> {now['p99_us']:.1f} us")
+    return regressions
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        mix[op.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Multi-ATM load generator for lab5')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--accounts-per-type', type=int, default=1)
+    parser.add_argument('--atms', type=int, default=20)
+    parser.add_argument('--edcs', type=int, default=10)
+    parser.add_argument('--counters', type=int, default=5)
+    parser.add_argument('--sessions', type=int, default=100_000)
+    parser.add_argument('--mix', type=_parse_mix, default=None, help='e.g. withdraw=0.4,pay=0.3,deposit=0.3')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pin-iterations', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=1, help='0 = os.cpu_count()')
+    parser.add_argument('--save', help='write result JSON (ใช้เป็น baseline ครั้งถัดไป)')
+    parser.add_argument('--baseline', help='compare against a saved result JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    config = LoadConfig(args.users, args.accounts_per_type, args.atms, args.edcs, args.counters,
+                        args.sessions, args.mix, args.seed, args.pin_iterations)
+    result = run_load(config, args.processes or os.cpu_count() or 1)
+    print(result.format())
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result.to_dict(), f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())